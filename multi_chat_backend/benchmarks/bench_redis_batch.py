@@ -0,0 +1,100 @@
+"""redis 批量接口基准: 逐个读写 vs MGET/pipeline
+
+用法 (在 multi_chat_backend 目录下, 需要可用的 redis, 地址取 config.redis.redis_url):
+    python -m benchmarks.bench_redis_batch [--accounts 200] [--repeat 5]
+
+往返次数与网络延迟成正比, 本机 redis 上的差距主要来自命令调度, 跨机房部署时差距更大.
+基准使用独立的 key 前缀, 结束后删除.
+"""
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable, List
+
+from multi_chat import config
+from multi_chat.chatgpt.available_openai_account_set import (
+    AvailableOpenAIAccount, AvailableOpenAIAccountSet)
+from multi_chat.chatgpt.openai_account_cache import (OpenAIAccount,
+                                                     OpenAIAccountCache)
+from multi_chat.redis import create_connection, get_database
+
+
+async def bench(name: str, func: Callable[[], Awaitable], round_trips: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24} round_trips={round_trips:<6} total={best * 1000:8.2f} ms")
+    return best
+
+
+async def run(accounts: int, repeat: int) -> None:
+    # 不污染线上数据, 也不使用进程内缓存
+    config.redis.redis_prefix = "bench_redis_batch"
+    OpenAIAccountCache._local = None
+    AvailableOpenAIAccountSet._local = None
+
+    await create_connection()
+
+    emails: List[str] = [f"bench{i}@example.com" for i in range(accounts)]
+    values = {
+        email: OpenAIAccount(email=email, password="x", access_token="t" * 1200, expiry=int(time.time()) + 3600, proxy=None)
+        for email in emails
+    }
+    items = [AvailableOpenAIAccount(email=email) for email in emails]
+
+    async def set_each() -> None:
+        for email, value in values.items():
+            await OpenAIAccountCache.set(key=email, value=value, ex=600)
+
+    async def set_many() -> None:
+        await OpenAIAccountCache.set_many(values, ex=600)
+
+    async def get_each() -> None:
+        for email in emails:
+            await OpenAIAccountCache.get(key=email)
+
+    async def get_many() -> None:
+        await OpenAIAccountCache.get_many(emails)
+
+    async def add_each() -> None:
+        for item in items:
+            await AvailableOpenAIAccountSet.add(item=item)
+
+    async def add_many() -> None:
+        await AvailableOpenAIAccountSet.add_many(items)
+
+    async def exists_each() -> None:
+        for item in items:
+            await AvailableOpenAIAccountSet.exists(item=item)
+
+    async def exists_many() -> None:
+        await AvailableOpenAIAccountSet.exists_many(items)
+
+    try:
+        for name_each, func_each, name_many, func_many in [
+            ("set (each)", set_each, "set_many (pipeline)", set_many),
+            ("get (each)", get_each, "get_many (MGET)", get_many),
+            ("add (each)", add_each, "add_many (SADD)", add_many),
+            ("exists (each)", exists_each, "exists_many (pipeline)", exists_many),
+        ]:
+            old = await bench(name_each, func_each, accounts, repeat)
+            new = await bench(name_many, func_many, 1, repeat)
+            print(f"{'speedup':<24} {old / new:.2f}x")
+    finally:
+        await OpenAIAccountCache.delete_many(emails)
+        await get_database().delete(AvailableOpenAIAccountSet.get_key())  # type: ignore
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.accounts, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
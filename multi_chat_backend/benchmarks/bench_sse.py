@@ -0,0 +1,113 @@
+"""上游 SSE 解析微基准
+
+用法 (在 multi_chat_backend 目录下):
+    python -m benchmarks.bench_sse [录制的原始响应文件] [--chunk-size 1024]
+
+录制文件是 chat.openai.com/backend-api/conversation 或 api.openai.com/v1/completions
+返回的原始字节流; 不传时生成一段模拟 ChatGPT 的累计式回复 (约 2000 token).
+"""
+import argparse
+import json
+import time
+import uuid
+from typing import Iterator, List
+
+import orjson
+from httpx._decoders import LineDecoder, TextDecoder
+
+from multi_chat.upstream.sse import DONE, SSEParser
+
+
+def fake_chatgpt_stream(tokens: int = 2000) -> bytes:
+    message_id = str(uuid.uuid4())
+    conversation_id = str(uuid.uuid4())
+    text = ""
+    events = []
+    for i in range(tokens):
+        text += "词" if i % 3 == 0 else " word"
+        events.append(b"data: " + json.dumps({
+            "message": {
+                "id": message_id,
+                "role": "assistant",
+                "user": None,
+                "create_time": None,
+                "update_time": None,
+                "content": {"content_type": "text", "parts": [text]},
+                "end_turn": None,
+                "weight": 1.0,
+                "metadata": {},
+                "recipient": "all",
+            },
+            "conversation_id": conversation_id,
+            "error": None,
+        }, ensure_ascii=False).encode("utf8") + b"\n\n")
+    events.append(b"data: [DONE]\n\n")
+    return b"".join(events)
+
+
+def split_chunks(raw: bytes, chunk_size: int) -> List[bytes]:
+    return [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+
+
+def parse_lines(chunks: List[bytes]) -> Iterator[dict]:
+    """原实现: aiter_lines + rstrip + 切片 + json.loads"""
+    text_decoder = TextDecoder()
+    line_decoder = LineDecoder()
+    for chunk in chunks:
+        for line in line_decoder.decode(text_decoder.decode(chunk)):
+            line = line.rstrip()
+            if len(line) == 0:
+                continue
+            if line[:6] == "data: ":
+                line = line[6:]
+            if line == "[DONE]":
+                return
+            if len(line) == 0:
+                continue
+            yield json.loads(line)
+
+
+def parse_bytes(chunks: List[bytes]) -> Iterator[dict]:
+    """新实现: SSEParser + orjson"""
+    parser = SSEParser()
+    for chunk in chunks:
+        for data in parser.feed(chunk):
+            if data == DONE:
+                return
+            yield orjson.loads(data)
+
+
+def bench(name: str, func, chunks: List[bytes], repeat: int) -> float:
+    best = float("inf")
+    events = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        events = sum(1 for _ in func(chunks))
+        best = min(best, time.process_time() - start)
+    print(f"{name:<8} events={events:<6} total={best * 1000:8.2f} ms  per_event={best / max(events, 1) * 1e6:8.2f} us")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recorded", nargs="?", default=None)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.recorded is None:
+        raw = fake_chatgpt_stream()
+    else:
+        with open(args.recorded, "rb") as f:
+            raw = f.read()
+
+    chunks = split_chunks(raw, args.chunk_size)
+    print(f"stream={len(raw)} bytes chunks={len(chunks)}")
+
+    old = bench("lines", parse_lines, chunks, args.repeat)
+    new = bench("bytes", parse_bytes, chunks, args.repeat)
+    print(f"speedup  {old / new:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,21 @@ import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from . import config, session
+from . import config, metrics, session
 from .chatgpt import create_chatgpt_client, get_chatgpt_client, refresh
 from .dialog import ask, conversation, feedback, moderations
 from .gpt3 import create_gpt3_client
 from .log import logger
 from .mongo import create_connection as create_mongo_connection
+from .mongo.indexes import start_index_reconciler, stop_index_reconciler
+from .mongo.write_behind import start_write_behind, stop_write_behind
 from .oauth2 import token
+from .redis import close_connection as close_redis_connection
 from .redis import create_connection as create_redis_connection
+from .redis.local import (start_invalidation_listener,
+                          stop_invalidation_listener)
 from .tasks import repeat_task
+from .upstream import close_clients as close_upstream_clients
 
 app = FastAPI(
     debug=config.fastapi.debug,
@@ -32,6 +38,7 @@ app.add_middleware(
 app.include_router(ask.router, prefix="/dialog", tags=["dialog"])
 app.include_router(session.router, prefix="/session", tags=["session"])
 app.include_router(refresh.router, prefix="/refresh", tags=["refresh"])
+app.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
 
 # 原版接口
 app.include_router(conversation.router, prefix="/backend-api", tags=["backend-api"])
@@ -48,6 +55,12 @@ async def refresh_chatgpt_all_accounts() -> None:
     await get_chatgpt_client()._refresh_all_accounts()
 
 
+@app.on_event('startup')
+@repeat_task(seconds=config.chatgpt.renew_check_seconds, wait_first=True)
+async def renew_chatgpt_tokens() -> None:
+    await get_chatgpt_client()._renew_expiring_tokens()
+
+
 @app.on_event("startup")
 async def startup():
 
@@ -57,6 +70,15 @@ async def startup():
         create_redis_connection(),
     )
 
+    # 后台核对 mongo 索引
+    start_index_reconciler()
+
+    # 对话记录异步批量写入
+    start_write_behind()
+
+    # 进程内缓存的失效订阅
+    start_invalidation_listener()
+
     # chatgpt初始化
     await asyncio.gather(
         create_chatgpt_client(),
@@ -65,4 +87,16 @@ async def startup():
 
     logger.info("startup success")
 
-    
\ No newline at end of file
+
+@app.on_event("shutdown")
+async def shutdown():
+
+    # 关闭上游长连接
+    await close_upstream_clients()
+    await stop_invalidation_listener()
+    await stop_index_reconciler()
+    # 写完队列里的对话记录, 需要在关闭 redis 之前
+    await stop_write_behind()
+    await close_redis_connection()
+
+    logger.info("shutdown success")
@@ -2,23 +2,39 @@ import asyncio
 import json
 import os
 import random
-from typing import AsyncGenerator, List, Mapping, Optional, Tuple
+import time
+from collections import Counter
+from typing import AsyncGenerator, Dict, List, Mapping, Optional, Tuple
 from uuid import UUID, uuid1
 
 import aiofiles
+import httpx
 from asyncer import asyncify
 from pychatgpt.classes import exceptions as Exceptions
-from self_limiters import MaxSleepExceededError, RedisError, Semaphore
+from redis.exceptions import RedisError
 
 from multi_chat import config, logger
 
+from ..metrics import register_collector
+from ..redis.lock import LockTimeoutError, RedisSemaphore
+from ..session.state import SessionState
+from ..upstream.errors import (AccountUnavailableError, AuthError,
+                               CloudflareError, OverloadedError,
+                               RateLimitError, StreamError, UpstreamError)
+from ..upstream.retry import RetryPolicy, StreamResume
 from . import auth as openai
+from .account_scheduler import AccountClaim, AccountScheduler
 from .ask import ask as chatgpt_ask
+from .ask import probe as chatgpt_probe
 from .available_openai_account_set import (AvailableOpenAIAccount,
                                            AvailableOpenAIAccountSet)
 from .cf_clearance import CFClearance, CFClearanceCache, get_cf_clearance
+from .circuit_breaker import CircuitBreaker
+from .hedge import Hedger
+from .migration import build_migration_prompt
 from .chatgpt_dialog_info import (get_now_dialog_info,
                                   save_new_dialog_info_and_update_now)
+from .models import AccountRefreshResult, RefreshReport
 from .openai_account_cache import OpenAIAccount, OpenAIAccountCache
 
 
@@ -52,6 +68,12 @@ def _openai_login(
     return access_token, expires_at 
 
 
+def _need_renew(account: OpenAIAccount, renew_before: Optional[float]) -> bool:
+    if renew_before is None:
+        return False
+    return account.expiry is None or account.expiry <= renew_before
+
+
 class MChatGPT:
     
     def __init__(self) -> None:
@@ -64,11 +86,23 @@ class MChatGPT:
                 self.account_map_idx[account['email']] = account_idx
                 self.accounts.append(OpenAIAccount.parse_obj(account))
 
+        self.scheduler = AccountScheduler()
+        self.breaker = CircuitBreaker()
+        self.hedger = Hedger()
+        # (策略, 原因, 结果) -> 次数
+        self.migrations: Counter = Counter()
+
+        # 每个账号固定一个随机提前量, 把续期分散开
+        self.renew_jitter: Mapping[str, float] = {
+            account.email: random.uniform(0, config.chatgpt.renew_jitter_seconds)
+            for account in self.accounts
+        }
+
 
     async def _save_accounts_to_json(self) -> None:
         tmp_accounts = []
-        for account in self.accounts:
-            new_account = await OpenAIAccountCache.get(account.email)
+        cached_accounts = await OpenAIAccountCache.get_many([account.email for account in self.accounts])
+        for account, new_account in zip(self.accounts, cached_accounts):
             # 获取数据失败
             if new_account is None:
                 new_account = account
@@ -79,42 +113,232 @@ class MChatGPT:
             await f.write(json.dumps(tmp_accounts, indent=4, ensure_ascii=False))
 
 
-    async def _refresh_all_accounts(self) -> None:
-        for account in self.accounts:
+    async def _probe_account(self, account: OpenAIAccount) -> Optional[bool]:
+        """轻量探测账号是否可用, 返回 None 表示无法判断"""
+        email = account.email
+        access_token, _, proxy = await self._get_account_access_token(email, refresh_not_available=True)
+        assert access_token is not None
+
+        relogin = False
+        recleared = False
+        while True:
+            chat_cf_clearance = await get_cf_clearance(
+                url="https://chat.openai.com/chat",
+                proxies=proxy
+            )
+
             try:
-                # 尝试登录更新
-                test_re = "fail", "fail", "fail", "fail"
-                async for tmp_re in self._ask(
-                    prompt="1+1=?",
-                    account_email=account.email,
-                    conversation_id=None,
-                    previous_convo_id=None,
-                ):
-                    test_re = tmp_re
-                logger.info(account.email + " login success")
-                logger.info("answer is: " + test_re[0])
+                status_code, r_text = await chatgpt_probe(
+                    auth_token=access_token,
+                    proxies=proxy,
+                    chat_cf_clearance=chat_cf_clearance,
+                )
+            except httpx.HTTPError as e:
+                logger.info(email + " probe error: " + type(e).__name__)
+                return None
+
+            if status_code == 200:
+                return True
+
+            if status_code == 401 or "token has expired" in r_text:
+                if relogin:
+                    return False
+                # token 失效, 重新登录后再探测一次
+                relogin = True
+                await AvailableOpenAIAccountSet.remove(item=AvailableOpenAIAccount(email=email))
+                access_token, _, proxy = await self._get_account_access_token(email, refresh_not_available=True)
+                assert access_token is not None
+                continue
+
+            if status_code == 403 and "cloudflare" in r_text.lower():
+                if recleared:
+                    return None
+                # cf 失效, 刷新后再探测一次
+                recleared = True
+                logger.warning("https://chat.openai.com/chat" + " cf is not available")
+                await CFClearanceCache.delete(key="https://chat.openai.com/chat" + str(proxy))
+                continue
+
+            logger.info(email + " probe undecided: " + str(status_code))
+            return None
+
+
+    async def _refresh_account(self, account: OpenAIAccount) -> str:
+        if config.chatgpt.refresh_probe:
+            healthy = await self._probe_account(account)
+
+            if healthy is True:
+                await AvailableOpenAIAccountSet.add(item=AvailableOpenAIAccount(email=account.email))
+                logger.info(account.email + " probe success")
+                return "probe"
+
+            if healthy is False:
+                await AvailableOpenAIAccountSet.remove(item=AvailableOpenAIAccount(email=account.email))
+                raise Exception(account.email + " probe unhealthy")
+
+        # 探测无法判断时, 退回完整对话验证
+        # 尝试登录更新
+        test_re = "fail", "fail", "fail", "fail"
+        async for tmp_re in self._ask(
+            prompt="1+1=?",
+            account_email=account.email,
+            conversation_id=None,
+            previous_convo_id=None,
+        ):
+            test_re = tmp_re
+        logger.info(account.email + " login success")
+        logger.info("answer is: " + test_re[0])
+        return "conversation"
+
+
+    async def _refresh_account_with_report(
+        self,
+        account: OpenAIAccount,
+        limiter: asyncio.Semaphore,
+    ) -> AccountRefreshResult:
+        async with limiter:
+            started = time.monotonic()
+            method = None
+            try:
+                method = await asyncio.wait_for(
+                    self._refresh_account(account),
+                    timeout=config.chatgpt.refresh_timeout,
+                )
+                # 探测在限流时也返回 200, 只恢复登录和 token 失效引起的熔断
+                await self.breaker.record_success(account.email, reasons=("login", "token"))
+                outcome, error = "success", None
+            except asyncio.TimeoutError as e:
+                logger.info(account.email + " login timeout")
+                outcome, error = "timeout", e
             except Exception as e:
                 logger.info(account.email + " login fail")
                 logger.exception(e)
+                outcome, error = "fail", e
+
+            return AccountRefreshResult(
+                email=account.email,
+                outcome=outcome,
+                method=method,
+                duration=time.monotonic() - started,
+                error_class=type(error).__name__ if error is not None else None,
+                error=str(error)[:500] if error is not None else None,
+            )
+
+
+    async def _warm_cf_clearance(self, proxy: Optional[str], limiter: asyncio.Semaphore) -> None:
+        async with limiter:
+            try:
+                await get_cf_clearance(url="https://chat.openai.com/chat", proxies=proxy)
+            except Exception as e:
+                logger.warning("warm cf clearance fail: " + type(e).__name__)
+
+
+    async def _renew_account(self, account: OpenAIAccount, limiter: asyncio.Semaphore) -> None:
+        async with limiter:
+            try:
+                renew_before = time.time() + config.chatgpt.renew_margin_seconds + self.renew_jitter[account.email]
+                await self._get_account_access_token(
+                    account.email,
+                    refresh_not_available=True,
+                    renew_before=renew_before,
+                )
+                logger.info(account.email + " renew token")
+            except Exception as e:
+                logger.warning(account.email + " renew token fail: " + type(e).__name__)
+
+
+    async def _renew_expiring_tokens(self) -> None:
+        """在 token 和 cf clearance 过期前主动续期, 用户请求基本不会走到登录"""
+        now = time.time()
+        limiter = asyncio.Semaphore(config.chatgpt.refresh_concurrency)
+
+        # cf clearance 先续期, 登录时会用到
+        proxies = list({account.proxy for account in self.accounts})
+        for proxy in proxies:
+            ttl = await CFClearanceCache.ttl(key="https://chat.openai.com/chat" + str(proxy))
+            if 0 <= ttl < config.chatgpt.renew_margin_seconds:
+                try:
+                    await get_cf_clearance(
+                        url="https://chat.openai.com/chat",
+                        proxies=proxy,
+                        renew_within=config.chatgpt.renew_margin_seconds,
+                    )
+                    logger.info("renew cf clearance: " + str(proxy))
+                except Exception as e:
+                    logger.warning("renew cf clearance fail: " + type(e).__name__)
+
+        emails = [account.email for account in self.accounts]
+        cached_accounts = await OpenAIAccountCache.get_many(emails)
+        available = await AvailableOpenAIAccountSet.exists_many([AvailableOpenAIAccount(email=email) for email in emails])
+
+        expiring = []
+        for account, cached, is_available in zip(self.accounts, cached_accounts, available):
+            # 没有缓存或不可用的账号交给刷新和请求路径处理
+            if cached is None or cached.expiry is None:
+                continue
+            if not is_available:
+                continue
+            if cached.expiry - now <= config.chatgpt.renew_margin_seconds + self.renew_jitter[account.email]:
+                expiring.append(account)
+
+        await asyncio.gather(*[self._renew_account(account, limiter) for account in expiring])
+
+
+    async def _refresh_all_accounts(self) -> RefreshReport:
+        started_at = int(time.time())
+        started = time.monotonic()
+        limiter = asyncio.Semaphore(config.chatgpt.refresh_concurrency)
+
+        # 同一代理的账号共用 cf clearance, 先按代理各取一次, 避免并发时争抢同一把锁
+        proxies = list({account.proxy for account in self.accounts})
+        await asyncio.gather(*[self._warm_cf_clearance(proxy, limiter) for proxy in proxies])
+
+        results = await asyncio.gather(*[
+            self._refresh_account_with_report(account, limiter)
+            for account in self.accounts
+        ])
+
+        report = RefreshReport(
+            started_at=started_at,
+            duration=time.monotonic() - started,
+            total=len(results),
+            success=sum(1 for result in results if result.outcome == "success"),
+            fail=sum(1 for result in results if result.outcome == "fail"),
+            timeout=sum(1 for result in results if result.outcome == "timeout"),
+            # 只统计配置中的账号, 不算集合里残留的旧账号
+            available=sum(await AvailableOpenAIAccountSet.exists_many([
+                AvailableOpenAIAccount(email=account.email) for account in self.accounts
+            ])),
+            accounts=results,
+        )
+
+        error_classes = Counter(result.error_class for result in results if result.error_class is not None)
+        logger.info(
+            f"refresh all accounts finish: {report.success}/{report.total} success, "
+            f"{report.fail} fail, {report.timeout} timeout, {report.available} available, "
+            f"{report.duration:.1f}s, errors: {dict(error_classes)}"
+        )
 
         # 检查
-        assert await AvailableOpenAIAccountSet.count() > 0, "至少一个可用账号"
+        assert report.available > 0, "至少一个可用账号"
         # 保存
         await self._save_accounts_to_json()
 
-        logger.info("refresh all accounts finish")
+        return report
 
     async def _get_account_access_token(
         self, 
         email: str, 
         refresh_not_available: bool=False, 
-        retry: int=5
+        retry: int=5,
+        renew_before: Optional[float]=None,
     ) -> Tuple[Optional[str], Optional[int], Optional[str]]:
+        """获取账号 token, renew_before 不为空时表示续期: token 在该时间之前过期就重新登录"""
         
         # 写缓存模式
         account = await OpenAIAccountCache.get(key=email)
 
-        if account is not None:
+        if account is not None and not _need_renew(account, renew_before):
             if await AvailableOpenAIAccountSet.exists(item=AvailableOpenAIAccount(email=email)) == True:
                 return account.access_token, account.expiry, account.proxy
             else:
@@ -123,14 +347,21 @@ class MChatGPT:
                     raise Exception("account is not available")
 
         try:
-            # 获取锁
-            async with Semaphore(
-                name="mchatgpt:account_cache_update_lock",
+            # 获取锁, 阻塞等待持有者释放
+            async with RedisSemaphore(
+                name="mchatgpt:account_cache_update_lock:" + email,
                 capacity=1,
-                redis_url=config.redis.redis_url,
-                expiry=1800,
-                max_sleep=1.0,
-            ):
+            ) as lock:
+                # 续期时其他 worker 可能已经更新过; 账号已被移出可用集合时 token 失效, 必须重新登录
+                if renew_before is not None:
+                    account = await OpenAIAccountCache.get(key=email, local=False)
+                    if (
+                        account is not None
+                        and not _need_renew(account, renew_before)
+                        and await AvailableOpenAIAccountSet.exists(item=AvailableOpenAIAccount(email=email)) == True
+                    ):
+                        return account.access_token, account.expiry, account.proxy
+
                 account = self.accounts[self.account_map_idx[email]]
 
                 chat_cf_clearance = await get_cf_clearance(
@@ -152,7 +383,9 @@ class MChatGPT:
                 account.access_token = access_token
                 account.expiry = expiry
 
-                await OpenAIAccountCache.set(key=email, value=account, ex=random.randint(21600, 28800))
+                # 登录耗时较长, 租约丢失后别的 worker 可能已经写入更新的 token
+                lock.ensure_held()
+                await OpenAIAccountCache.set(key=email, value=account, ex=random.randint(21600, 28800), fence=lock.fence)
 
                 # 设置为
                 await AvailableOpenAIAccountSet.add(item=AvailableOpenAIAccount(email=email))
@@ -160,13 +393,10 @@ class MChatGPT:
                 logger.info(email + " update token")
                 return account.access_token, account.expiry, account.proxy
 
-        # 锁拿不到
-        except MaxSleepExceededError  as e:
-            logger.info(email + "get update lock retry")
-            if retry > 0:
-                return await self._get_account_access_token(email, refresh_not_available, retry-1)
-            else:
-                raise Exception(email + "get update lock retry max")
+        # 等锁超时, 持有者一直没有登录完
+        except LockTimeoutError as e:
+            logger.info(email + " get update lock timeout")
+            raise e
 
         except Exceptions.Auth0Exception as e:
             # cf 失效
@@ -184,10 +414,18 @@ class MChatGPT:
                 logger.info(email + " is not available")
                 
                 await AvailableOpenAIAccountSet.remove(item=AvailableOpenAIAccount(email=email))
+                # 冷却结束后由调度器放行试探请求重新登录, 不必等到下一次整体刷新
+                if refresh_not_available == True:
+                    await self.breaker.record_failure(
+                        email,
+                        reason="login",
+                        cooldown=config.chatgpt.breaker_login_cooldown_seconds,
+                        hard=True,
+                    )
                 raise e
             else:
                 logger.info(email + "get update retry")
-                return await self._get_account_access_token(email, refresh_not_available, retry-1)
+                return await self._get_account_access_token(email, refresh_not_available, retry-1, renew_before)
 
 
     async def ask(
@@ -195,23 +433,32 @@ class MChatGPT:
         prompt: str,
         session_id: UUID,
         previous_dhid: Optional[UUID] = None,
-        retry: int = 5,
+        retry: Optional[int] = None,
+        state: Optional[SessionState] = None,
     ) -> AsyncGenerator[Tuple[str, UUID, UUID], None]:
 
         openai_account_email = None
         openai_previous_convo_id = None
         openai_conversation_id = None
+        history_dhid = None
 
         # 获取openai历史信息
+        # 调用方传入本轮共享的会话状态时由调用方写回, 否则自己读写
+        own_state = state is None
+        if state is None:
+            state = await SessionState.load(session_id)
+
         last_dialog_info = await get_now_dialog_info(
             session_id=session_id,
-            dhid=previous_dhid
+            dhid=previous_dhid,
+            state=state,
         )
 
         if last_dialog_info is not None:
             openai_account_email = last_dialog_info.openai_account_email
             openai_previous_convo_id = last_dialog_info.openai_previous_convo_id
             openai_conversation_id = last_dialog_info.openai_conversation_id
+            history_dhid = last_dialog_info.dhid
 
         now_dhid = uuid1()
 
@@ -220,13 +467,39 @@ class MChatGPT:
         new_openai_previous_convo_id = ""
         new_openai_conversation_id = ""
 
-        async for r_item in self._ask(
-            prompt=prompt,
-            account_email=openai_account_email,
-            previous_convo_id=openai_previous_convo_id,
-            conversation_id=openai_conversation_id,
-            retry=retry,
+        if (
+            config.chatgpt.hedge_enabled
+            and openai_account_email is None
+            and openai_conversation_id is None
+        ):
+            # 新会话任何账号都可以处理, 首字超时时对冲到另一个账号
+            r_iter = self.hedger.race(lambda: self._ask(prompt=prompt, retry=retry))
+        elif (
+            config.chatgpt.migration_enabled
+            and openai_account_email is not None
+            and not await self._account_usable(openai_account_email)
         ):
+            # 固定账号已不可用, 不等重新登录, 直接迁移到其他账号
+            r_iter = self._migrate(prompt, session_id, history_dhid, openai_account_email, "unavailable", retry)
+        elif openai_account_email is not None:
+            r_iter = self._ask_pinned(
+                prompt=prompt,
+                session_id=session_id,
+                history_dhid=history_dhid,
+                account_email=openai_account_email,
+                previous_convo_id=openai_previous_convo_id,
+                conversation_id=openai_conversation_id,
+                retry=retry,
+            )
+        else:
+            r_iter = self._ask(
+                prompt=prompt,
+                previous_convo_id=openai_previous_convo_id,
+                conversation_id=openai_conversation_id,
+                retry=retry,
+            )
+
+        async for r_item in r_iter:
             answer = r_item[0]
             new_openai_account_email = r_item[1]
             new_openai_previous_convo_id = r_item[2]
@@ -235,6 +508,11 @@ class MChatGPT:
             yield answer, session_id, now_dhid 
 
         if len(answer) > 0:
+            # 已有会话换了 conversation 说明发生了迁移
+            migrated_from = None
+            if openai_conversation_id is not None and new_openai_conversation_id != openai_conversation_id:
+                migrated_from = openai_account_email
+
             await save_new_dialog_info_and_update_now(
                 session_id=session_id,
 
@@ -242,7 +520,80 @@ class MChatGPT:
                 openai_account_email=new_openai_account_email,
                 openai_previous_convo_id=new_openai_previous_convo_id,
                 openai_conversation_id=new_openai_conversation_id,
+                migrated_from=migrated_from,
+                state=state,
             )
+            if own_state:
+                await state.commit()
+
+
+    async def _account_usable(self, email: str) -> bool:
+        if await AvailableOpenAIAccountSet.exists(item=AvailableOpenAIAccount(email=email)) == False:
+            return False
+        # 熔断冷却中
+        return (await self.breaker.state(email)).state != "open"
+
+
+    async def _ask_pinned(
+        self,
+        prompt: str,
+        session_id: UUID,
+        history_dhid: Optional[UUID],
+        account_email: str,
+        conversation_id: Optional[str],
+        previous_convo_id: Optional[str],
+        retry: Optional[int],
+    ) -> AsyncGenerator[Tuple[str, str, str, str], None]:
+        """已有会话留在原账号, 首字之前失败时迁移到其他账号"""
+        started = False
+        try:
+            async for item in self._ask(
+                prompt=prompt,
+                account_email=account_email,
+                conversation_id=conversation_id,
+                previous_convo_id=previous_convo_id,
+                retry=retry,
+            ):
+                started = True
+                yield item
+            return
+        except Exception as e:
+            if started or not config.chatgpt.migration_enabled:
+                raise
+            logger.warning(account_email + " pinned conversation failed, migrate: " + type(e).__name__)
+
+        async for item in self._migrate(prompt, session_id, history_dhid, account_email, "failed", retry):
+            yield item
+
+
+    async def _migrate(
+        self,
+        prompt: str,
+        session_id: UUID,
+        history_dhid: Optional[UUID],
+        from_email: str,
+        reason: str,
+        retry: Optional[int],
+    ) -> AsyncGenerator[Tuple[str, str, str, str], None]:
+        """在负载最低的可用账号上新开会话, 用历史记录重建上下文"""
+        strategy = config.chatgpt.migration_strategy
+        migration_prompt = await build_migration_prompt(session_id, history_dhid, prompt, strategy)
+        logger.info(f"migrate {session_id} from {from_email}: {reason}, {strategy}, {len(migration_prompt)} chars")
+
+        try:
+            async for item in self._ask(prompt=migration_prompt, retry=retry):
+                yield item
+        except Exception:
+            self.migrations[(strategy, reason, "fail")] += 1
+            raise
+        self.migrations[(strategy, reason, "success")] += 1
+
+
+    def migration_stats(self) -> List[dict]:
+        return [
+            dict(strategy=strategy, reason=reason, outcome=outcome, count=count)
+            for (strategy, reason, outcome), count in self.migrations.items()
+        ]
 
 
     async def _ask(
@@ -251,24 +602,126 @@ class MChatGPT:
         account_email: Optional[str] = None,
         conversation_id: Optional[str] = None,
         previous_convo_id: Optional[str] = None,
-        retry: int = 5,
+        retry: Optional[int] = None,
     ) -> AsyncGenerator[Tuple[str, str, str, str], None]:
 
+        policy = RetryPolicy(
+            "chatgpt",
+            budget=retry,
+            retry_on=(AuthError, RateLimitError, CloudflareError, OverloadedError, StreamError),
+        )
+        # 重试会从头重新生成, 新回答超过已发送的长度后再继续发送
+        resume = StreamResume()
+
+        while True:
+            state: Dict[str, Optional[str]] = dict(account_email=account_email)
+            last_item: Optional[Tuple[str, str, str, str]] = None
+            last_sent = False
+
+            try:
+                async for item in self._ask_once(
+                    prompt=prompt,
+                    account_email=account_email,
+                    conversation_id=conversation_id,
+                    previous_convo_id=previous_convo_id,
+                    state=state,
+                ):
+                    last_item = item
+                    last_sent = resume.accept(len(item[0]))
+                    if last_sent:
+                        yield item
+
+                # 重试后的回答比之前发送的短, 最后补发完整回答 (以及新的会话 id)
+                if last_item is not None and not last_sent:
+                    yield last_item
+                return
+
+            except UpstreamError as e:
+                failed_email = state["account_email"]
+                if failed_email is None:
+                    raise
+
+                # 新会话可以换账号重试, 已有会话只能留在原账号
+                retry_email = failed_email if conversation_id is not None else None
+
+                if isinstance(e, RateLimitError):
+                    logger.warning(failed_email + "\n" + str(e))
+                    # 限流: 熔断到限流窗口结束后自动恢复, 不再注销账号
+                    await self.breaker.record_failure(
+                        failed_email,
+                        reason="rate_limit",
+                        cooldown=config.chatgpt.breaker_rate_limit_cooldown_seconds,
+                        hard=True,
+                    )
+                    await self.scheduler.exhaust(failed_email)
+                    # 已有会话换不了账号, 不重试
+                    if retry_email is not None:
+                        raise
+                elif isinstance(e, AuthError):
+                    logger.warning(failed_email + "\n" + str(e))
+                    # token 失效: 删除缓存的 token, 下次使用时重新登录, 冷却期间新会话换账号
+                    await OpenAIAccountCache.delete(key=failed_email)
+                    await self.breaker.record_failure(
+                        failed_email,
+                        reason="token",
+                        cooldown=config.chatgpt.breaker_token_cooldown_seconds,
+                        hard=True,
+                    )
+                elif isinstance(e, CloudflareError):
+                    logger.warning("https://chat.openai.com/chat" + " cf is not available")
+                    proxy = self.accounts[self.account_map_idx[failed_email]].proxy
+                    await CFClearanceCache.delete(key="https://chat.openai.com/chat" + str(proxy))
+                    # cf 和账号无关, 留在原账号
+                    retry_email = failed_email
+                elif isinstance(e, (OverloadedError, StreamError)):
+                    # 连续失败达到阈值才熔断
+                    await self.breaker.record_failure(
+                        failed_email,
+                        reason="upstream",
+                        cooldown=config.chatgpt.breaker_cooldown_seconds,
+                    )
+
+                if not policy.should_retry(e):
+                    raise
+
+                account_email = retry_email
+                await policy.backoff(e)
+
+
+    async def _ask_once(
+        self, 
+        prompt: str,
+        account_email: Optional[str],
+        conversation_id: Optional[str],
+        previous_convo_id: Optional[str],
+        state: Dict[str, Optional[str]],
+    ) -> AsyncGenerator[Tuple[str, str, str, str], None]:
+        """单次请求, 实际使用的账号写入 state, 供重试时判断"""
+
+        # 新会话按负载领取账号, 已有会话登记在原账号上
+        claim: Optional[AccountClaim] = None
         if account_email is None:
-            tmp_account_email = await AvailableOpenAIAccountSet.random_get()
-            account_email = tmp_account_email.email if tmp_account_email is not None else None
+            claim = await self.scheduler.claim([account.email for account in self.accounts])
+            account_email = claim.email if claim is not None else None
+        else:
+            claim = await self.scheduler.acquire(account_email)
+
+        if account_email is None or claim is None:
+            raise AccountUnavailableError("no chatgpt account available, try again later")
+        state["account_email"] = account_email
 
-        assert account_email is not None
+        started = time.monotonic()
+        first_token_latency: Optional[float] = None
+        failed = False
 
         try:
             access_token, expiry, proxy = await self._get_account_access_token(account_email, refresh_not_available=True)
 
-            async with Semaphore(
+            # 流式对话可能很长, 持有期间自动续租
+            async with RedisSemaphore(
                 name="mchatgpt:account_semaphores:" + account_email,
                 capacity=1,
-                redis_url=config.redis.redis_url,
-                expiry=1800,
-                max_sleep=5.0,
+                timeout=5.0,
             ):
 
                 logger.info(
@@ -295,76 +748,20 @@ class MChatGPT:
                     proxies=proxy, # type: ignore
                     chat_cf_clearance=chat_cf_clearance,
                 ):
+                    if first_token_latency is None:
+                        first_token_latency = time.monotonic() - started
+                        self.hedger.observe(first_token_latency)
                     yield answer, account_email, previous_convo, convo_id
 
-        except Exception as e:
-            e_str =  str(e)
-            if (
-                "parse your authentication token" in e_str
-                or "token has expired" in e_str
-                or "Too many requests in 1 hour" in e_str
-            ):
-                logger.warning(account_email + "\n" + e_str)
-                # logger.warning(account_email + " is not available")
-                # token 失效注销
-                await AvailableOpenAIAccountSet.remove(item=AvailableOpenAIAccount(email=account_email))
-
-                if retry > 0:
-                    async for retry_re in self._ask(
-                        prompt=prompt,
-                        account_email=account_email,
-                        conversation_id=conversation_id,
-                        previous_convo_id=previous_convo_id,
-                        retry=retry-1,
-                    ):
-                        yield retry_re
-                else:
-                    logger.warning(account_email + " retry max")
-                    raise e
-            elif (
-                "Maybe try me again" in e_str
-                or "incomplete chunked read" in e_str
-                or "peer closed connection" in e_str
-            ):
-                if retry > 0:
-                    # 休眠一下
-                    await asyncio.sleep(0.3)
-
-                    async for retry_re in self._ask(
-                        prompt=prompt,
-                        account_email=account_email,
-                        conversation_id=conversation_id,
-                        previous_convo_id=previous_convo_id,
-                        retry=retry-1,
-                    ):
-                        yield retry_re
-                else:
-                    logger.warning(account_email + " retry max")
-                    raise e
-            elif (
-                "[Status Code] 403" in e_str 
-                and "cloudflare" in e_str 
-            ):
-                if retry > 0:
-                    
-                    # 休眠一下
-                    await asyncio.sleep(0.3)
-                    logger.warning("https://chat.openai.com/chat" + " cf is not available")
-                    await CFClearanceCache.delete(key="https://chat.openai.com/chat")
-
-                    async for retry_re in self._ask(
-                        prompt=prompt,
-                        account_email=account_email,
-                        conversation_id=conversation_id,
-                        previous_convo_id=previous_convo_id,
-                        retry=retry-1,
-                    ):
-                        yield retry_re
-                else:
-                    logger.warning(account_email + " retry max")
-                    raise e
-            else:
-                raise e
+            # 试探成功或之前有失败, 恢复熔断器
+            if claim.breaker_state != "closed":
+                await self.breaker.record_success(account_email)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # 重试前先释放在途登记
+            await self.scheduler.release(claim, latency=first_token_latency, error=failed)
 
     
 _chatgpt_client: Optional[MChatGPT] = None
@@ -373,6 +770,18 @@ async def create_chatgpt_client():
     global _chatgpt_client
     _chatgpt_client = MChatGPT()
 
+    client = _chatgpt_client
+    register_collector(
+        "chatgpt_scheduler",
+        lambda: client.scheduler.stats([account.email for account in client.accounts]),
+    )
+    register_collector(
+        "chatgpt_breaker",
+        lambda: client.breaker.stats([account.email for account in client.accounts]),
+    )
+    register_collector("chatgpt_hedge", client.hedger.stats)
+    register_collector("chatgpt_migration", client.migration_stats)
+
     await _chatgpt_client._refresh_all_accounts()
 
 
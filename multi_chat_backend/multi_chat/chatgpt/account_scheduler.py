@@ -0,0 +1,340 @@
+import random
+import time
+from collections import deque
+from typing import Deque, List, Optional
+from uuid import uuid4
+
+from pydantic import BaseModel
+
+from multi_chat import config, logger
+
+from ..redis import get_database
+from .available_openai_account_set import (AvailableOpenAIAccount,
+                                           AvailableOpenAIAccountSet)
+from .circuit_breaker import CircuitBreaker
+
+# 每个账号一个令牌桶: 容量为每小时预算, 按小时匀速补充, 每次请求扣一个
+# 已有会话固定在原账号上, 不会被拒绝, 所以令牌可以为负 (最多欠一个小时的预算)
+_BUCKET_LUA = """
+local function bucket_tokens(key, now, budget)
+    local raw = redis.call('HMGET', key, 'tokens', 'ts')
+    if not raw[1] then
+        return budget
+    end
+    local tokens = tonumber(raw[1]) + (now - tonumber(raw[2])) * budget / 3600000
+    return math.min(tokens, budget)
+end
+
+local function bucket_take(key, now, budget, tokens)
+    redis.call('HSET', key, 'tokens', tostring(math.max(tokens - 1, -budget)), 'ts', now)
+    redis.call('PEXPIRE', key, 7200000)
+end
+"""
+
+# 在可用账号中原子地选出负载最低的账号并登记在途
+# 熔断冷却中的账号跳过, 冷却结束 (half_open) 且没有进行中试探的账号可以被选为试探
+# 本小时预算用完的账号跳过, 用量超过软上限的账号按超出比例加分
+# KEYS[1] 可用账号集合
+# ARGV[1] key 前缀 ARGV[2] 熔断 key 前缀 ARGV[3] 当前毫秒 ARGV[4] 租约毫秒 ARGV[5] 领取 token
+# ARGV[6] 在途权重 ARGV[7] 延迟权重 ARGV[8] 错误权重 ARGV[9] 试探租约毫秒
+# ARGV[10] 每小时预算 (0 不限制) ARGV[11] 软上限比例 ARGV[12] 软上限权重
+# ARGV[13..] email 与其在可用集合中的成员编码成对出现
+_CLAIM_SCRIPT = _BUCKET_LUA + """
+local prefix = ARGV[1]
+local breaker = ARGV[2]
+local now = tonumber(ARGV[3])
+local budget = tonumber(ARGV[10])
+local soft_ratio = tonumber(ARGV[11])
+local best_email = false
+local best_score = 0
+local best_inflight = 0
+local best_trial = false
+local best_tokens = 0
+
+for i = 13, #ARGV, 2 do
+    local email = ARGV[i]
+    local usable = false
+    local trial = false
+
+    if redis.call('HGET', breaker .. ':state:' .. email, 'state') == 'open' then
+        if redis.call('EXISTS', breaker .. ':cooldown:' .. email) == 0
+            and redis.call('EXISTS', breaker .. ':trial:' .. email) == 0 then
+            usable = true
+            trial = true
+        end
+    else
+        usable = redis.call('SISMEMBER', KEYS[1], ARGV[i + 1]) == 1
+    end
+
+    local tokens = 0
+    if usable and budget > 0 then
+        tokens = bucket_tokens(prefix .. ':bucket:' .. email, now, budget)
+        if tokens < 1 then
+            usable = false
+        end
+    end
+
+    if usable then
+        local inflight_key = prefix .. ':inflight:' .. email
+        redis.call('ZREMRANGEBYSCORE', inflight_key, '-inf', now)
+        local inflight = redis.call('ZCARD', inflight_key)
+        local latency = tonumber(redis.call('HGET', prefix .. ':latency', email) or '0')
+        local errors = tonumber(redis.call('GET', prefix .. ':errors:' .. email) or '0')
+        local score = inflight * tonumber(ARGV[6]) + latency * tonumber(ARGV[7]) + errors * tonumber(ARGV[8])
+        if budget > 0 then
+            local used_ratio = 1 - tokens / budget
+            if used_ratio > soft_ratio then
+                score = score + (used_ratio - soft_ratio) / (1 - soft_ratio) * tonumber(ARGV[12])
+            end
+        end
+        if best_email == false or score < best_score then
+            best_email = email
+            best_score = score
+            best_inflight = inflight
+            best_trial = trial
+            best_tokens = tokens
+        end
+    end
+end
+
+if best_email == false then
+    return false
+end
+
+redis.call('ZADD', prefix .. ':inflight:' .. best_email, now + tonumber(ARGV[4]), ARGV[5])
+redis.call('PEXPIRE', prefix .. ':inflight:' .. best_email, tonumber(ARGV[4]))
+if budget > 0 then
+    bucket_take(prefix .. ':bucket:' .. best_email, now, budget, best_tokens)
+end
+if best_trial then
+    redis.call('SET', breaker .. ':trial:' .. best_email, ARGV[5], 'PX', tonumber(ARGV[9]))
+end
+return {best_email, tostring(best_score), best_inflight, best_trial and 1 or 0}
+"""
+
+# 登记指定账号的在途请求 (已有会话固定在原账号上), 返回熔断状态
+# ARGV[1] key 前缀 ARGV[2] email ARGV[3] 当前毫秒 ARGV[4] 租约毫秒 ARGV[5] 领取 token
+# ARGV[6] 熔断 key 前缀 ARGV[7] 每小时预算 (0 不限制)
+_ACQUIRE_SCRIPT = _BUCKET_LUA + """
+local inflight_key = ARGV[1] .. ':inflight:' .. ARGV[2]
+redis.call('ZREMRANGEBYSCORE', inflight_key, '-inf', tonumber(ARGV[3]))
+redis.call('ZADD', inflight_key, tonumber(ARGV[3]) + tonumber(ARGV[4]), ARGV[5])
+redis.call('PEXPIRE', inflight_key, tonumber(ARGV[4]))
+
+local budget = tonumber(ARGV[7])
+if budget > 0 then
+    local bucket_key = ARGV[1] .. ':bucket:' .. ARGV[2]
+    bucket_take(bucket_key, tonumber(ARGV[3]), budget, bucket_tokens(bucket_key, tonumber(ARGV[3]), budget))
+end
+
+local state = redis.call('HGET', ARGV[6] .. ':state:' .. ARGV[2], 'state') or 'closed'
+if state == 'open' and redis.call('EXISTS', ARGV[6] .. ':cooldown:' .. ARGV[2]) == 0 then
+    state = 'half_open'
+end
+return {redis.call('ZCARD', inflight_key), state}
+"""
+
+# 释放在途请求, 更新首字延迟的指数滑动平均和近期错误数
+# 成功时清零熔断器的连续失败计数
+# ARGV[1] key 前缀 ARGV[2] email ARGV[3] 领取 token ARGV[4] 延迟秒 (空串表示没有)
+# ARGV[5] 平滑系数 ARGV[6] 是否错误 ARGV[7] 错误统计窗口秒 ARGV[8] 熔断 key 前缀
+_RELEASE_SCRIPT = """
+local prefix = ARGV[1]
+local email = ARGV[2]
+redis.call('ZREM', prefix .. ':inflight:' .. email, ARGV[3])
+
+if ARGV[4] ~= '' then
+    local alpha = tonumber(ARGV[5])
+    local latency = tonumber(ARGV[4])
+    local old = redis.call('HGET', prefix .. ':latency', email)
+    if old then
+        latency = tonumber(old) * (1 - alpha) + latency * alpha
+    end
+    redis.call('HSET', prefix .. ':latency', email, tostring(latency))
+end
+
+if ARGV[6] == '1' then
+    local errors_key = prefix .. ':errors:' .. email
+    redis.call('INCR', errors_key)
+    redis.call('EXPIRE', errors_key, tonumber(ARGV[7]))
+else
+    local state_key = ARGV[8] .. ':state:' .. email
+    if redis.call('HEXISTS', state_key, 'failures') == 1 then
+        redis.call('HSET', state_key, 'failures', 0)
+    end
+end
+return 1
+"""
+
+
+class AccountClaim(BaseModel):
+    email: str
+    token: str
+    score: float = 0.0
+    # 领取时账号的熔断状态, half_open 表示这是一次试探
+    breaker_state: str = "closed"
+
+
+class AccountDecision(BaseModel):
+    timestamp: float
+    email: Optional[str]
+    score: Optional[float]
+    inflight: Optional[int]
+    candidates: int
+    trial: bool = False
+
+
+class AccountScheduler:
+    """按在途流数, 近期首字延迟和近期错误数给账号打分, 新会话原子地领取得分最低的可用账号
+
+    熔断冷却中的账号不会被选中, 冷却结束后作为试探账号参与调度.
+    """
+
+    def __init__(self) -> None:
+        self.decisions: Deque[AccountDecision] = deque(maxlen=100)
+
+    @staticmethod
+    def _prefix() -> str:
+        return config.redis.redis_prefix + ":AccountScheduler"
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    async def claim(self, emails: List[str]) -> Optional[AccountClaim]:
+        args: List[str] = []
+        # 打乱顺序, 得分相同的账号随机选
+        for email in random.sample(emails, len(emails)):
+            args.append(email)
+            args.append(AvailableOpenAIAccountSet.format_item(AvailableOpenAIAccount(email=email)).decode("utf8"))
+
+        token = uuid4().hex
+        result = await get_database().eval(  # type: ignore
+            _CLAIM_SCRIPT,
+            1,
+            AvailableOpenAIAccountSet.get_key(),
+            self._prefix(),
+            CircuitBreaker.prefix(),
+            self._now_ms(),
+            config.chatgpt.scheduler_lease_seconds * 1000,
+            token,
+            config.chatgpt.scheduler_inflight_weight,
+            config.chatgpt.scheduler_latency_weight,
+            config.chatgpt.scheduler_error_weight,
+            config.chatgpt.breaker_trial_seconds * 1000,
+            config.chatgpt.usage_hourly_budget,
+            config.chatgpt.usage_soft_ratio,
+            config.chatgpt.usage_soft_weight,
+            *args,
+        )
+
+        if not result:
+            self.decisions.append(AccountDecision(
+                timestamp=time.time(),
+                email=None,
+                score=None,
+                inflight=None,
+                candidates=len(emails),
+            ))
+            logger.warning("scheduler: no available account")
+            return None
+
+        email = result[0].decode("utf8") if isinstance(result[0], bytes) else result[0]
+        score = float(result[1])
+        trial = int(result[3]) == 1
+
+        decision = AccountDecision(
+            timestamp=time.time(),
+            email=email,
+            score=score,
+            inflight=int(result[2]),
+            candidates=len(emails),
+            trial=trial,
+        )
+        self.decisions.append(decision)
+        logger.debug("scheduler decision: " + decision.json())
+
+        return AccountClaim(
+            email=email,
+            token=token,
+            score=score,
+            breaker_state="half_open" if trial else "closed",
+        )
+
+    async def acquire(self, email: str) -> AccountClaim:
+        token = uuid4().hex
+        result = await get_database().eval(  # type: ignore
+            _ACQUIRE_SCRIPT,
+            0,
+            self._prefix(),
+            email,
+            self._now_ms(),
+            config.chatgpt.scheduler_lease_seconds * 1000,
+            token,
+            CircuitBreaker.prefix(),
+            config.chatgpt.usage_hourly_budget,
+        )
+        breaker_state = result[1].decode("utf8") if isinstance(result[1], bytes) else result[1]
+        return AccountClaim(email=email, token=token, breaker_state=breaker_state)
+
+    async def release(
+        self,
+        claim: AccountClaim,
+        latency: Optional[float] = None,
+        error: bool = False,
+    ) -> None:
+        await get_database().eval(  # type: ignore
+            _RELEASE_SCRIPT,
+            0,
+            self._prefix(),
+            claim.email,
+            claim.token,
+            "" if latency is None else latency,
+            config.chatgpt.scheduler_latency_alpha,
+            "1" if error else "0",
+            config.chatgpt.scheduler_error_window,
+            CircuitBreaker.prefix(),
+        )
+
+    async def exhaust(self, email: str) -> None:
+        """上游返回限流时清空令牌桶, 和上游的实际用量对齐"""
+        await get_database().hset(  # type: ignore
+            self._prefix() + ":bucket:" + email,
+            mapping=dict(tokens=0, ts=self._now_ms()),
+        )
+
+    async def usage(self, email: str) -> Optional[float]:
+        """本小时已用的请求数 (按令牌桶折算), 不限制时返回 None"""
+        budget = config.chatgpt.usage_hourly_budget
+        if budget <= 0:
+            return None
+
+        raw = await get_database().hmget(self._prefix() + ":bucket:" + email, "tokens", "ts")  # type: ignore
+        if raw[0] is None:
+            return 0.0
+        tokens = float(raw[0]) + (self._now_ms() - int(raw[1])) * budget / 3600000
+        return budget - min(tokens, budget)
+
+    async def stats(self, emails: List[str]) -> dict:
+        db = get_database()
+        prefix = self._prefix()
+        now = self._now_ms()
+
+        accounts = []
+        for email in emails:
+            inflight = await db.zcount(prefix + ":inflight:" + email, now, "+inf")  # type: ignore
+            latency = await db.hget(prefix + ":latency", email)  # type: ignore
+            errors = await db.get(prefix + ":errors:" + email)  # type: ignore
+            accounts.append(dict(
+                email=email,
+                inflight=int(inflight),
+                latency=float(latency) if latency else None,
+                errors=int(errors) if errors else 0,
+                hourly_used=await self.usage(email),
+            ))
+
+        return dict(
+            hourly_budget=config.chatgpt.usage_hourly_budget,
+            accounts=accounts,
+            decisions=[decision.dict() for decision in self.decisions],
+        )
@@ -3,10 +3,11 @@ import json
 import uuid
 from typing import AsyncGenerator, Optional, Tuple
 
-# import cfscrape
-# Requests
 import httpx
 
+from ..upstream import get_client
+from ..upstream.errors import classify_response, classify_transport
+from ..upstream.sse import iter_events
 from .cf_clearance import CFClearance
 
 
@@ -17,7 +18,7 @@ async def ask(
         conversation_id: str or None,
         previous_convo_id: str or None,
         
-        proxies: str or dict or None,
+        proxies: Optional[str],
         chat_cf_clearance: CFClearance, 
 ) -> AsyncGenerator[Tuple[str, str, str], None]:
     auth_token, expiry = auth_token
@@ -55,12 +56,9 @@ async def ask(
         "model": "text-davinci-002-render"
     }
 
-    if proxies is not None:
-        if isinstance(proxies, str):
-            proxies = {'http://': proxies, 'https://': proxies} # type: ignore
-
-    async with httpx.AsyncClient(proxies=proxies, transport=httpx.AsyncHTTPTransport(retries=5)) as session: # type: ignore
+    session = get_client("chatgpt", proxies)
 
+    try:
         async with session.stream(
             'POST',
             url="https://chat.openai.com/backend-api/conversation",
@@ -70,26 +68,12 @@ async def ask(
             timeout=360,
         ) as response:
             if response.status_code == 200:
-                async for line in response.aiter_lines():
-                    line = line.rstrip()
-
-                    if len(line) == 0:
-                        continue
-
-                    if line[:6] == "data: ":
-                        line = line[6:]
+                async for as_json in iter_events(response):
+                    parts = as_json["message"]["content"]["parts"]
 
-                    if line == "[DONE]":
-                        break
-
-                    if len(line) == 0:
-                        continue
-                    
-                    as_json = json.loads(line)
-
-                    if len(as_json["message"]["content"]["parts"]) > 0:
+                    if len(parts) > 0:
                         yield (
-                            as_json["message"]["content"]["parts"][0],
+                            parts[0],
                             as_json["message"]["id"],
                             as_json["conversation_id"],
                         )
@@ -97,13 +81,30 @@ async def ask(
                 r_text = await response.aread()
                 r_text = r_text.decode('utf8')
 
-                if response.status_code == 401:
-                    raise Exception(f"[Status Code] 401 | [Response Text] {r_text}")
-                elif response.status_code >= 500:
-                    print(">> Looks like the server is either overloaded or down. Try again later.")
-                    raise Exception(f"[Status Code] {response.status_code} | [Response Text] {r_text}")
-                else:
-                    raise Exception(f"[Status Code] {response.status_code} | [Response Text] {r_text}")
+                raise classify_response(response.status_code, r_text)
+    except httpx.TransportError as e:
+        raise classify_transport(e) from e
+
 
+async def probe(
+        auth_token: str,
+        proxies: Optional[str],
+        chat_cf_clearance: CFClearance,
+) -> Tuple[int, str]:
+    """用最轻的接口 (模型列表) 同时检查 token 和 cf clearance, 不产生对话"""
+    headers = {
+        'Authorization': f'Bearer {auth_token}',
+        'Referer': 'https://chat.openai.com/chat',
+        'Origin': 'https://chat.openai.com',
+        'User-Agent': chat_cf_clearance.user_agent,
+    }
 
+    session = get_client("chatgpt", proxies)
 
+    response = await session.get(
+        url="https://chat.openai.com/backend-api/models",
+        headers=headers,
+        cookies=chat_cf_clearance.cookies,
+        timeout=30,
+    )
+    return response.status_code, response.text
@@ -1,5 +1,7 @@
 from pydantic import BaseModel
 
+from multi_chat import config
+
 from ..redis import RedisSet
 
 
@@ -7,6 +9,6 @@ class AvailableOpenAIAccount(BaseModel):
     email: str
 
 class AvailableOpenAIAccountSet(RedisSet[AvailableOpenAIAccount]):
-    pass
+    _local_ttl = config.redis.local_cache_ttl
 
 
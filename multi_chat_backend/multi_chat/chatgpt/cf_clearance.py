@@ -4,13 +4,15 @@ import random
 import traceback
 from typing import Optional
 
-import httpx
 from pydantic import BaseModel, BaseSettings, Field
-from self_limiters import MaxSleepExceededError, RedisError, Semaphore
+from redis.exceptions import RedisError
 
 from multi_chat import config, logger
 
 from ..redis import RedisCache
+from ..redis.codec import OrjsonCodec
+from ..redis.lock import LockTimeoutError, RedisSemaphore
+from ..upstream import get_client
 
 
 class CFClearance(BaseModel):
@@ -20,68 +22,73 @@ class CFClearance(BaseModel):
     cookies: dict
 
 class CFClearanceCache(RedisCache[CFClearance]):
-    pass
+    _codec = OrjsonCodec(trusted=True, compress_min_bytes=1024)
+    _local_ttl = config.redis.local_cache_ttl
     
 
     
 async def get_cf_clearance(
     url: str, 
     proxies: Optional[str] = None,
-    retry: int=5
+    retry: int=5,
+    renew_within: Optional[int]=None,
 ) -> CFClearance:
     
-    # 写缓存模式
-    cf_clearance = await CFClearanceCache.get(key=url+str(proxies))
+    # 写缓存模式, renew_within 不为空时表示续期: 缓存剩余不足该秒数就更新
+    if renew_within is None:
+        cf_clearance = await CFClearanceCache.get(key=url+str(proxies))
 
-    if cf_clearance is not None:
-        return cf_clearance
+        if cf_clearance is not None:
+            return cf_clearance
 
     # if proxies is not None:
     #     if isinstance(proxies, str):
     #         proxies = {'http': proxies, 'https': proxies} # type: ignore
 
     try:
-        # 获取锁
-        async with Semaphore(
+        # 获取锁, 阻塞等待持有者释放
+        async with RedisSemaphore(
             name="mchatgpt:get_cf_clearance_lock_" + url + str(proxies),
             capacity=1,
-            redis_url=config.redis.redis_url,
-            expiry=1800,
-            max_sleep=1.0,
-        ):
-
-            async with httpx.AsyncClient() as session: # type: ignore
-                cf_clearance_res = await session.post(
-                    url=config.chatgpt.get_cf_clearance_url,
-                    headers = {
-                        'Content-Type': 'application/json',
-                    },
-                    data=json.dumps({
-                        "proxy": {"server": "" if proxies is None else proxies} , 
-                        "timeout": 60, 
-                        "url": url
-                    }),  # type: ignore
-                    timeout=120,
-                )
-
-                cf_clearance_res = CFClearance.parse_obj(cf_clearance_res.json())
-
-                assert "cf_clearance" in cf_clearance_res.cookies
-
-                await CFClearanceCache.set(key=url+str(proxies), value=cf_clearance_res, ex=random.randint(3600, 5400))
-
-                logger.info(url + " cf clearance")
-                return cf_clearance_res
-
-
-    # 锁拿不到
-    except MaxSleepExceededError  as e:
-        logger.info(url + " get update lock retry")
-        if retry > 0:
-            await asyncio.sleep(1)
-            return await get_cf_clearance(url=url, retry=retry-1, proxies=proxies)
-        else:
-            raise Exception(url + " get update lock retry max")
+        ) as lock:
+            # 等锁期间其他 worker 可能已经更新过
+            cf_clearance = await CFClearanceCache.get(key=url+str(proxies), local=False)
+            if cf_clearance is not None and (
+                renew_within is None
+                or await CFClearanceCache.ttl(key=url+str(proxies)) >= renew_within
+            ):
+                return cf_clearance
+
+            session = get_client("cf_clearance")
+
+            cf_clearance_res = await session.post(
+                url=config.chatgpt.get_cf_clearance_url,
+                headers = {
+                    'Content-Type': 'application/json',
+                },
+                data=json.dumps({
+                    "proxy": {"server": "" if proxies is None else proxies} , 
+                    "timeout": 60, 
+                    "url": url
+                }),  # type: ignore
+                timeout=120,
+            )
+
+            cf_clearance_res = CFClearance.parse_obj(cf_clearance_res.json())
+
+            assert "cf_clearance" in cf_clearance_res.cookies
+
+            lock.ensure_held()
+            await CFClearanceCache.set(key=url+str(proxies), value=cf_clearance_res, ex=random.randint(3600, 5400), fence=lock.fence)
+
+            logger.info(url + " cf clearance")
+            return cf_clearance_res
+
+
+    # 等锁超时, 持有者一直没有更新完
+    except LockTimeoutError as e:
+        logger.info(url + " get update lock timeout")
+        raise e
 
     # redis炸
     except RedisError as e:
@@ -96,7 +103,7 @@ async def get_cf_clearance(
             logger.info(url + " cf clearance update retry")
             logger.warning(traceback.format_exc())
             await asyncio.sleep(1)
-            return await get_cf_clearance(url=url, retry=retry-1, proxies=proxies)
+            return await get_cf_clearance(url=url, retry=retry-1, proxies=proxies, renew_within=renew_within)
 
 
 
@@ -2,9 +2,11 @@ import time
 from typing import Optional
 from uuid import UUID, uuid1
 
-from .chatgpt_dialog_state_cache import ChatGPTDialogStateCache
+from ..session.state import SessionState, register_field
 from .models import ChatGPTDialogHistory
 
+register_field("chatgpt", ChatGPTDialogHistory)
+
 
 async def get_one_dialog_info(
     session_id: UUID,
@@ -24,9 +26,15 @@ async def get_one_dialog_info(
 async def get_now_dialog_info(
     session_id: UUID,
     dhid: Optional[UUID] = None,
+    state: Optional[SessionState] = None,
 ) -> Optional[ChatGPTDialogHistory]:
+    """state 为空时单独读取会话状态, 否则使用本轮共享的状态, 由调用方统一写回"""
+
+    own_state = state is None
+    if state is None:
+        state = await SessionState.load(session_id)
 
-    now_state = await ChatGPTDialogStateCache.get(key=str(session_id))
+    now_state = state.get("chatgpt")
 
     if dhid is None:
         # dhid is None 默认找最近的一次
@@ -41,7 +49,9 @@ async def get_now_dialog_info(
             now_state = await get_one_dialog_info(session_id=session_id, dhid=dhid)
             
             if now_state is not None:
-                await ChatGPTDialogStateCache.set(key=str(session_id), value=now_state, ex=600)
+                state.update(chatgpt=now_state)
+                if own_state:
+                    await state.commit()
 
             return now_state
 
@@ -52,6 +62,8 @@ async def save_new_dialog_info_and_update_now(
     openai_account_email: Optional[str] = None,
     openai_conversation_id: Optional[str] = None,
     openai_previous_convo_id: Optional[str] = None,
+    migrated_from: Optional[str] = None,
+    state: Optional[SessionState] = None,
 ) -> ChatGPTDialogHistory:
     """存储新一轮的患者或系统的对话信息 接口文档5.2
 
@@ -64,17 +76,23 @@ async def save_new_dialog_info_and_update_now(
     if dhid is None:
         dhid = uuid1()
         
-    new_dialog_info = await ChatGPTDialogHistory.new(
+    new_dialog_info = await ChatGPTDialogHistory.new_behind(
         session_id=session_id,
         dhid=dhid,
 
         openai_account_email=openai_account_email,
         openai_conversation_id=openai_conversation_id,
         openai_previous_convo_id=openai_previous_convo_id,
+        migrated_from=migrated_from,
     )
 
-    # 允许存活时间10分钟
-    await ChatGPTDialogStateCache.set(key=str(session_id), value=new_dialog_info, ex=600)
+    # state 为空时直接写回这一个字段; 否则由本轮最后保存的一层统一写回
+    if state is None:
+        state = SessionState(session_id)
+        state.update(chatgpt=new_dialog_info)
+        await state.commit()
+    else:
+        state.update(chatgpt=new_dialog_info)
 
     return new_dialog_info
 
@@ -0,0 +1,142 @@
+import time
+from typing import List, Optional, Sequence
+
+from pydantic import BaseModel
+
+from multi_chat import config, logger
+
+from ..redis import get_database
+
+# 熔断状态存在 redis 中, 多个 worker 共享:
+#   {prefix}:state:<email>     hash, state 为 closed/open, 以及 failures, reason, opened_at
+#   {prefix}:cooldown:<email>  冷却标记, 带过期时间, 过期后 open 自动变为 half_open
+#   {prefix}:trial:<email>     half_open 时的试探请求标记, 同一时间只放行一个
+
+# 记录一次失败
+# ARGV[1] key 前缀 ARGV[2] email ARGV[3] 原因 ARGV[4] 冷却毫秒 ARGV[5] 是否直接熔断
+# ARGV[6] 连续失败阈值 ARGV[7] 当前秒
+_FAILURE_SCRIPT = """
+local prefix = ARGV[1]
+local email = ARGV[2]
+local state_key = prefix .. ':state:' .. email
+local cooldown_key = prefix .. ':cooldown:' .. email
+local trial_key = prefix .. ':trial:' .. email
+
+local failures = redis.call('HINCRBY', state_key, 'failures', 1)
+local state = redis.call('HGET', state_key, 'state') or 'closed'
+local half_open = state == 'open' and redis.call('EXISTS', cooldown_key) == 0
+
+if ARGV[5] == '1' or half_open or failures >= tonumber(ARGV[6]) then
+    redis.call('HSET', state_key, 'state', 'open', 'reason', ARGV[3], 'opened_at', ARGV[7])
+    redis.call('SET', cooldown_key, ARGV[3], 'PX', tonumber(ARGV[4]))
+    redis.call('DEL', trial_key)
+    return 'open'
+end
+
+redis.call('HSET', state_key, 'reason', ARGV[3])
+return state
+"""
+
+# 记录一次成功, 恢复为 closed
+# ARGV[1] key 前缀 ARGV[2] email ARGV[3..] 只恢复这些原因打开的熔断 (为空时不限)
+_SUCCESS_SCRIPT = """
+local prefix = ARGV[1]
+local email = ARGV[2]
+local state_key = prefix .. ':state:' .. email
+if #ARGV > 2 then
+    local raw = redis.call('HMGET', state_key, 'state', 'reason')
+    local matched = false
+    for i = 3, #ARGV do
+        if raw[2] == ARGV[i] then
+            matched = true
+        end
+    end
+    if raw[1] ~= 'open' or not matched then
+        return raw[1] or 'closed'
+    end
+end
+redis.call('HSET', state_key, 'state', 'closed', 'failures', 0)
+redis.call('DEL', prefix .. ':cooldown:' .. email, prefix .. ':trial:' .. email)
+return 'closed'
+"""
+
+
+class BreakerState(BaseModel):
+    email: str
+    state: str
+    failures: int = 0
+    reason: Optional[str] = None
+    opened_at: Optional[int] = None
+    cooldown_remaining: Optional[float] = None
+
+
+class CircuitBreaker:
+    """每个账号一个熔断器: closed 正常, open 冷却中不分配新会话, 冷却结束后 half_open 放行一个试探请求"""
+
+    @staticmethod
+    def prefix() -> str:
+        return config.redis.redis_prefix + ":CircuitBreaker"
+
+    async def record_failure(
+        self,
+        email: str,
+        reason: str,
+        cooldown: float,
+        hard: bool = False,
+    ) -> str:
+        state = await get_database().eval(  # type: ignore
+            _FAILURE_SCRIPT,
+            0,
+            self.prefix(),
+            email,
+            reason,
+            int(cooldown * 1000),
+            "1" if hard else "0",
+            config.chatgpt.breaker_failure_threshold,
+            int(time.time()),
+        )
+        state = state.decode("utf8") if isinstance(state, bytes) else state
+        if state == "open":
+            logger.warning(f"{email} circuit open: {reason}, cooldown {cooldown}s")
+        return state
+
+    async def record_success(self, email: str, reasons: Optional[Sequence[str]] = None) -> None:
+        """reasons 不为空时只恢复因这些原因打开的熔断"""
+        await get_database().eval(  # type: ignore
+            _SUCCESS_SCRIPT,
+            0,
+            self.prefix(),
+            email,
+            *(reasons or []),
+        )
+
+    async def state(self, email: str) -> BreakerState:
+        db = get_database()
+        prefix = self.prefix()
+
+        raw = await db.hgetall(prefix + ":state:" + email)  # type: ignore
+        raw = {
+            (k.decode("utf8") if isinstance(k, bytes) else k): (v.decode("utf8") if isinstance(v, bytes) else v)
+            for k, v in raw.items()
+        }
+        state = raw.get("state", "closed")
+
+        cooldown_remaining = None
+        if state == "open":
+            pttl = await db.pttl(prefix + ":cooldown:" + email)  # type: ignore
+            if pttl is not None and pttl > 0:
+                cooldown_remaining = pttl / 1000
+            else:
+                state = "half_open"
+
+        return BreakerState(
+            email=email,
+            state=state,
+            failures=int(raw.get("failures", 0)),
+            reason=raw.get("reason"),
+            opened_at=int(raw["opened_at"]) if "opened_at" in raw else None,
+            cooldown_remaining=cooldown_remaining,
+        )
+
+    async def stats(self, emails: List[str]) -> List[dict]:
+        return [(await self.state(email)).dict() for email in emails]
@@ -0,0 +1,128 @@
+import asyncio
+from collections import deque
+from typing import AsyncGenerator, Callable, Deque, Optional, Set, Tuple, TypeVar
+
+from multi_chat import config, logger
+
+T = TypeVar("T", bound=Tuple)
+
+
+async def _close(tasks: Set[asyncio.Future], streams: Set[AsyncGenerator]) -> None:
+    # 取消还在等首字的请求, 生成器的 finally 会释放账号
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except BaseException:
+            pass
+    for stream in streams:
+        await stream.aclose()
+
+
+class Hedger:
+    """新会话的首字对冲: 主请求超时没有首字时在另一个账号上发起对冲请求, 先出首字的胜出, 另一个取消
+
+    对冲请求占全部可对冲请求的比例不超过 hedge_max_ratio, 避免额度消耗翻倍.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: Deque[float] = deque(maxlen=config.chatgpt.hedge_latency_samples)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+
+    def observe(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def delay(self) -> float:
+        if config.chatgpt.hedge_delay_ms is not None:
+            return config.chatgpt.hedge_delay_ms / 1000
+
+        min_delay = config.chatgpt.hedge_min_delay_ms / 1000
+        if len(self.latencies) == 0:
+            return min_delay
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        return max(p95, min_delay)
+
+    def _allow_hedge(self) -> bool:
+        return self.hedged + 1 <= self.requests * config.chatgpt.hedge_max_ratio
+
+    async def race(self, start: Callable[[], AsyncGenerator[T, None]]) -> AsyncGenerator[T, None]:
+        """start 每次调用发起一个新请求 (由调度器分配账号)"""
+        self.requests += 1
+
+        primary = start()
+        streams = {primary}
+        tasks = {asyncio.ensure_future(primary.__anext__()): primary}
+        winner: Optional[AsyncGenerator[T, None]] = None
+        first: Optional[T] = None
+
+        try:
+            delay = self.delay()
+            done, _ = await asyncio.wait(set(tasks), timeout=delay)
+
+            if len(done) == 0 and self._allow_hedge():
+                # 主请求在调度器中已登记在途, 对冲请求会优先分到其他账号
+                self.hedged += 1
+                hedge = start()
+                streams.add(hedge)
+                tasks[asyncio.ensure_future(hedge.__anext__())] = hedge
+                logger.info(f"hedge started after {delay:.2f}s")
+
+            error: Optional[BaseException] = None
+            while len(tasks) > 0:
+                done, _ = await asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stream = tasks.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        # 没有任何输出, 作为空回答胜出
+                        winner = stream
+                        break
+                    except Exception as e:
+                        # 一个失败了就等另一个
+                        error = e
+                        continue
+                    winner = stream
+                    break
+                if winner is not None:
+                    break
+
+            if winner is None:
+                assert error is not None
+                raise error
+
+            if len(streams) > 1:
+                if winner is primary:
+                    self.primary_wins += 1
+                else:
+                    self.hedge_wins += 1
+
+            # 取消输掉的请求
+            losers = {stream for stream in streams if stream is not winner}
+            await _close(set(tasks), losers)
+            tasks.clear()
+            streams = {winner}
+
+            if first is None:
+                return
+            yield first
+            async for item in winner:
+                yield item
+
+        finally:
+            await _close(set(tasks), streams)
+
+    def stats(self) -> dict:
+        return dict(
+            enabled=config.chatgpt.hedge_enabled,
+            delay=self.delay(),
+            requests=self.requests,
+            hedged=self.hedged,
+            hedge_wins=self.hedge_wins,
+            primary_wins=self.primary_wins,
+        )
@@ -0,0 +1,87 @@
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from pymongo import DESCENDING
+
+from multi_chat import config
+
+from ..dialog.models import DialogHistory
+
+
+async def load_history(
+    session_id: UUID,
+    dhid: Optional[UUID],
+    max_rounds: Optional[int] = None,
+) -> List[DialogHistory]:
+    """沿 previous_dhid 取到 dhid 为止的对话记录, 按轮次从前到后"""
+    if dhid is None:
+        return []
+
+    # 一次取出最近的轮次, 在内存里沿链回溯; 同一会话可能有重新生成的分支, 多取一些
+    items = await DialogHistory.list(
+        sort=[("round_id", DESCENDING)],
+        length=1000 if max_rounds is None else max_rounds * 2,
+        session_id=session_id,
+    )
+    by_dhid: Dict[UUID, DialogHistory] = {item.dhid: item for item in items}
+
+    history: List[DialogHistory] = []
+    now: Optional[UUID] = dhid
+    while now is not None:
+        if max_rounds is not None and len(history) >= max_rounds:
+            break
+        item = by_dhid.get(now)
+        if item is None:
+            # 超出一次取出的范围 (分支很多或会话很长) 时逐条补取
+            item = await DialogHistory.get(session_id=session_id, dhid=now)
+            if item is None:
+                break
+        history.append(item)
+        now = item.previous_dhid
+
+    history.reverse()
+    return history
+
+
+def format_history(history: List[DialogHistory], max_chars: Optional[int] = None) -> str:
+    rounds = [
+        "User: " + item.ask_text + "\nAssistant: " + item.answer_text
+        for item in history
+    ]
+    transcript = "\n\n".join(rounds)
+
+    # 超长时保留最近的内容
+    if max_chars is not None and len(transcript) > max_chars:
+        transcript = "..." + transcript[-max_chars:]
+    return transcript
+
+
+async def build_migration_prompt(
+    session_id: UUID,
+    dhid: Optional[UUID],
+    prompt: str,
+    strategy: Optional[str] = None,
+) -> str:
+    """把之前的对话拼进新会话的第一条消息"""
+    if strategy is None:
+        strategy = config.chatgpt.migration_strategy
+
+    if strategy == "fresh":
+        return prompt
+
+    if strategy == "compact":
+        history = await load_history(session_id, dhid, max_rounds=config.chatgpt.migration_compact_rounds)
+        transcript = format_history(history, max_chars=config.chatgpt.migration_max_chars)
+    else:
+        history = await load_history(session_id, dhid)
+        transcript = format_history(history)
+
+    if len(transcript) == 0:
+        return prompt
+
+    return (
+        "The following is our conversation so far:\n\n"
+        + transcript
+        + "\n\nContinue the conversation and reply to my next message.\n\nUser: "
+        + prompt
+    )
@@ -1,6 +1,9 @@
-from typing import Optional, Union
+from typing import List, Literal, Optional, Union
 from uuid import UUID
 
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
 from ..mongo import MongoModel
 
 
@@ -12,10 +15,36 @@ class ChatGPTDialogHistory(MongoModel):
     openai_account_email: Optional[str] = None
     openai_conversation_id: Optional[str] = None
     openai_previous_convo_id: Optional[str] = None
+    # 从不可用账号迁移过来时记录原账号
+    migrated_from: Optional[str] = None
 
     @classmethod
     def collection_name(cls) -> str:
         return "chatgpt_dialog_history"
 
-
-
+    @classmethod
+    def indexes(cls) -> List[IndexModel]:
+        return [
+            IndexModel([("session_id", ASCENDING), ("dhid", ASCENDING)]),
+        ]
+
+
+class AccountRefreshResult(BaseModel):
+    email: str
+    outcome: Literal["success", "fail", "timeout"]
+    # 验证方式: 轻量探测或完整对话
+    method: Optional[Literal["probe", "conversation"]] = None
+    duration: float
+    error_class: Optional[str] = None
+    error: Optional[str] = None
+
+
+class RefreshReport(BaseModel):
+    started_at: int
+    duration: float
+    total: int
+    success: int
+    fail: int
+    timeout: int
+    available: int
+    accounts: List[AccountRefreshResult]
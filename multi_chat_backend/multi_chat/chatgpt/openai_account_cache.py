@@ -2,7 +2,10 @@ from typing import Optional
 
 from pydantic import BaseModel
 
+from multi_chat import config
+
 from ..redis import RedisCache
+from ..redis.codec import OrjsonCodec
 
 
 class OpenAIAccount(BaseModel):
@@ -16,7 +19,8 @@ class OpenAIAccount(BaseModel):
 
 
 class OpenAIAccountCache(RedisCache[OpenAIAccount]):
-    pass
+    _codec = OrjsonCodec(trusted=True)
+    _local_ttl = config.redis.local_cache_ttl
 
 
 
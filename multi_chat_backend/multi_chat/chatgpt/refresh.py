@@ -1,7 +1,9 @@
 import traceback
+from typing import Optional
 
 from fastapi import APIRouter
 from multi_chat.chatgpt import get_chatgpt_client
+from multi_chat.chatgpt.models import RefreshReport
 from multi_chat.models import ResponseCode, ResponseWrapper
 from pydantic import BaseModel
 
@@ -15,6 +17,7 @@ class RequestModel(BaseModel):
 
 class ResponseModel(BaseModel):
     reply: str
+    report: Optional[RefreshReport] = None
 
 
 @router.post("/chatgpt", response_model=ResponseWrapper[ResponseModel])
@@ -31,12 +34,13 @@ async def chatgpt(
                 )
             )
 
-        await get_chatgpt_client()._refresh_all_accounts()
+        report = await get_chatgpt_client()._refresh_all_accounts()
 
         return ResponseWrapper(
             code=ResponseCode.success,
             result=ResponseModel(
-                reply="success"
+                reply="success",
+                report=report,
             )
         )
 
@@ -25,17 +25,122 @@ class FastAPIConfig(BaseModel):
 class MongoConfig(BaseModel):
     mongo_url: str = "mongodb://localhost:27017"
     mongo_database: str = "multi_chat"
+    # 启动时在后台创建模型声明的索引; 关闭时只核对并报告缺少的索引
+    create_indexes: bool = True
+    # 对话记录异步批量写入: 每批条数, 最长间隔秒数, 队列上限 (满了等待的最长秒数, 超时直接写)
+    write_behind: bool = True
+    write_behind_batch_size: int = 100
+    write_behind_interval: float = 0.5
+    write_behind_max_pending: int = 10000
+    write_behind_max_wait: float = 5.0
+    # 入队时同时写入 redis stream, 崩溃后由其他 worker 在 recover_after 秒后补写;
+    # 其他 worker 按字段查找还没写入的文档也靠这个 stream, 关闭后只有入队的 worker 能读到
+    write_behind_spill: bool = True
+    write_behind_recover_after: float = 60.0
 
 class RedisConfig(BaseModel):
     redis_url: str = "redis://localhost:6379/0"
     redis_prefix: str = "multi_chat"
+    # 连接池: 最大连接数, 连接用满时最长等待秒数
+    max_connections: int = 100
+    pool_timeout: float = 5.0
+    # 单条命令的读写超时和建连超时秒数; 阻塞命令 (锁等待) 的单次阻塞会限制在读超时以内
+    socket_timeout: Optional[float] = 5.0
+    socket_connect_timeout: Optional[float] = 3.0
+    # 超时和断连后按指数退避重试的次数, 0 表示不重试
+    retry_on_timeout: bool = True
+    retries: int = 3
+    retry_base_delay: float = 0.05
+    retry_max_delay: float = 1.0
+    # 空闲超过该秒数的连接在使用前先 PING 检查, 0 表示不检查
+    health_check_interval: int = 30
+    # 账号 token, 可用账号和 cf clearance 的进程内缓存秒数, 0 表示不缓存
+    local_cache_ttl: float = 10.0
+    # 会话状态 (每轮都读) 的进程内缓存秒数, 0 表示不缓存; 写入的 worker 直接保留新值
+    dialog_state_local_ttl: float = 30.0
+    # 每个进程内缓存最多保留的 key 数, 超出按最近最少使用淘汰
+    local_cache_max_size: int = 10000
+    # 兼容模式: 只写旧的 json 格式, 用于和不认识新格式的旧 worker 混跑, 新格式照常可读
+    codec_compat: bool = False
+    # 分布式锁: 租约秒数 (持有期间按 1/3 间隔续租) 和默认最长等待秒数
+    lock_lease_seconds: float = 30.0
+    lock_wait_seconds: float = 60.0
+
+
+class UpstreamConfig(BaseModel):
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    retries: int = 5
+    # 上游请求失败后的重试: 次数预算, 指数退避的基础和最大等待秒数 (带随机抖动)
+    retry_budget: int = 5
+    retry_base_delay: float = 0.3
+    retry_max_delay: float = 5.0
+
+
+class StreamingConfig(BaseModel):
+    # 流式返回合并: 最多每 N 毫秒或每新增 M 字节发送一帧, 0 表示不合并
+    coalesce_interval_ms: int = 50
+    coalesce_max_bytes: int = 1024
+
+
+class AdmissionConfig(BaseModel):
+    # 账号都在忙时请求排队: 每个 worker 的并发上限, 队列长度上限, 最长等待秒数
+    # chatgpt_concurrency 为空时取账号数, 多 worker 部署时应按 worker 数分摊
+    enabled: bool = True
+    chatgpt_concurrency: Optional[int] = None
+    gpt3_concurrency: int = 16
+    max_queue_depth: int = 200
+    max_wait_seconds: float = 60.0
+    # 排队时推送位置的最短间隔
+    position_interval_seconds: float = 1.0
 
 
 class ChatGPTConfig(BaseModel):
     account_path: str = "./accounts/chatgpt.json"
     refresh_passwd: str = "Tiankong1234"
     refresh_seconds: int = 3600
+    refresh_concurrency: int = 8
+    refresh_timeout: float = 120.0
+    # 刷新时先用轻量接口探测账号, 无法判断时才发送完整对话
+    refresh_probe: bool = True
+    # token 和 cf clearance 在过期前 margin + [0, jitter) 秒内主动续期
+    renew_check_seconds: int = 60
+    renew_margin_seconds: int = 300
+    renew_jitter_seconds: int = 600
     get_cf_clearance_url : str = "http://127.0.0.1:8000/challenge"
+    # 账号调度打分: 在途流数 * 权重 + 首字延迟(秒) * 权重 + 近期错误数 * 权重
+    scheduler_inflight_weight: float = 100.0
+    scheduler_latency_weight: float = 1.0
+    scheduler_error_weight: float = 20.0
+    scheduler_latency_alpha: float = 0.2
+    scheduler_error_window: int = 300
+    scheduler_lease_seconds: int = 1800
+    # 账号每小时请求预算 (令牌桶, 按小时匀速补充), 0 表示不限制
+    # 已用超过 soft_ratio 后逐步降低优先级, 用完后不再分配新会话
+    usage_hourly_budget: int = 60
+    usage_soft_ratio: float = 0.8
+    usage_soft_weight: float = 1000.0
+    # 账号熔断: 连续失败次数阈值, 各类失败的冷却时间, half_open 试探租约
+    breaker_failure_threshold: int = 3
+    breaker_cooldown_seconds: float = 30.0
+    breaker_token_cooldown_seconds: float = 60.0
+    breaker_login_cooldown_seconds: float = 300.0
+    breaker_rate_limit_cooldown_seconds: float = 3600.0
+    breaker_trial_seconds: int = 120
+    # 新会话首字对冲: 超过 hedge_delay_ms 仍没有首字时在另一个账号上再发一次, 先出首字的胜出
+    # hedge_delay_ms 为空时取近期首字延迟的 p95, hedge_max_ratio 限制对冲请求占比
+    hedge_enabled: bool = False
+    hedge_delay_ms: Optional[int] = None
+    hedge_min_delay_ms: int = 1000
+    hedge_max_ratio: float = 0.1
+    hedge_latency_samples: int = 200
+    # 固定账号不可用时把会话迁移到其他账号, 用历史记录重建上下文
+    # replay 回放全部历史 (质量高, prompt 长), compact 只回放最近几轮并限制长度, fresh 不带历史 (最快)
+    migration_enabled: bool = True
+    migration_strategy: Literal["replay", "compact", "fresh"] = "compact"
+    migration_compact_rounds: int = 6
+    migration_max_chars: int = 8000
 
 
 class GPT3Config(BaseModel):
@@ -60,6 +165,9 @@ class Config(BaseSettings):
     fastapi: FastAPIConfig = Field(default_factory=FastAPIConfig)
     mongo: MongoConfig = Field(default_factory=MongoConfig)
     redis: RedisConfig = Field(default_factory=RedisConfig)
+    upstream: UpstreamConfig = Field(default_factory=UpstreamConfig)
+    streaming: StreamingConfig = Field(default_factory=StreamingConfig)
+    admission: AdmissionConfig = Field(default_factory=AdmissionConfig)
     chatgpt: ChatGPTConfig = Field(default_factory=ChatGPTConfig)
     gpt3: GPT3Config = Field(default_factory=GPT3Config)
     logger: List[LoggerConfig] = [LoggerConfig()]
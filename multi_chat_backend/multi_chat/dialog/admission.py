@@ -0,0 +1,203 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Callable, Deque, Dict, Optional, TypeVar
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+
+T = TypeVar("T")
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class QueueFullError(AdmissionError):
+    pass
+
+
+class QueueTimeoutError(AdmissionError):
+    pass
+
+
+class Ticket:
+    """一次排队, 轮到后持有一个并发名额, 用完必须 release"""
+
+    def __init__(self, queue: "AdmissionQueue", session: str) -> None:
+        self.queue = queue
+        self.session = session
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_event_loop().create_future()
+        self.released = False
+
+    @property
+    def admitted(self) -> bool:
+        return self.future.done()
+
+    @property
+    def position(self) -> int:
+        """排在第几位, 已轮到时为 0"""
+        if self.admitted:
+            return 0
+        return self.queue._position(self)
+
+    async def positions(self) -> AsyncGenerator[int, None]:
+        """等待轮到, 期间位置变化时返回新位置, 超过最长等待时间抛 QueueTimeoutError"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + config.admission.max_wait_seconds
+        last_position = None
+
+        try:
+            while not self.admitted:
+                position = self.position
+                if position != last_position:
+                    last_position = position
+                    yield position
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.queue.timeouts += 1
+                    raise QueueTimeoutError(
+                        f"{self.queue.name} queue wait exceeded {config.admission.max_wait_seconds}s"
+                    )
+                await asyncio.wait(
+                    {self.future},
+                    timeout=min(remaining, config.admission.position_interval_seconds),
+                )
+        except BaseException:
+            # 放弃排队
+            self.release()
+            raise
+
+    async def wait(self) -> None:
+        async for _ in self.positions():
+            pass
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.queue._release(self)
+
+
+class AdmissionQueue:
+    """并发名额加有界等待队列, 不同会话之间轮转出队, 单个会话的突发请求不会占满名额"""
+
+    def __init__(self, name: str, capacity: int) -> None:
+        self.name = name
+        self.capacity = max(capacity, 1)
+        self.active = 0
+        # 会话 -> 该会话的等待队列, 顺序即轮转顺序
+        self.waiting: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.depth = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.waits: Deque[float] = deque(maxlen=1000)
+
+    def enqueue(self, session: str) -> Ticket:
+        ticket = Ticket(self, session)
+
+        if self.active < self.capacity and self.depth == 0:
+            self._admit(ticket)
+            return ticket
+
+        if self.depth >= config.admission.max_queue_depth:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} queue is full ({self.depth})")
+
+        if session not in self.waiting:
+            self.waiting[session] = deque()
+        self.waiting[session].append(ticket)
+        self.depth += 1
+        logger.info(f"{self.name} queued: session {session}, depth {self.depth}")
+        return ticket
+
+    def _admit(self, ticket: Ticket) -> None:
+        self.active += 1
+        self.admitted += 1
+        self.waits.append(time.monotonic() - ticket.enqueued_at)
+        ticket.future.set_result(None)
+
+    def _grant(self) -> None:
+        while self.active < self.capacity and len(self.waiting) > 0:
+            session, tickets = self.waiting.popitem(last=False)
+            ticket = tickets.popleft()
+            self.depth -= 1
+            # 还有等待的请求则排到轮转末尾
+            if len(tickets) > 0:
+                self.waiting[session] = tickets
+            self._admit(ticket)
+
+    def _release(self, ticket: Ticket) -> None:
+        if ticket.admitted:
+            self.active -= 1
+        else:
+            tickets = self.waiting.get(ticket.session)
+            if tickets is not None and ticket in tickets:
+                tickets.remove(ticket)
+                self.depth -= 1
+                if len(tickets) == 0:
+                    del self.waiting[ticket.session]
+        self._grant()
+
+    def _position(self, ticket: Ticket) -> int:
+        # 轮转出队: 前面每轮每个会话出一个
+        # 排在前面的 = 各会话前 k 轮的数量 + 第 k 轮中排在本会话之前的会话数
+        tickets = self.waiting[ticket.session]
+        k = tickets.index(ticket)
+        ahead = 0
+        before = True
+        for session, others in self.waiting.items():
+            if session == ticket.session:
+                before = False
+            ahead += min(len(others), k)
+            if before and len(others) > k:
+                ahead += 1
+        return ahead + 1
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return dict(
+            capacity=self.capacity,
+            active=self.active,
+            depth=self.depth,
+            sessions=len(self.waiting),
+            admitted=self.admitted,
+            rejected=self.rejected,
+            timeouts=self.timeouts,
+            wait_avg=sum(waits) / len(waits) if len(waits) > 0 else None,
+            wait_p95=waits[min(int(len(waits) * 0.95), len(waits) - 1)] if len(waits) > 0 else None,
+            wait_max=waits[-1] if len(waits) > 0 else None,
+        )
+
+
+async def with_ticket(ticket: Ticket, r_iter: AsyncGenerator[T, None]) -> AsyncGenerator[T, None]:
+    """生成结束或被关闭时释放名额"""
+    try:
+        async for item in r_iter:
+            yield item
+    finally:
+        await r_iter.aclose()
+        ticket.release()
+
+
+_queues: Dict[str, AdmissionQueue] = {}
+
+
+def get_admission_queue(name: str, capacity: Callable[[], int]) -> Optional[AdmissionQueue]:
+    """按后端获取排队器, 第一次使用时创建, 未开启排队时返回 None"""
+    if not config.admission.enabled:
+        return None
+
+    queue = _queues.get(name)
+    if queue is None:
+        queue = AdmissionQueue(name, capacity())
+        _queues[name] = queue
+    return queue
+
+
+register_collector("admission", lambda: {name: queue.stats() for name, queue in _queues.items()})
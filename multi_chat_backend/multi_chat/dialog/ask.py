@@ -3,17 +3,23 @@ import traceback
 from typing import Optional, Union
 from uuid import UUID, uuid1
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header
 from fastapi.responses import StreamingResponse
 from multi_chat.models import ResponseCode, ResponseWrapper
 from multi_chat.session import get_session_id
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
 from multi_chat import logger
 
-from .chat_client import get_chat_client
+from ..metrics import finish_turn, start_turn
+from ..session.state import SessionState
+from ..upstream.errors import AccountUnavailableError
+from .admission import AdmissionError, QueueTimeoutError, with_ticket
+from .chat_client import get_chat_admission_queue, get_chat_client
 from .dialog_info import (get_now_dialog_info,
                           save_new_dialog_info_and_update_now)
+from .streaming import DELTA_HEADER, DeltaEncoder, coalesce, use_delta
 
 router = APIRouter()
 
@@ -22,6 +28,8 @@ class RequestModel(BaseModel):
     model: str = ""
     text: str
     previous_dhid: Optional[UUID] = None
+    # 增量流式: 每帧只返回新追加的文本
+    delta: bool = False
     
 
 class ResponseModel(BaseModel):
@@ -43,10 +51,15 @@ async def ask(
 
         assert len(sentence_text) > 0, "need len(sentence_text) > 0"
 
+        # 本轮共享的会话状态, 一次读出, 保存时一次写回
+        start_turn()
+        state = await SessionState.load(session_id)
+
         # 获取所有历史信息
         last_dialog_info = await get_now_dialog_info(
             session_id=session_id,
-            dhid=previous_dhid
+            dhid=previous_dhid,
+            state=state,
         )
 
         if last_dialog_info is not None:
@@ -55,17 +68,30 @@ async def ask(
 
         chat_client = get_chat_client(data.model)
 
+        # 账号都在忙时排队
+        admission_queue = get_chat_admission_queue(data.model)
+        ticket = admission_queue.enqueue(str(session_id)) if admission_queue is not None else None
+        if ticket is not None:
+            await ticket.wait()
+
         answer = ""
         now_dhid = None
 
-        async for chatgpt_result in chat_client.ask(
+        r_iter = chat_client.ask(
             prompt=sentence_text,
             session_id=session_id,
             previous_dhid=previous_dhid,
-        ):
+            state=state,
+        )
+        if ticket is not None:
+            r_iter = with_ticket(ticket, r_iter)
+
+        async for chatgpt_result in r_iter:
             answer = chatgpt_result[0]
             now_dhid = chatgpt_result[2]
 
+        # 只在最终保存和返回时拼接全文
+        answer = str(answer)
 
         # 保存最后一轮
         await save_new_dialog_info_and_update_now(
@@ -77,7 +103,9 @@ async def ask(
 
             dhid=now_dhid,
             previous_dhid=previous_dhid,
+            state=state,
         )
+        finish_turn("dialog_ask")
         return ResponseWrapper(
             code=ResponseCode.success,
             result=ResponseModel.parse_obj(dict(
@@ -85,6 +113,15 @@ async def ask(
                 now_dhid=now_dhid,
             )),
         )
+    except (AdmissionError, AccountUnavailableError) as e:
+        logger.warning("Busy: " + str(e))
+        return ResponseWrapper(
+            code=ResponseCode.busy,
+            result=ResponseModel.parse_obj(dict(
+                reply=str(e),
+                now_dhid=None,
+            )),
+        )
     except:
         error_text = traceback.format_exc()
         logger.warning("Error:\n" + error_text)
@@ -100,9 +137,13 @@ async def ask(
 
 @router.post("/ask_streaming")
 async def ask_streaming(
-    data: RequestModel, session_id: UUID = Depends(get_session_id)
+    data: RequestModel,
+    session_id: UUID = Depends(get_session_id),
+    x_stream_delta: Optional[str] = Header(None, alias=DELTA_HEADER),
 ) -> Union[StreamingResponse, ResponseWrapper[ResponseModel]]:
     try:
+        delta_encoder = DeltaEncoder() if use_delta(data.delta, x_stream_delta) else None
+
         #当前句子
         sentence_text = data.text
         previous_dhid = data.previous_dhid
@@ -111,10 +152,15 @@ async def ask_streaming(
 
         assert len(sentence_text) > 0, "need len(sentence_text) > 0"
 
+        # 本轮共享的会话状态, 一次读出, 保存时一次写回
+        start_turn()
+        state = await SessionState.load(session_id)
+
         # 获取所有历史信息
         last_dialog_info = await get_now_dialog_info(
             session_id=session_id,
-            dhid=previous_dhid
+            dhid=previous_dhid,
+            state=state,
         )
 
         if last_dialog_info is not None:
@@ -125,25 +171,84 @@ async def ask_streaming(
 
         chat_client = get_chat_client(data.model)
 
-        r_iter = chat_client.ask(
-            prompt=sentence_text,
-            session_id=session_id,
-            previous_dhid=previous_dhid,
-        )
+        # 账号都在忙时排队
+        admission_queue = get_chat_admission_queue(data.model)
+        ticket = admission_queue.enqueue(str(session_id)) if admission_queue is not None else None
 
-        answer, _, now_dhid = await r_iter.__anext__()
+        def start_iter():
+            # 合并过密的上游更新, 首条和末条立即发送
+            r_iter = coalesce(chat_client.ask(
+                prompt=sentence_text,
+                session_id=session_id,
+                previous_dhid=previous_dhid,
+                state=state,
+            ))
+            return with_ticket(ticket, r_iter) if ticket is not None else r_iter
+
+        answer = ""
+        now_dhid = None
+
+        if ticket is None or ticket.admitted:
+            r_iter = start_iter()
+            answer, _, now_dhid = await r_iter.__anext__()
+        else:
+            # 排队中: 先返回响应, 轮到后再开始生成
+            r_iter = None
             
         # 重新封装返回器
         async def response_generator():
             nonlocal answer
             nonlocal now_dhid
+            nonlocal r_iter
+
+            if r_iter is None:
+                assert ticket is not None
+                try:
+                    async for position in ticket.positions():
+                        yield (b"data: " + json.dumps(dict(
+                            queued=True,
+                            position=position,
+                        ), ensure_ascii=False).encode("utf8") + b"\n")
+                except QueueTimeoutError as e:
+                    yield (b"data: " + json.dumps(dict(
+                        error=str(e),
+                        code=int(ResponseCode.busy),
+                    ), ensure_ascii=False).encode("utf8") + b"\n")
+                    yield b"data: [DONE]\n"
+                    return
 
-            try:
-                while True:
+                r_iter = start_iter()
+                try:
+                    answer, _, now_dhid = await r_iter.__anext__()
+                except StopAsyncIteration:
+                    await r_iter.aclose()
+                    yield b"data: [DONE]\n"
+                    return
+                except AccountUnavailableError as e:
+                    logger.warning("Busy: " + str(e))
                     yield (b"data: " + json.dumps(dict(
-                        reply=answer,
-                        now_dhid=str(now_dhid)
+                        error=str(e),
+                        code=int(ResponseCode.busy),
                     ), ensure_ascii=False).encode("utf8") + b"\n")
+                    yield b"data: [DONE]\n"
+                    return
+
+            try:
+                while True:
+                    if delta_encoder is None:
+                        frame = dict(
+                            reply=str(answer),
+                            now_dhid=str(now_dhid)
+                        )
+                    else:
+                        offset, delta = delta_encoder.encode(answer)
+                        frame = dict(
+                            delta=delta,
+                            offset=offset,
+                            now_dhid=str(now_dhid)
+                        )
+
+                    yield (b"data: " + json.dumps(frame, ensure_ascii=False).encode("utf8") + b"\n")
 
                     answer, _, now_dhid = await r_iter.__anext__()
 
@@ -153,26 +258,54 @@ async def ask_streaming(
             # 关闭迭代器
             await r_iter.aclose()
 
+            # 增量模式最后一帧返回全文用于校验
+            if delta_encoder is not None:
+                yield (b"data: " + json.dumps(dict(
+                    reply=str(answer),
+                    length=len(answer),
+                    now_dhid=str(now_dhid),
+                    final=True,
+                ), ensure_ascii=False).encode("utf8") + b"\n")
+
             # 保存最后一轮
             await save_new_dialog_info_and_update_now(
                 session_id=session_id,
                 round_id=round_id,
 
                 ask_text=sentence_text,
-                answer_text=answer,
+                answer_text=str(answer),
 
                 dhid=now_dhid,
                 previous_dhid=previous_dhid,
+                state=state,
             )
+            finish_turn("dialog_ask_streaming")
 
             yield b"data: [DONE]\n"
 
+        async def release_ticket():
+            # 客户端在开始读取响应之前断开时生成器不会运行, 由这里关闭上游并释放名额
+            if r_iter is not None:
+                await r_iter.aclose()
+            if ticket is not None:
+                ticket.release()
+
         return StreamingResponse(
             content=response_generator(),
             status_code=200,
             media_type="text/event-stream",
+            background=BackgroundTask(release_ticket) if ticket is not None else None,
         )
 
+    except (AdmissionError, AccountUnavailableError) as e:
+        logger.warning("Busy: " + str(e))
+        return ResponseWrapper(
+            code=ResponseCode.busy,
+            result=ResponseModel.parse_obj(dict(
+                reply=str(e),
+                now_dhid=None,
+            )),
+        )
     except:
         try:
             # 关闭迭代器
@@ -1,5 +1,10 @@
+from typing import Optional
+
+from multi_chat import config
+
 from ..chatgpt import get_chatgpt_client
 from ..gpt3 import get_gpt3_client
+from .admission import AdmissionQueue, get_admission_queue
 
 FUNC_MAP = {
     "text-davinci-002-render": get_chatgpt_client,
@@ -7,9 +12,30 @@ FUNC_MAP = {
     "default": get_chatgpt_client,
 }
 
+# 同一个后端的模型共用一个排队器
+QUEUE_MAP = {
+    "text-davinci-002-render": "chatgpt",
+    "text-davinci-003": "gpt3",
+    "default": "chatgpt",
+}
+
 def get_chat_client(model_name: str):
     if model_name in FUNC_MAP:
         return FUNC_MAP[model_name]()
     else:
         return FUNC_MAP["default"]()
 
+
+def _chatgpt_concurrency() -> int:
+    if config.admission.chatgpt_concurrency is not None:
+        return config.admission.chatgpt_concurrency
+    # 每个账号同时只能有一个对话
+    return len(get_chatgpt_client().accounts)
+
+
+def get_chat_admission_queue(model_name: str) -> Optional[AdmissionQueue]:
+    name = QUEUE_MAP.get(model_name, QUEUE_MAP["default"])
+    if name == "chatgpt":
+        return get_admission_queue(name, _chatgpt_concurrency)
+    else:
+        return get_admission_queue(name, lambda: config.admission.gpt3_concurrency)
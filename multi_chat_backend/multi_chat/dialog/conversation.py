@@ -3,18 +3,24 @@ import traceback
 from typing import List, Optional, Union
 from uuid import UUID, uuid1
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header
 from fastapi.responses import StreamingResponse
 from multi_chat.models import ResponseCode, ResponseWrapper
 # from multi_chat.mongo.models import User
 # from multi_chat.mongo.user import get_current_active_user
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
 from multi_chat import logger
 
-from .chat_client import get_chat_client
+from ..metrics import finish_turn, start_turn
+from ..session.state import SessionState
+from ..upstream.errors import AccountUnavailableError
+from .admission import AdmissionError, QueueTimeoutError, with_ticket
+from .chat_client import get_chat_admission_queue, get_chat_client
 from .dialog_info import (get_now_dialog_info,
                           save_new_dialog_info_and_update_now)
+from .streaming import DELTA_HEADER, DeltaEncoder, coalesce, use_delta
 
 router = APIRouter()
 
@@ -43,12 +49,43 @@ class ResponseModel(BaseModel):
     now_dhid: Optional[UUID] = None
 
 
+def _message_frame(
+    message_id: UUID,
+    session_id: UUID,
+    parts: List[str],
+    metadata: Optional[dict] = None,
+    error: Optional[str] = None,
+) -> bytes:
+    return (b"data: " + json.dumps({
+        "message":{
+            "id": str(message_id),
+            "role":"assistant",
+            "user": None,
+            "create_time":None,
+            "update_time":None,
+            "content":{
+                "content_type":"text",
+                "parts": parts
+            },
+            "end_turn":None,
+            "weight":1,
+            "metadata":{} if metadata is None else metadata,
+            "recipient":"all"
+        },
+        "conversation_id": str(session_id),
+        "error":error
+    }, ensure_ascii=False).encode("utf8") + b"\n\n")
+
+
 @router.post("/conversation")
 async def conversation(
     data: RequestModel,
+    x_stream_delta: Optional[str] = Header(None, alias=DELTA_HEADER),
     # current_user: User = Depends(get_current_active_user),
 ) -> Union[StreamingResponse, ResponseWrapper[ResponseModel]]:
     try:
+        delta_encoder = DeltaEncoder() if use_delta(header=x_stream_delta) else None
+
         #当前句子
         sentence_text = "".join([
             "".join(message.content.parts)
@@ -66,10 +103,15 @@ async def conversation(
 
         assert len(sentence_text) > 0, "need len(sentence_text) > 0"
 
+        # 本轮共享的会话状态, 一次读出, 保存时一次写回
+        start_turn()
+        state = await SessionState.load(session_id)
+
         # 获取所有历史信息
         last_dialog_info = await get_now_dialog_info(
             session_id=session_id,
-            dhid=previous_dhid
+            dhid=previous_dhid,
+            state=state,
         )
 
         if last_dialog_info is not None:
@@ -81,62 +123,72 @@ async def conversation(
 
         chat_client = get_chat_client(data.model)
 
-        r_iter = chat_client.ask(
-            prompt=sentence_text,
-            session_id=session_id,
-            previous_dhid=previous_dhid,
-        )
+        # 账号都在忙时排队
+        admission_queue = get_chat_admission_queue(data.model)
+        ticket = admission_queue.enqueue(str(session_id)) if admission_queue is not None else None
 
-        answer, _, now_dhid = await r_iter.__anext__()
+        def start_iter():
+            # 合并过密的上游更新, 首条和末条立即发送
+            r_iter = coalesce(chat_client.ask(
+                prompt=sentence_text,
+                session_id=session_id,
+                previous_dhid=previous_dhid,
+                state=state,
+            ))
+            return with_ticket(ticket, r_iter) if ticket is not None else r_iter
+
+        answer = ""
+        now_dhid = uuid1()
+
+        if ticket is None or ticket.admitted:
+            r_iter = start_iter()
+            answer, _, now_dhid = await r_iter.__anext__()
+        else:
+            # 排队中: 先返回响应, 轮到后再开始生成
+            r_iter = None
 
         # 重新封装返回器
         async def response_generator():
             nonlocal answer
             nonlocal now_dhid
+            nonlocal r_iter
+
+            if r_iter is None:
+                assert ticket is not None
+                # 排队期间的消息 id 只用于占位
+                queued_id = now_dhid
+                try:
+                    async for position in ticket.positions():
+                        yield _message_frame(queued_id, session_id, [], {"queued": True, "queue_position": position})
+                except QueueTimeoutError as e:
+                    yield _message_frame(queued_id, session_id, [], error=str(e))
+                    yield b"data: [DONE]\n\n"
+                    return
+
+                r_iter = start_iter()
+                try:
+                    answer, _, now_dhid = await r_iter.__anext__()
+                except StopAsyncIteration:
+                    await r_iter.aclose()
+                    yield b"data: [DONE]\n\n"
+                    return
+                except AccountUnavailableError as e:
+                    logger.warning("Busy: " + str(e))
+                    yield _message_frame(queued_id, session_id, [], error=str(e))
+                    yield b"data: [DONE]\n\n"
+                    return
 
             try:
                 # 伪装第一次空白返回
-                yield (b"data: " + json.dumps({
-                    "message":{
-                        "id": str(now_dhid),
-                        "role":"assistant",
-                        "user": None,
-                        "create_time":None,
-                        "update_time":None,
-                        "content":{
-                            "content_type":"text",
-                            "parts": []
-                        },
-                        "end_turn":None,
-                        "weight":1,
-                        "metadata":{},
-                        "recipient":"all"
-                    },
-                    "conversation_id": str(session_id),
-                    "error":None
-                }, ensure_ascii=False).encode("utf8") + b"\n\n")
+                yield _message_frame(now_dhid, session_id, [])
 
                 # 正常循环启动
                 while True:
-                    yield (b"data: " + json.dumps({
-                        "message":{
-                            "id": str(now_dhid),
-                            "role":"assistant",
-                            "user": None,
-                            "create_time":None,
-                            "update_time":None,
-                            "content":{
-                                "content_type":"text",
-                                "parts": [answer]
-                            },
-                            "end_turn":None,
-                            "weight":1,
-                            "metadata":{},
-                            "recipient":"all"
-                        },
-                        "conversation_id": str(session_id),
-                        "error":None
-                    }, ensure_ascii=False).encode("utf8") + b"\n\n")
+                    if delta_encoder is None:
+                        yield _message_frame(now_dhid, session_id, [str(answer)])
+                    else:
+                        offset, delta = delta_encoder.encode(answer)
+                        yield _message_frame(now_dhid, session_id, [delta], {"delta_offset": offset})
 
                     answer, _, now_dhid = await r_iter.__anext__()
 
@@ -146,26 +198,49 @@ async def conversation(
             # 关闭迭代器
             await r_iter.aclose()
 
+            # 增量模式最后一帧返回全文用于校验
+            if delta_encoder is not None:
+                yield _message_frame(now_dhid, session_id, [str(answer)], {"delta_final": True})
+
             # 保存最后一轮
             await save_new_dialog_info_and_update_now(
                 session_id=session_id,
                 round_id=round_id,
 
                 ask_text=sentence_text,
-                answer_text=answer,
+                answer_text=str(answer),
 
                 dhid=now_dhid,
                 previous_dhid=previous_dhid,
+                state=state,
             )
+            finish_turn("conversation")
 
             yield b"data: [DONE]\n\n"
 
+        async def release_ticket():
+            # 客户端在开始读取响应之前断开时生成器不会运行, 由这里关闭上游并释放名额
+            if r_iter is not None:
+                await r_iter.aclose()
+            if ticket is not None:
+                ticket.release()
+
         return StreamingResponse(
             content=response_generator(),
             status_code=200,
             media_type="text/event-stream",
+            background=BackgroundTask(release_ticket) if ticket is not None else None,
         )
 
+    except (AdmissionError, AccountUnavailableError) as e:
+        logger.warning("Busy: " + str(e))
+        return ResponseWrapper(
+            code=ResponseCode.busy,
+            result=ResponseModel.parse_obj(dict(
+                reply=str(e),
+                now_dhid=None,
+            )),
+        )
     except:
         try:
             # 关闭迭代器
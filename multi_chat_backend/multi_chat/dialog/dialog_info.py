@@ -2,9 +2,11 @@ import time
 from typing import Optional
 from uuid import UUID, uuid1
 
-from .dialog_state_cache import DialogStateCache
+from ..session.state import SessionState, register_field
 from .models import DialogHistory
 
+register_field("dialog", DialogHistory)
+
 
 async def get_one_dialog_info(
     session_id: UUID,
@@ -24,9 +26,15 @@ async def get_one_dialog_info(
 async def get_now_dialog_info(
     session_id: UUID,
     dhid: Optional[UUID] = None,
+    state: Optional[SessionState] = None,
 ) -> Optional[DialogHistory]:
+    """state 为空时单独读取会话状态, 否则使用本轮共享的状态, 由调用方统一写回"""
+
+    own_state = state is None
+    if state is None:
+        state = await SessionState.load(session_id)
 
-    now_state = await DialogStateCache.get(key=str(session_id))
+    now_state = state.get("dialog")
 
     if dhid is None:
         # dhid is None 默认找最近的一次
@@ -41,7 +49,9 @@ async def get_now_dialog_info(
             now_state = await get_one_dialog_info(session_id=session_id, dhid=dhid)
             
             if now_state is not None:
-                await DialogStateCache.set(key=str(session_id), value=now_state, ex=600)
+                state.update(dialog=now_state)
+                if own_state:
+                    await state.commit()
 
             return now_state
 
@@ -57,6 +67,7 @@ async def save_new_dialog_info_and_update_now(
 
     dhid: Optional[UUID] = None,
     previous_dhid: Optional[UUID] = None,
+    state: Optional[SessionState] = None,
 ) -> DialogHistory:
     """存储新一轮的患者或系统的对话信息 接口文档5.2
 
@@ -71,7 +82,7 @@ async def save_new_dialog_info_and_update_now(
         
     answer_timestamp = int(time.time())
 
-    new_dialog_info = await DialogHistory.new(
+    new_dialog_info = await DialogHistory.new_behind(
         dhid=dhid,
         previous_dhid=previous_dhid,
 
@@ -83,8 +94,11 @@ async def save_new_dialog_info_and_update_now(
         answer_timestamp=answer_timestamp,
     )
 
-    # 允许存活时间10分钟
-    await DialogStateCache.set(key=str(session_id), value=new_dialog_info, ex=600)
+    # 对话层最后保存, 连同后端本轮更新的字段一次写回
+    if state is None:
+        state = SessionState(session_id)
+    state.update(dialog=new_dialog_info)
+    await state.commit()
 
     return new_dialog_info
 
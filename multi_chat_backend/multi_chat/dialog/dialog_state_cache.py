@@ -1,10 +0,0 @@
-from typing import Optional
-
-from ..redis import RedisCache
-from .models import DialogHistory
-
-
-class DialogStateCache(RedisCache[DialogHistory]):
-    pass
-
-
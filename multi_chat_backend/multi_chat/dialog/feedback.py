@@ -2,7 +2,7 @@ import json
 from typing import List
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 
 # from .models import User
@@ -43,7 +43,8 @@ async def feedback(
         dhid=dhid
     )
 
-    assert dialog_info is not None
+    if dialog_info is None:
+        raise HTTPException(status_code=404, detail="Message not found")
 
     if data.rating == 'thumbsUp':
         dialog_info.user_feedback_rank = 10
@@ -55,9 +56,12 @@ async def feedback(
         "tags": data.tags,
     }, ensure_ascii=False)
 
-    save_re = await dialog_info.save()
+    # 只写回反馈字段, 不重写整条对话内容
+    save_re = await dialog_info.update_fields("user_feedback_rank", "user_feedback_content")
 
-    assert save_re == 0 or save_re == 1
+    # 0 表示没有写入任何文档, 反馈丢失
+    if save_re == 0:
+        raise HTTPException(status_code=404, detail="Message not found")
 
     return ResponseModel(
         conversation_id=data.conversation_id,
@@ -1,7 +1,9 @@
 from enum import IntEnum
-from typing import Generic, Optional, Type, TypeVar
+from typing import Generic, List, Optional, Type, TypeVar
 from uuid import UUID
 
+from pymongo import ASCENDING, IndexModel
+
 from ..mongo import MongoModel
 
 # from pydantic import BaseModel
@@ -26,3 +28,12 @@ class DialogHistory(MongoModel):
     def collection_name(cls) -> str:
         return "dialog_history"
 
+    @classmethod
+    def indexes(cls) -> List[IndexModel]:
+        return [
+            # 按轮次 id 取某一轮: get(dhid=..., session_id=...)
+            IndexModel([("session_id", ASCENDING), ("dhid", ASCENDING)]),
+            # 取整个会话 (迁移时回溯历史), 按轮次排序
+            IndexModel([("session_id", ASCENDING), ("round_id", ASCENDING)]),
+        ]
+
@@ -0,0 +1,133 @@
+import asyncio
+from typing import AsyncGenerator, Optional, Tuple, TypeVar, Union
+
+from multi_chat import config
+
+from ..upstream.rope import TextRope
+
+T = TypeVar("T", bound=Tuple)
+
+# 增量流式协议的开关请求头
+DELTA_HEADER = "X-Stream-Delta"
+
+
+def use_delta(flag: bool = False, header: Optional[str] = None) -> bool:
+    if flag:
+        return True
+    return header is not None and header.strip().lower() in ("1", "true", "yes", "on")
+
+
+class DeltaEncoder:
+    """记录单个流已发送的长度, 每帧只编码新追加的后缀"""
+
+    def __init__(self) -> None:
+        self.length = 0
+        self._last: Union[str, TextRope] = ""
+
+    def encode(self, answer: Union[str, TextRope]) -> Tuple[int, str]:
+        offset = self.length
+
+        if isinstance(answer, TextRope) and answer is self._last:
+            # 同一个只追加的 rope, 直接取后缀
+            delta = answer.since(offset)
+        else:
+            text = str(answer)
+
+            # 上游改写了已发送的内容, 从头重发
+            if len(text) < offset or not text.startswith(str(self._last)):
+                offset = 0
+
+            delta = text[offset:]
+
+        self._last = answer
+        self.length = len(answer)
+
+        return offset, delta
+
+
+async def coalesce(
+    r_iter: AsyncGenerator[T, None],
+    interval_ms: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> AsyncGenerator[T, None]:
+    """合并上游的流式更新, 最多每 interval_ms 毫秒或每新增 max_bytes 发送一次
+
+    第一条和最后一条立即发送, 不影响首字延迟. 上游每条都是累计的全文 (answer, ...),
+    所以合并时只需保留最新一条, 新增长度按字符数近似字节数.
+    """
+    if interval_ms is None:
+        interval_ms = config.streaming.coalesce_interval_ms
+    if max_bytes is None:
+        max_bytes = config.streaming.coalesce_max_bytes
+
+    if interval_ms <= 0:
+        try:
+            async for item in r_iter:
+                yield item
+        finally:
+            await r_iter.aclose()
+        return
+
+    loop = asyncio.get_event_loop()
+    interval = interval_ms / 1000
+
+    pending: Optional[T] = None
+    flushed_length: Optional[int] = None
+    last_flush = loop.time()
+    next_task: Optional[asyncio.Future] = None
+
+    try:
+        while True:
+            if next_task is None:
+                next_task = asyncio.ensure_future(r_iter.__anext__())
+
+            timeout = None
+            if pending is not None:
+                timeout = max(interval - (loop.time() - last_flush), 0)
+
+            done, _ = await asyncio.wait({next_task}, timeout=timeout)
+
+            if len(done) == 0:
+                # 上游暂时没有新数据, 发送积攒的更新
+                assert pending is not None
+                flushed_length = len(pending[0])
+                last_flush = loop.time()
+                item, pending = pending, None
+                yield item
+                continue
+
+            task, next_task = next_task, None
+            try:
+                pending = task.result()
+            except StopAsyncIteration:
+                break
+
+            if (
+                flushed_length is None
+                or len(pending[0]) - flushed_length >= max_bytes
+                or loop.time() - last_flush >= interval
+            ):
+                flushed_length = len(pending[0])
+                last_flush = loop.time()
+                item, pending = pending, None
+                yield item
+
+        # 结束时立即发送最后一条
+        if pending is not None:
+            yield pending
+
+    finally:
+        try:
+            if next_task is not None:
+                next_task.cancel()
+                # 只等读取任务结束, 不吞掉当前任务自己收到的取消
+                await asyncio.wait({next_task})
+                if not next_task.cancelled():
+                    # 取出异常, 避免 "exception was never retrieved"
+                    next_task.exception()
+        finally:
+            if next_task is not None and not next_task.done():
+                # 等待时自己被取消, 读取任务还在运行, 此时 aclose 会报 already running, 等它结束后再关闭
+                next_task.add_done_callback(lambda _: asyncio.ensure_future(r_iter.aclose()))
+            else:
+                await r_iter.aclose()
@@ -1,4 +1,3 @@
-import asyncio
 import json
 import random
 from typing import AsyncGenerator, List, Mapping, Optional, Tuple
@@ -6,6 +5,10 @@ from uuid import UUID, uuid1
 
 from multi_chat import config, logger
 
+from ..session.state import SessionState
+from ..upstream.errors import UpstreamError
+from ..upstream.retry import RetryPolicy
+from ..upstream.rope import TextRope
 from .ask import ask as gpt3_ask
 from .gpt3_dialog_info import (get_now_dialog_info,
                                save_new_dialog_info_and_update_now)
@@ -30,16 +33,23 @@ class MGPT3:
         prompt: str,
         session_id: UUID,
         previous_dhid: Optional[UUID] = None,
-        retry: int = 5,
-    ) -> AsyncGenerator[Tuple[str, UUID, UUID], None]:
+        retry: Optional[int] = None,
+        state: Optional[SessionState] = None,
+    ) -> AsyncGenerator[Tuple[TextRope, UUID, UUID], None]:
 
         openai_account_email = None
         pre_text = None
 
         # 获取openai历史信息
+        # 调用方传入本轮共享的会话状态时由调用方写回, 否则自己读写
+        own_state = state is None
+        if state is None:
+            state = await SessionState.load(session_id)
+
         last_dialog_info = await get_now_dialog_info(
             session_id=session_id,
-            dhid=previous_dhid
+            dhid=previous_dhid,
+            state=state,
         )
 
         if last_dialog_info is not None:
@@ -53,56 +63,43 @@ class MGPT3:
         assert openai_account_email is not None
         access_token = self.accounts[self.account_map_idx[openai_account_email]].access_token
 
-        try:
-
-            if pre_text is None:
-                pre_text = "I am a highly intelligent question answering bot. If you ask me a question that is rooted in truth, I will give you the answer. \nExample:\nQ: Who are you?\nA: Hello! I am Assistant, a large language model trained by OpenAI. I am not a real person, but a computer program designed to assist with answering questions and providing information on a wide range of topics. Is there something specific you'd like to know?"
-
-            ask_prompt = pre_text + "\n\nQ: " + prompt + "\nA: "
-
-            now_dhid = uuid1()
-            answer = ""
-
-            async for r_item in gpt3_ask(
-                auth_token=access_token,
-                prompt=ask_prompt,
-
-            ):
-                answer = r_item
-                yield answer, session_id, now_dhid 
-
-            if len(answer) > 0:
-                await save_new_dialog_info_and_update_now(
-                    session_id=session_id,
-                    dhid=now_dhid,
-                    openai_account_email=openai_account_email,
-                    pre_text=(ask_prompt+answer)
-                )
-
-
-        except Exception as e:
-            e_str =  str(e)
-            if (
-                "Maybe try me again" in e_str
-                or "incomplete chunked read" in e_str
-                or "peer closed connection" in e_str
-            ):
-                if retry > 0:
-                    # 休眠一下
-                    await asyncio.sleep(0.3)
-
-                    async for retry_re in self.ask(
-                        prompt=prompt,
-                        session_id=session_id,
-                        previous_dhid=previous_dhid,
-                        retry=retry-1,
-                    ):
-                        yield retry_re
-                else:
-                    logger.warning(openai_account_email + " retry max")
-                    raise e
-            else:
-                raise e
+        if pre_text is None:
+            pre_text = "I am a highly intelligent question answering bot. If you ask me a question that is rooted in truth, I will give you the answer. \nExample:\nQ: Who are you?\nA: Hello! I am Assistant, a large language model trained by OpenAI. I am not a real person, but a computer program designed to assist with answering questions and providing information on a wide range of topics. Is there something specific you'd like to know?"
+
+        ask_prompt = pre_text + "\n\nQ: " + prompt + "\nA: "
+
+        now_dhid = uuid1()
+        answer = TextRope()
+
+        policy = RetryPolicy("gpt3", budget=retry)
+        while True:
+            try:
+                # 重试时把已生成的部分接在 prompt 后面续写, 不重复已发送的内容
+                async for r_item in gpt3_ask(
+                    auth_token=access_token,
+                    prompt=ask_prompt + str(answer),
+                    resume=answer,
+                ):
+                    answer = r_item
+                    yield answer, session_id, now_dhid 
+                break
+            except UpstreamError as e:
+                if not policy.should_retry(e):
+                    logger.warning(openai_account_email + " " + str(e))
+                    raise
+                await policy.backoff(e)
+
+        if len(answer) > 0:
+            await save_new_dialog_info_and_update_now(
+                session_id=session_id,
+                dhid=now_dhid,
+                openai_account_email=openai_account_email,
+                pre_text=(ask_prompt+str(answer)),
+                state=state,
+            )
+            if own_state:
+                await state.commit()
+
 
 _gpt3_client: Optional[MGPT3] = None
 
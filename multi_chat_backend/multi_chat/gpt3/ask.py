@@ -3,15 +3,20 @@ import json
 import uuid
 from typing import AsyncGenerator, Optional, Tuple
 
-# import cfscrape
-# Requests
 import httpx
 
+from ..upstream import get_client
+from ..upstream.errors import classify_response, classify_transport
+from ..upstream.rope import TextRope
+from ..upstream.sse import iter_events
+
 
 async def ask(
         auth_token: str,
         prompt: str,
-) -> AsyncGenerator[str, None]:
+        resume: Optional[TextRope] = None,
+) -> AsyncGenerator[TextRope, None]:
+    """resume 不为空时表示续写, prompt 已包含 resume 的内容, 新生成的块追加到 resume 后面"""
 
     headers = {
         'Content-Type': 'application/json',
@@ -30,8 +35,9 @@ async def ask(
         "stop": "\n\n"
     }
 
-    async with httpx.AsyncClient(proxies=None, transport=httpx.AsyncHTTPTransport(retries=5)) as session: # type: ignore
+    session = get_client("gpt3")
 
+    try:
         async with session.stream(
             'POST',
             url="https://api.openai.com/v1/completions",
@@ -40,38 +46,18 @@ async def ask(
             timeout=360,
         ) as response:
             if response.status_code == 200:
-                re_text = ""
-                async for line in response.aiter_lines():
-                    line = line.rstrip()
-
-                    if len(line) == 0:
-                        continue
-
-                    if line[:6] == "data: ":
-                        line = line[6:]
-
-                    if line == "[DONE]":
-                        break
+                # 只追加新块, 需要全文时再拼接
+                re_text = resume if resume is not None else TextRope()
+                async for as_json in iter_events(response):
+                    text = as_json["choices"][0]["text"]
 
-                    if len(line) == 0:
-                        continue
-                    
-                    as_json = json.loads(line)
-
-                    if len(as_json["choices"][0]["text"]) > 0:
-                        re_text += as_json["choices"][0]["text"]
+                    if len(text) > 0:
+                        re_text.append(text)
                         yield re_text
             else:
                 r_text = await response.aread()
                 r_text = r_text.decode('utf8')
 
-                if response.status_code == 401:
-                    raise Exception(f"[Status Code] 401 | [Response Text] {r_text}")
-                elif response.status_code >= 500:
-                    print(">> Looks like the server is either overloaded or down. Try again later.")
-                    raise Exception(f"[Status Code] {response.status_code} | [Response Text] {r_text}")
-                else:
-                    raise Exception(f"[Status Code] {response.status_code} | [Response Text] {r_text}")
-
-
-
+                raise classify_response(response.status_code, r_text)
+    except httpx.TransportError as e:
+        raise classify_transport(e) from e
@@ -2,9 +2,11 @@ import time
 from typing import Optional
 from uuid import UUID, uuid1
 
-from .gpt3_dialog_state_cache import GPT3DialogStateCache
+from ..session.state import SessionState, register_field
 from .models import GPT3DialogHistory
 
+register_field("gpt3", GPT3DialogHistory)
+
 
 async def get_one_dialog_info(
     session_id: UUID,
@@ -24,9 +26,15 @@ async def get_one_dialog_info(
 async def get_now_dialog_info(
     session_id: UUID,
     dhid: Optional[UUID] = None,
+    state: Optional[SessionState] = None,
 ) -> Optional[GPT3DialogHistory]:
+    """state 为空时单独读取会话状态, 否则使用本轮共享的状态, 由调用方统一写回"""
+
+    own_state = state is None
+    if state is None:
+        state = await SessionState.load(session_id)
 
-    now_state = await GPT3DialogStateCache.get(key=str(session_id))
+    now_state = state.get("gpt3")
 
     if dhid is None:
         # dhid is None 默认找最近的一次
@@ -41,7 +49,9 @@ async def get_now_dialog_info(
             now_state = await get_one_dialog_info(session_id=session_id, dhid=dhid)
             
             if now_state is not None:
-                await GPT3DialogStateCache.set(key=str(session_id), value=now_state, ex=600)
+                state.update(gpt3=now_state)
+                if own_state:
+                    await state.commit()
 
             return now_state
 
@@ -51,6 +61,7 @@ async def save_new_dialog_info_and_update_now(
     dhid: Optional[UUID] = None,
     openai_account_email: Optional[str] = None,
     pre_text: Optional[str] = None,
+    state: Optional[SessionState] = None,
 ) -> GPT3DialogHistory:
     """存储新一轮的患者或系统的对话信息 接口文档5.2
 
@@ -63,7 +74,7 @@ async def save_new_dialog_info_and_update_now(
     if dhid is None:
         dhid = uuid1()
         
-    new_dialog_info = await GPT3DialogHistory.new(
+    new_dialog_info = await GPT3DialogHistory.new_behind(
         session_id=session_id,
         dhid=dhid,
 
@@ -71,8 +82,13 @@ async def save_new_dialog_info_and_update_now(
         pre_text=pre_text,
     )
 
-    # 允许存活时间10分钟
-    await GPT3DialogStateCache.set(key=str(session_id), value=new_dialog_info, ex=600)
+    # state 为空时直接写回这一个字段; 否则由本轮最后保存的一层统一写回
+    if state is None:
+        state = SessionState(session_id)
+        state.update(gpt3=new_dialog_info)
+        await state.commit()
+    else:
+        state.update(gpt3=new_dialog_info)
 
     return new_dialog_info
 
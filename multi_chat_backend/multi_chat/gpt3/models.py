@@ -1,7 +1,8 @@
-from typing import Optional, Union
+from typing import List, Optional, Union
 from uuid import UUID
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
 from ..mongo import MongoModel
 
@@ -18,6 +19,12 @@ class GPT3DialogHistory(MongoModel):
     def collection_name(cls) -> str:
         return "gpt3_dialog_history"
 
+    @classmethod
+    def indexes(cls) -> List[IndexModel]:
+        return [
+            IndexModel([("session_id", ASCENDING), ("dhid", ASCENDING)]),
+        ]
+
 
 class OpenAIAccount(BaseModel):
     email: str
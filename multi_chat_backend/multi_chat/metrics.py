@@ -0,0 +1,74 @@
+import asyncio
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import APIRouter
+
+router = APIRouter()
+
+# 各模块注册的统计采集函数, 同步或异步均可
+_collectors: Dict[str, Callable[[], Any]] = {}
+
+
+def register_collector(name: str, collector: Callable[[], Any]) -> None:
+    _collectors[name] = collector
+
+
+async def collect() -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    for name, collector in _collectors.items():
+        value = collector()
+        if asyncio.iscoroutine(value):
+            value = await value
+        result[name] = value
+    return result
+
+
+# 每轮对话的数据存储往返次数: 请求开始时 start_turn, 各存储层每次往返调用 count_round_trip
+_turn_round_trips: ContextVar[Optional[Counter]] = ContextVar("turn_round_trips", default=None)
+_round_trip_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def start_turn() -> Counter:
+    counter: Counter = Counter()
+    _turn_round_trips.set(counter)
+    return counter
+
+
+def count_round_trip(store: str) -> None:
+    counter = _turn_round_trips.get()
+    if counter is not None:
+        counter[store] += 1
+
+
+def finish_turn(name: str) -> None:
+    counter = _turn_round_trips.get()
+    if counter is None:
+        return
+    _turn_round_trips.set(None)
+
+    stats = _round_trip_stats.setdefault(name, dict(turns=0, total=Counter(), max=Counter()))
+    stats["turns"] += 1
+    for store, count in counter.items():
+        stats["total"][store] += count
+        stats["max"][store] = max(stats["max"][store], count)
+
+
+def _round_trips() -> Dict[str, Any]:
+    return {
+        name: dict(
+            turns=stats["turns"],
+            avg={store: total / stats["turns"] for store, total in stats["total"].items()},
+            max=dict(stats["max"]),
+        )
+        for name, stats in _round_trip_stats.items()
+    }
+
+
+register_collector("round_trips", _round_trips)
+
+
+@router.get("/stats")
+async def stats() -> Dict[str, Any]:
+    return await collect()
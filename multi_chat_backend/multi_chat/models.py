@@ -12,6 +12,7 @@ class ResponseCode(IntEnum):
     success = 0
     empty_result = 10
     internal_error = 20
+    busy = 30
 
 
 class ResponseWrapper(GenericModel, Generic[R]):
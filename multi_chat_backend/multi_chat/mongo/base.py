@@ -1,15 +1,22 @@
-from typing import Optional, Type, TypeVar
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Type, TypeVar, Union
 from uuid import UUID
 
 from bson import ObjectId
 from bson.errors import InvalidId
 from motor.core import AgnosticCollection, AgnosticCursor
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
+from pymongo import IndexModel, InsertOne, UpdateOne
+from pymongo.results import BulkWriteResult
 
+from ..metrics import count_round_trip
 from . import get_database
+from .write_behind import get_write_behind
 
 T = TypeVar("T", bound="MongoModel")
 
+# 所有 MongoModel 子类, 按集合名登记, 启动时据此核对索引
+_models: Dict[str, Type["MongoModel"]] = {}
+
 
 class OID(ObjectId):
     @classmethod
@@ -27,50 +34,223 @@ class OID(ObjectId):
 class MongoModel(BaseModel):
     id: OID = Field(alias="_id")
 
+    # 读出或创建后修改过的字段, save 时只 $set 这些字段
+    _dirty: Set[str] = PrivateAttr(default_factory=set)
+    # 从写入队列里读出的文档, mongo 里可能还没有
+    _unsaved: bool = PrivateAttr(default=False)
+
     class Config:
         allow_population_by_field_name = True
         json_encoders = {ObjectId: lambda x: str(x), UUID: lambda x: str(x)}
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        _models[cls.collection_name()] = cls
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in self.__fields__ and name != "id":
+            # 换成新集合而不是原地修改, copy() 出来的对象共用同一个集合
+            object.__setattr__(self, "_dirty", self._dirty | {name})
+
     def dict(self, **kwargs) -> dict:
         kwargs.pop("by_alias", None)
         return super().dict(by_alias=True, **kwargs)
 
+    def dirty_fields(self) -> Set[str]:
+        return set(self._dirty)
+
+    def _mark_clean(self, fields: Iterable[str]) -> None:
+        object.__setattr__(self, "_dirty", self._dirty - set(fields))
+
+    def _update_document(self, fields: Set[str], upsert: bool) -> dict:
+        """$set 指定字段; upsert 时其余字段只在插入时写入"""
+        update: dict = {}
+        if len(fields) > 0:
+            update["$set"] = self.dict(include=fields)
+        if upsert:
+            others = set(self.__fields__) - fields - {"id"}
+            if len(others) > 0:
+                update["$setOnInsert"] = self.dict(include=others)
+        return update
+
     @classmethod
     def collection_name(cls) -> str:
         return cls.__name__.lower()
 
+    @classmethod
+    def indexes(cls) -> List[IndexModel]:
+        """集合需要的索引, 子类按自己的查询声明, 启动时自动创建"""
+        return []
+
     @classmethod
     def collection(cls) -> AgnosticCollection:
         return get_database()[cls.collection_name()]
 
     @classmethod
     async def get(cls: Type[T], **kwargs) -> Optional[T]:
+        count_round_trip("mongo")
         obj: T = await cls.collection().find_one(kwargs)  # type: ignore
-        return cls.parse_obj(obj) if obj else None
+        if obj:
+            return cls.parse_obj(obj)
+
+        queue = get_write_behind()
+        if queue is None:
+            return None
+        # 可能还在异步写入的队列里, 本 worker 的队列里没有时再按会话索引查其他 worker 的
+        pending = queue.find_pending(cls.collection_name(), kwargs)
+        if len(pending) == 0:
+            pending = await queue.find_spilled(cls.collection_name(), kwargs)
+        return cls._parse_unsaved(pending[0]) if len(pending) > 0 else None
+
+    @classmethod
+    def _parse_unsaved(cls: Type[T], doc: dict) -> T:
+        obj = cls.parse_obj(doc)
+        object.__setattr__(obj, "_unsaved", True)
+        return obj
 
     @classmethod
     async def list(
-        cls: Type[T], sort: Optional[str] = None, length: int = 100, **kwargs
+        cls: Type[T], sort: Optional[Union[str, List[Tuple[str, int]]]] = None, length: int = 100, **kwargs
     ) -> list[T]:
+        count_round_trip("mongo")
         cursor: AgnosticCursor
         if sort:
             cursor = cls.collection().find(kwargs).sort(sort)  # type: ignore
         else:
             cursor = cls.collection().find(kwargs)
 
-        return [cls.parse_obj(x) for x in await cursor.to_list(length=length)]
+        items = await cursor.to_list(length=length)
+
+        objs = [cls.parse_obj(x) for x in items]
+
+        queue = get_write_behind()
+        if queue is not None and len(objs) < length:
+            found = {x["_id"] for x in items}
+            for x in queue.find_pending(cls.collection_name(), kwargs) + await queue.find_spilled(cls.collection_name(), kwargs):
+                if len(objs) >= length:
+                    break
+                if x["_id"] not in found:
+                    found.add(x["_id"])
+                    objs.append(cls._parse_unsaved(x))
+
+        return objs
+
+    async def _flush_if_pending(self) -> None:
+        # 还没写入的文档先写入, 否则按 _id 的修改会落空
+        queue = get_write_behind()
+        if queue is not None and queue.is_pending(self.id):
+            await queue.flush(drain=True)
+
+    async def update_fields(self, *fields: str, upsert: bool = False) -> int:
+        """只写回指定的字段, 不指定时写回修改过的字段; upsert 为真时文档不存在则按全部字段插入
+
+        返回匹配或插入的文档数, 文档不存在或没有要写的字段时为 0
+        """
+        names = set(fields) if len(fields) > 0 else self.dirty_fields()
+        for name in names:
+            assert name in self.__fields__ and name != "id", f"{name} is not a writable field"
 
-    async def save(self) -> int:
+        update = self._update_document(names, upsert)
+        if len(update) == 0:
+            return 0
+
+        await self._flush_if_pending()
+        count_round_trip("mongo")
+        result = await self.collection().update_one(
+            {"_id": self.id}, update, upsert=upsert
+        )  # type: ignore
+        if result.matched_count == 0 and result.upserted_id is None and self._unsaved:
+            # 还在其他 worker 的写入队列里: 整个文档写入, 之后那边的写入按重复键忽略
+            return await self.replace(upsert=True)
+
+        self._mark_clean(names)
+        return result.matched_count + (1 if result.upserted_id is not None else 0)
+
+    async def save(self, upsert: bool = False) -> int:
+        return await self.update_fields(upsert=upsert)
+
+    async def replace(self, upsert: bool = False) -> int:
+        """整个文档覆盖写入"""
+        await self._flush_if_pending()
+        count_round_trip("mongo")
         result = await self.collection().replace_one(
-            {"_id": self.id}, self.dict()
+            {"_id": self.id}, self.dict(), upsert=upsert
         )  # type: ignore
-        return result.modified_count
+        self._mark_clean(self.__fields__)
+        if result.matched_count > 0 or result.upserted_id is not None:
+            object.__setattr__(self, "_unsaved", False)
+        return result.matched_count + (1 if result.upserted_id is not None else 0)
 
     async def delete(self) -> int:
+        await self._flush_if_pending()
+        count_round_trip("mongo")
         result = await self.collection().delete_many({"_id": self.id})  # type: ignore
         return result.deleted_count
 
     @classmethod
     async def new(cls: Type[T], **kwargs) -> T:
+        count_round_trip("mongo")
         await cls.collection().insert_one(kwargs)  # type: ignore
         return cls(**kwargs)
+
+    @classmethod
+    async def bulk_write(cls, requests: List[Any], ordered: bool = False) -> Optional[BulkWriteResult]:
+        """多个写操作一次往返, 默认不按顺序执行, 一条失败不影响其他"""
+        if len(requests) == 0:
+            return None
+        count_round_trip("mongo")
+        return await cls.collection().bulk_write(requests, ordered=ordered)  # type: ignore
+
+    @classmethod
+    async def bulk_new(cls: Type[T], items: List[dict], ordered: bool = False) -> List[T]:
+        """同 new, 多条一次 bulk_write 插入"""
+        objs = []
+        for kwargs in items:
+            kwargs = dict(kwargs)
+            kwargs.setdefault("_id", ObjectId())
+            objs.append(cls(**kwargs))
+
+        await cls.bulk_write([InsertOne(obj.dict()) for obj in objs], ordered=ordered)
+        return objs
+
+    @classmethod
+    async def bulk_update(cls: Type[T], objs: List[T], upsert: bool = False, ordered: bool = False) -> int:
+        """多个对象修改过的字段一次 bulk_write 写回, 返回匹配和插入的文档数"""
+        queue = get_write_behind()
+        if queue is not None and any(queue.is_pending(obj.id) for obj in objs):
+            await queue.flush(drain=True)
+
+        count = 0
+        requests = []
+        written = []
+        for obj in objs:
+            if obj._unsaved:
+                # 可能还在其他 worker 的写入队列里, 逐个写入, 没匹配到时整个文档写入
+                count += await obj.update_fields(upsert=upsert)
+                continue
+            names = obj.dirty_fields()
+            update = obj._update_document(names, upsert)
+            if len(update) > 0:
+                requests.append(UpdateOne({"_id": obj.id}, update, upsert=upsert))
+                written.append((obj, names))
+
+        result = await cls.bulk_write(requests, ordered=ordered)
+        if result is None:
+            return count
+        for obj, names in written:
+            obj._mark_clean(names)
+        return count + result.matched_count + result.upserted_count
+
+    @classmethod
+    async def new_behind(cls: Type[T], **kwargs) -> T:
+        """同 new, 但交给后台批量写入, 不等 mongo; 没有开启时直接写入"""
+        queue = get_write_behind()
+        if queue is None or not queue.running:
+            return await cls.new(**kwargs)
+
+        kwargs.setdefault("_id", ObjectId())
+        obj = cls(**kwargs)
+        await queue.enqueue(cls.collection_name(), obj.dict())
+        object.__setattr__(obj, "_unsaved", True)
+        return obj
@@ -0,0 +1,120 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+from .base import _models
+
+# 最近一次核对的结果, 按集合名
+_report: Dict[str, Dict[str, Any]] = {}
+_reconciler: Optional[asyncio.Task] = None
+
+
+def _key_of(keys: Any) -> List[tuple]:
+    # 服务端返回的方向可能是 1.0
+    return [
+        (field, int(direction) if isinstance(direction, float) else direction)
+        for field, direction in (keys.items() if isinstance(keys, dict) else keys)
+    ]
+
+
+def _find(existing: Dict[str, dict], index: IndexModel) -> Optional[str]:
+    """按字段和 unique 找已有的同一个索引, 名字不同也算"""
+    document = index.document
+    for name, info in existing.items():
+        if _key_of(info["key"]) == _key_of(document["key"]) and bool(info.get("unique")) == bool(document.get("unique")):
+            return name
+    return None
+
+
+async def reconcile_collection(collection_name: str, create: bool) -> Dict[str, Any]:
+    model = _models[collection_name]
+    wanted = model.indexes()
+    collection = model.collection()
+
+    existing: Dict[str, dict] = await collection.index_information()  # type: ignore
+
+    present: List[str] = []
+    missing: List[IndexModel] = []
+    for index in wanted:
+        name = _find(existing, index)
+        if name is not None:
+            present.append(name)
+        else:
+            missing.append(index)
+
+    created: List[str] = []
+    errors: Dict[str, str] = {}
+    if create:
+        # 逐个创建, 一个冲突 (例如同名不同定义, 或已有重复数据建不了唯一索引) 不影响其他
+        for index in missing:
+            try:
+                created += await collection.create_indexes([index])  # type: ignore
+            except OperationFailure as e:
+                errors[index.document["name"]] = str(e)
+
+    still_missing = [
+        index.document["name"]
+        for index in missing
+        if index.document["name"] not in created
+    ]
+    return dict(
+        present=present,
+        created=created,
+        missing=still_missing,
+        errors=errors,
+    )
+
+
+async def reconcile_indexes(create: Optional[bool] = None) -> Dict[str, Dict[str, Any]]:
+    """核对所有 MongoModel 声明的索引, create 为真时创建缺少的, 返回每个集合的结果"""
+    if create is None:
+        create = config.mongo.create_indexes
+
+    for collection_name, model in list(_models.items()):
+        if len(model.indexes()) == 0:
+            continue
+        try:
+            result = await reconcile_collection(collection_name, create)
+        except Exception as e:
+            result = dict(present=[], created=[], missing=[], errors=dict(reconcile=repr(e)))
+        _report[collection_name] = result
+
+        if len(result["created"]) > 0:
+            logger.info(f"mongo {collection_name} created indexes {result['created']}")
+        if len(result["missing"]) > 0:
+            logger.warning(f"mongo {collection_name} lacks indexes {result['missing']}: {result['errors']}")
+
+    return _report
+
+
+def start_index_reconciler() -> None:
+    """后台核对, 大集合上建索引可能很久, 不阻塞启动"""
+    global _reconciler
+    if _reconciler is None or _reconciler.done():
+        _reconciler = asyncio.ensure_future(reconcile_indexes())
+
+
+async def stop_index_reconciler() -> None:
+    global _reconciler
+    if _reconciler is not None:
+        _reconciler.cancel()
+        try:
+            await _reconciler
+        except BaseException:
+            pass
+        _reconciler = None
+
+
+register_collector(
+    "mongo_indexes",
+    lambda: dict(
+        running=_reconciler is not None and not _reconciler.done(),
+        collections=_report,
+        lacking=[name for name, result in _report.items() if len(result["missing"]) > 0],
+    ),
+)
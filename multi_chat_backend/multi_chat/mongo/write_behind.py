@@ -0,0 +1,393 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import bson
+from bson import ObjectId
+from bson.binary import UuidRepresentation
+from bson.codec_options import CodecOptions
+from pymongo.errors import BulkWriteError, ConnectionFailure, ExecutionTimeout, WTimeoutError
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+from ..redis import get_database as get_redis
+from ..redis import get_pipeline
+from . import get_database
+
+# 对话记录先进进程内队列, 后台按条数或时间批量 insert_many 写入 mongo.
+# 入队时同时 XADD 到 redis stream 落盘, 写入 mongo 成功后 XDEL;
+# 进程崩溃留下的条目由任意 worker 在超过 recover_after 秒后补写.
+# 文档入队前就分配好 _id, 重复补写只会触发重复键错误, 按已写入处理.
+# 只有连接和超时错误整批留在队列里重试; 被 mongo 拒绝的文档移出队列,
+# stream 条目保留给补写, 补写仍被拒绝时转入死信 stream, 不会卡住后面的写入.
+# 带 session_id 的文档同时按 (集合, session_id) 写入一个 hash, 其他 worker 按会话查找
+# 还没写入的文档时只读这一个 hash, 不扫描 stream.
+
+_CODEC_OPTIONS: CodecOptions = CodecOptions(uuid_representation=UuidRepresentation.STANDARD)
+
+_DUPLICATE_KEY = 11000
+
+# 这些错误与文档无关, 整批原样重试
+_RETRYABLE = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+
+_DEAD_LETTER_MAXLEN = 10000
+
+# 按这个字段建立跨 worker 的查找索引
+_INDEX_FIELD = "session_id"
+
+
+def _stream() -> str:
+    return config.redis.redis_prefix + ":WriteBehind"
+
+
+def _dead_letter_stream() -> str:
+    return config.redis.redis_prefix + ":WriteBehind:Dead"
+
+
+def _index_key(collection: str, values: Dict[str, Any]) -> Optional[str]:
+    """文档或查询条件对应的索引 hash, 没有 session_id 时不建索引"""
+    if not config.mongo.write_behind_spill or values.get(_INDEX_FIELD) is None:
+        return None
+    return config.redis.redis_prefix + ":WriteBehind:Index:" + collection + ":" + str(values[_INDEX_FIELD])
+
+
+def _index_expire() -> int:
+    # 正常情况下写入后即删除; 崩溃时超过 recover_after 会被补写, 之后的条目只是兜底
+    return int(config.mongo.write_behind_recover_after * 2) + 1
+
+
+def _queue_unindex(pipe: Any, collection: str, docs: List[Dict[str, Any]]) -> None:
+    by_key: Dict[str, List[str]] = {}
+    for doc in docs:
+        key = _index_key(collection, doc)
+        if key is not None:
+            by_key.setdefault(key, []).append(str(doc["_id"]))
+    for key, ids in by_key.items():
+        pipe.hdel(key, *ids)  # type: ignore
+
+
+class PendingDoc:
+    def __init__(self, collection: str, doc: Dict[str, Any], stream_id: Optional[bytes]) -> None:
+        self.collection = collection
+        self.doc = doc
+        self.stream_id = stream_id
+
+
+class WriteBehindQueue:
+
+    def __init__(self) -> None:
+        self._pending: Deque[PendingDoc] = deque()
+        self._ids: Dict[ObjectId, PendingDoc] = {}
+
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.flush_errors = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.dead_lettered = 0
+        self.recovered = 0
+        self.backpressure_waits = 0
+        self.direct_writes = 0
+        self.last_flush_seconds: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done() and not self._closing
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def enqueue(self, collection: str, doc: Dict[str, Any]) -> None:
+        """doc 必须已有 _id; 队列满时等待后台写入腾出空间, 等不到就直接写 mongo"""
+        if not self.running:
+            await self._insert_direct(collection, doc)
+            return
+
+        if len(self._pending) >= config.mongo.write_behind_max_pending:
+            self.backpressure_waits += 1
+            self._wakeup.set()
+            try:
+                async with self._space:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: len(self._pending) < config.mongo.write_behind_max_pending),
+                        timeout=config.mongo.write_behind_max_wait,
+                    )
+            except asyncio.TimeoutError:
+                await self._insert_direct(collection, doc)
+                return
+
+        stream_id = None
+        if config.mongo.write_behind_spill:
+            try:
+                data = bson.encode(doc, codec_options=_CODEC_OPTIONS)
+                index = _index_key(collection, doc)
+                async with get_pipeline() as pipe:
+                    pipe.xadd(_stream(), {b"c": collection.encode("utf8"), b"d": data})  # type: ignore
+                    if index is not None:
+                        pipe.hset(index, str(doc["_id"]), data)  # type: ignore
+                        pipe.expire(index, _index_expire())  # type: ignore
+                    stream_id = (await pipe.execute())[0]
+            except Exception as e:
+                # 落盘失败时不冒丢数据的风险
+                logger.warning("write behind spill error: " + repr(e))
+                await self._insert_direct(collection, doc)
+                return
+
+        item = PendingDoc(collection, doc, stream_id)
+        self._pending.append(item)
+        self._ids[doc["_id"]] = item
+        self.enqueued += 1
+
+        if len(self._pending) >= config.mongo.write_behind_batch_size:
+            self._wakeup.set()
+
+    async def _insert_direct(self, collection: str, doc: Dict[str, Any]) -> None:
+        self.direct_writes += 1
+        await get_database()[collection].insert_one(doc)  # type: ignore
+
+    def is_pending(self, _id: Any) -> bool:
+        return _id in self._ids
+
+    def find_pending(self, collection: str, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """还没写入 mongo 的文档里按字段相等查找"""
+        return [
+            item.doc
+            for item in self._pending
+            if item.collection == collection
+            and all(item.doc.get(key) == value for key, value in query.items())
+        ]
+
+    async def find_spilled(self, collection: str, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """其他 worker 还没写入 mongo 的文档, 按会话索引查找, 查询条件不带 session_id 时不查"""
+        index = _index_key(collection, query)
+        if index is None:
+            return []
+
+        raw: Dict[bytes, bytes] = await get_redis().hgetall(index)  # type: ignore
+        docs = [bson.decode(data, codec_options=_CODEC_OPTIONS) for data in raw.values()]
+        return [
+            doc for doc in docs
+            if all(doc.get(key) == value for key, value in query.items())
+        ]
+
+    async def _insert_many(self, collection: str, docs: List[Dict[str, Any]]) -> Dict[int, str]:
+        """写入一批, 返回被拒绝的文档下标和原因; 连接或超时错误直接抛出"""
+        try:
+            await get_database()[collection].insert_many(docs, ordered=False)  # type: ignore
+        except BulkWriteError as e:
+            if len(e.details.get("writeConcernErrors", [])) > 0:
+                raise
+            rejected: Dict[int, str] = {}
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") == _DUPLICATE_KEY:
+                    # 补写或重试时已经写入过
+                    self.duplicates += 1
+                else:
+                    rejected[error["index"]] = str(error.get("errmsg"))
+            return rejected
+        except _RETRYABLE:
+            raise
+        except Exception as e:
+            # 整批在发送前就失败 (例如有文档无法编码), 逐条写入找出是哪些
+            if len(docs) == 1:
+                return {0: repr(e)}
+            rejected = {}
+            for index, doc in enumerate(docs):
+                errors = await self._insert_many(collection, [doc])
+                if len(errors) > 0:
+                    rejected[index] = errors[0]
+            return rejected
+        return {}
+
+    async def flush(self, drain: bool = False) -> None:
+        """写入队列头部的一批, drain 为真时写到队列为空"""
+        async with self._flush_lock:
+            while len(self._pending) > 0:
+                batch = list(self._pending)[:config.mongo.write_behind_batch_size]
+
+                by_collection: Dict[str, List[PendingDoc]] = {}
+                for item in batch:
+                    by_collection.setdefault(item.collection, []).append(item)
+
+                started = time.monotonic()
+                rejected: List[PendingDoc] = []
+                try:
+                    for collection, items in by_collection.items():
+                        errors = await self._insert_many(collection, [item.doc for item in items])
+                        for index, error in errors.items():
+                            logger.warning(f"write behind rejected {collection} {items[index].doc['_id']}: {error}")
+                            rejected.append(items[index])
+                except Exception as e:
+                    self.flush_errors += 1
+                    logger.warning("write behind flush error: " + repr(e))
+                    raise
+                self.last_flush_seconds = time.monotonic() - started
+
+                for item in batch:
+                    self._pending.popleft()
+                    self._ids.pop(item.doc["_id"], None)
+                self.batches += 1
+                self.flushed += len(batch) - len(rejected)
+                self.rejected += len(rejected)
+
+                async with self._space:
+                    self._space.notify_all()
+
+                # 被拒绝的文档留在 stream 和索引里, 之后补写时再试一次
+                written = [
+                    item for item in batch
+                    if item.stream_id is not None and item not in rejected
+                ]
+                if len(written) > 0:
+                    try:
+                        async with get_pipeline() as pipe:
+                            pipe.xdel(_stream(), *[item.stream_id for item in written])  # type: ignore
+                            for collection, items in by_collection.items():
+                                _queue_unindex(pipe, collection, [item.doc for item in items if item in written])
+                            await pipe.execute()
+                    except Exception as e:
+                        # 留在 stream 里的条目之后会被重复补写, 按重复键忽略
+                        logger.warning("write behind stream cleanup error: " + repr(e))
+
+                if not drain:
+                    break
+
+    async def recover(self) -> None:
+        """补写其他进程 (或本进程上次运行) 崩溃时留在 stream 里的条目"""
+        if not config.mongo.write_behind_spill:
+            return
+
+        before_ms = int((time.time() - config.mongo.write_behind_recover_after) * 1000)
+        while True:
+            entries: List[Tuple[bytes, Dict[bytes, bytes]]] = await get_redis().xrange(  # type: ignore
+                _stream(), min="-", max=str(before_ms), count=config.mongo.write_behind_batch_size,
+            )
+            if len(entries) == 0:
+                return
+
+            by_collection: Dict[str, List[Tuple[bytes, Dict[bytes, bytes]]]] = {}
+            for entry_id, fields in entries:
+                by_collection.setdefault(fields[b"c"].decode("utf8"), []).append((entry_id, fields))
+
+            dead = 0
+            decoded: Dict[str, List[Dict[str, Any]]] = {}
+            for collection, items in by_collection.items():
+                docs = [bson.decode(fields[b"d"], codec_options=_CODEC_OPTIONS) for _, fields in items]
+                decoded[collection] = docs
+                errors = await self._insert_many(collection, docs)
+                for index, error in errors.items():
+                    entry_id, fields = items[index]
+                    logger.warning(f"write behind dead letter {collection} {entry_id!r}: {error}")
+                    await get_redis().xadd(  # type: ignore
+                        _dead_letter_stream(),
+                        {b"c": fields[b"c"], b"d": fields[b"d"], b"e": error.encode("utf8")},
+                        maxlen=_DEAD_LETTER_MAXLEN,
+                        approximate=True,
+                    )
+                    dead += 1
+            async with get_pipeline() as pipe:
+                pipe.xdel(_stream(), *[entry_id for entry_id, _ in entries])  # type: ignore
+                for collection, docs in decoded.items():
+                    _queue_unindex(pipe, collection, docs)
+                await pipe.execute()
+
+            self.recovered += len(entries) - dead
+            self.dead_lettered += dead
+            logger.info(f"write behind recovered {len(entries)} docs")
+
+    async def _run(self) -> None:
+        interval = config.mongo.write_behind_interval
+        next_recover = time.monotonic()
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 出错的一批留在队列里, 下一轮重试
+                await asyncio.sleep(interval)
+
+            if time.monotonic() >= next_recover:
+                next_recover = time.monotonic() + config.mongo.write_behind_recover_after / 2
+                try:
+                    await self.recover()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning("write behind recover error: " + repr(e))
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """停止后台任务并写完队列里剩下的文档; 写不完的仍在 stream 里, 由之后的补写处理"""
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException:
+                pass
+            self._task = None
+
+        try:
+            await self.flush(drain=True)
+        except Exception as e:
+            logger.warning(f"write behind left {len(self._pending)} docs on shutdown: {e!r}")
+
+    def stats(self) -> dict:
+        return dict(
+            running=self.running,
+            pending=len(self._pending),
+            enqueued=self.enqueued,
+            flushed=self.flushed,
+            batches=self.batches,
+            flush_errors=self.flush_errors,
+            duplicates=self.duplicates,
+            rejected=self.rejected,
+            dead_lettered=self.dead_lettered,
+            recovered=self.recovered,
+            backpressure_waits=self.backpressure_waits,
+            direct_writes=self.direct_writes,
+            last_flush_seconds=self.last_flush_seconds,
+        )
+
+
+_queue: Optional[WriteBehindQueue] = None
+
+
+def get_write_behind() -> Optional[WriteBehindQueue]:
+    return _queue
+
+
+def start_write_behind() -> None:
+    global _queue
+    if not config.mongo.write_behind:
+        return
+    if _queue is None:
+        _queue = WriteBehindQueue()
+        register_collector("write_behind", _queue.stats)
+    _queue.start()
+
+
+async def stop_write_behind() -> None:
+    if _queue is not None:
+        await _queue.stop()
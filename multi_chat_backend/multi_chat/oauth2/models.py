@@ -1,4 +1,6 @@
-from typing import Union
+from typing import List, Union
+
+from pymongo import ASCENDING, IndexModel
 
 from ..mongo import MongoModel
 
@@ -11,3 +13,9 @@ class User(MongoModel):
     @classmethod
     def collection_name(cls) -> str:
         return "user"
+
+    @classmethod
+    def indexes(cls) -> List[IndexModel]:
+        return [
+            IndexModel([("username", ASCENDING)], unique=True),
+        ]
@@ -1,22 +1,113 @@
-from typing import Optional
+import asyncio
+from typing import Dict, Optional
 
-from aredis import StrictRedis
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.client import Pipeline
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError
 
 from multi_chat import config
 
-_client: Optional[StrictRedis] = None
+from ..metrics import count_round_trip, register_collector
+
+_client: Optional[Redis] = None
+
+
+class CountingConnectionPool(BlockingConnectionPool):
+    """连接用满时等待其他请求归还, 而不是无限新建; 统计借出数和等待时间"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # 借出的连接 id -> 借出时间; 包内有 set 子模块, 这里不能用内置 set()
+        self._held: Dict[int, float] = {}
+        self.peak_in_use = 0
+        self.acquired = 0
+        # 等连接超时或建立连接失败
+        self.failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            self.failures += 1
+            raise
+
+        # 每条命令或每个 pipeline 借一次连接, 即一次往返
+        count_round_trip("redis")
+        waited = loop.time() - started
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self._held[id(connection)] = loop.time()
+        self.peak_in_use = max(self.peak_in_use, len(self._held))
+        return connection
+
+    async def release(self, connection) -> None:
+        self._held.pop(id(connection), None)
+        await super().release(connection)
+
+    def stats(self) -> dict:
+        return dict(
+            max_connections=self.max_connections,
+            in_use=len(self._held),
+            peak_in_use=self.peak_in_use,
+            utilisation=len(self._held) / self.max_connections,
+            acquired=self.acquired,
+            failures=self.failures,
+            wait_avg=self.wait_total / self.acquired if self.acquired > 0 else None,
+            wait_max=self.wait_max,
+        )
+
 
 async def create_connection():
     global _client
-    _client = StrictRedis.from_url(
+
+    retry = None
+    if config.redis.retries > 0:
+        retry = Retry(
+            ExponentialBackoff(cap=config.redis.retry_max_delay, base=config.redis.retry_base_delay),
+            config.redis.retries,
+        )
+
+    pool = CountingConnectionPool.from_url(
         url=config.redis.redis_url,
-        decode_responses=False
+        max_connections=config.redis.max_connections,
+        timeout=config.redis.pool_timeout,
+        socket_timeout=config.redis.socket_timeout,
+        socket_connect_timeout=config.redis.socket_connect_timeout,
+        socket_keepalive=True,
+        retry_on_timeout=config.redis.retry_on_timeout,
+        retry=retry,
+        health_check_interval=config.redis.health_check_interval,
+        decode_responses=False,
     )
+    _client = Redis(connection_pool=pool)
+
+    register_collector("redis_pool", pool.stats)
+
 
-def get_database() -> StrictRedis:
+async def close_connection():
+    global _client
+    if _client is None:
+        return
+    await _client.connection_pool.disconnect()
+    _client = None
+
+
+def get_database() -> Redis:
     if _client is None:
         raise ValueError("Redis connection has not been initialized.")
     return _client
 
+
+def get_pipeline(transaction: bool = False) -> Pipeline:
+    """批量命令一次往返发送, 默认不包 MULTI/EXEC"""
+    return get_database().pipeline(transaction=transaction)
+
 from .cache import RedisCache
 from .set import RedisSet
@@ -1,38 +1,88 @@
-from typing import Any, Generic, Optional, TypeVar, get_args
+from typing import Any, Dict, Generic, List, Optional, TypeVar, Union, get_args
 
-from pydantic import BaseModel, parse_raw_as
+from pydantic import BaseModel
 from pydantic.generics import GenericModel
 
 from multi_chat import config
 
-from . import get_database
+from . import get_database, get_pipeline
+from .codec import LEGACY, Codec
+from .local import (LocalCache, get_local_cache, is_missing,
+                    publish_invalidation, publish_invalidations)
+from .lock import LockLostError
 
 T = TypeVar("T", bound=BaseModel)
 
+# 带 fencing token 的写入: 比已写入的 token 小说明是过期的锁持有者, 拒绝写入
+# KEYS[1] 值 KEYS[2] 已写入的 token ARGV[1] 值 ARGV[2] token ARGV[3] 过期秒数 (0 不过期)
+_FENCED_SET_SCRIPT = """
+local stored = tonumber(redis.call('GET', KEYS[2]) or '0')
+if tonumber(ARGV[2]) < stored then
+    return 0
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[3]))
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', tonumber(ARGV[3]))
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+    redis.call('SET', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
 
 class RedisCache(Generic[T], GenericModel):
 
     _type_T: Any
+    # 大于 0 时在 redis 前面加一层进程内缓存 (LRU, 写入时同时更新), 其他 worker 写入时通过 pub/sub 失效
+    _local_ttl: float = 0
+    _local: Optional[LocalCache] = None
+    # 值的编码, 默认保持原来的 json 格式
+    _codec: Codec = LEGACY
 
     def __init_subclass__(cls) -> None:
         cls._type_T = get_args(cls.__orig_bases__[0])[0]  # type: ignore
+        cls._local = get_local_cache(cls.__name__, cls._local_ttl) if cls._local_ttl > 0 else None
 
     @classmethod
     def format_key(cls, key: str) -> str:
         return config.redis.redis_prefix + ":" + str(cls.__name__) + "__" + key
 
     @classmethod
-    async def get(cls, key: str) -> Optional[T]: # type: ignore
+    async def get(cls, key: str, local: bool = True) -> Optional[T]: # type: ignore
+        if local and cls._local is not None:
+            value = cls._local.get(key)
+            if not is_missing(value):
+                return cls._copy(value)
+
+        since = cls._local.mark() if cls._local is not None else 0
         obj = await get_database().get(cls.format_key(key)) # type: ignore
-        return parse_raw_as(cls._type_T, obj, encoding="utf8") if obj else None   # type: ignore
+        value = cls._codec.decode(cls._type_T, obj) if obj else None
+
+        if cls._local is not None:
+            cls._local.record_remote(value is not None)
+            cls._local.set(key, cls._copy(value), since)
+        return value
+
+    @staticmethod
+    def _copy(value: Optional[T]) -> Optional[T]:
+        # 进程内缓存的对象不交给调用方, 避免调用方修改后影响缓存; 深拷贝, cookies 这类字典也不共用
+        return value.copy(deep=True) if value is not None else None
     
     @classmethod
     async def exists(cls, key: str) -> bool:
         return await get_database().exists(cls.format_key(key)) # type: ignore
 
+    @classmethod
+    async def ttl(cls, key: str) -> int:
+        return await get_database().ttl(cls.format_key(key)) # type: ignore
+
     @classmethod
     async def delete(cls, key: str) -> bool:
-        return await get_database().execute_command("del", cls.format_key(key)) # type: ignore
+        result = await get_database().execute_command("del", cls.format_key(key)) # type: ignore
+        if cls._local is not None:
+            await publish_invalidation(cls.__name__, key)
+        return result
         
     @classmethod
     async def set(
@@ -40,5 +90,97 @@ class RedisCache(Generic[T], GenericModel):
         key: str, 
         value: T,
         ex: Optional[int] = None,
+        fence: Optional[int] = None,
     ):
-        await get_database().set(cls.format_key(key), value.json().encode(encoding="utf8"), ex=ex) # type: ignore
+        """fence 为 RedisSemaphore.fence, 比之前写入的小时抛 LockLostError, 不覆盖新持有者的值"""
+        since = cls._local.mark() if cls._local is not None else 0
+        if fence is None:
+            await get_database().set(cls.format_key(key), cls._codec.encode(value), ex=ex) # type: ignore
+        else:
+            written = await get_database().eval( # type: ignore
+                _FENCED_SET_SCRIPT,
+                2,
+                cls.format_key(key),
+                cls.format_key(key) + ":fence",
+                cls._codec.encode(value),
+                fence,
+                ex or 0,
+            )
+            if int(written) == 0:
+                raise LockLostError(f"{cls.__name__} {key} was written by a newer lock holder, fence {fence}")
+        if cls._local is not None:
+            await publish_invalidation(cls.__name__, key)
+            # 同一个会话的下一轮通常落在同一个 worker, 写入的值直接留在本地
+            cls._local.set(key, cls._copy(value), since, ttl=ex)
+
+    @classmethod
+    async def get_many(cls, keys: List[str], local: bool = True) -> List[Optional[T]]:
+        """一次 MGET 取多个 key, 结果顺序与 keys 一致"""
+        values: List[Optional[T]] = [None] * len(keys)
+        remote_idx: List[int] = []
+
+        for idx, key in enumerate(keys):
+            if local and cls._local is not None:
+                value = cls._local.get(key)
+                if not is_missing(value):
+                    values[idx] = cls._copy(value)
+                    continue
+            remote_idx.append(idx)
+
+        if len(remote_idx) == 0:
+            return values
+
+        since = cls._local.mark() if cls._local is not None else 0
+        objs = await get_database().mget([cls.format_key(keys[idx]) for idx in remote_idx]) # type: ignore
+        for idx, obj in zip(remote_idx, objs):
+            value = cls._codec.decode(cls._type_T, obj) if obj else None
+            values[idx] = value
+
+            if cls._local is not None:
+                cls._local.record_remote(value is not None)
+                cls._local.set(keys[idx], cls._copy(value), since)
+
+        return values
+
+    @classmethod
+    async def set_many(
+        cls,
+        items: Dict[str, T],
+        ex: Union[None, int, Dict[str, Optional[int]]] = None,
+    ) -> None:
+        """用 pipeline 一次写入多个 key, ex 可以是统一的过期秒数, 也可以按 key 指定"""
+        if len(items) == 0:
+            return
+
+        since = cls._local.mark() if cls._local is not None else 0
+        async with get_pipeline() as pipe:
+            for key, value in items.items():
+                key_ex = ex.get(key) if isinstance(ex, dict) else ex
+                pipe.set(cls.format_key(key), cls._codec.encode(value), ex=key_ex) # type: ignore
+            await pipe.execute()
+
+        if cls._local is not None:
+            await publish_invalidations(cls.__name__, list(items.keys()))
+            for key, value in items.items():
+                key_ex = ex.get(key) if isinstance(ex, dict) else ex
+                cls._local.set(key, cls._copy(value), since, ttl=key_ex)
+
+    @classmethod
+    async def exists_many(cls, keys: List[str]) -> List[bool]:
+        if len(keys) == 0:
+            return []
+
+        async with get_pipeline() as pipe:
+            for key in keys:
+                pipe.exists(cls.format_key(key)) # type: ignore
+            return [bool(result) for result in await pipe.execute()]
+
+    @classmethod
+    async def delete_many(cls, keys: List[str]) -> int:
+        if len(keys) == 0:
+            return 0
+
+        result = await get_database().delete(*[cls.format_key(key) for key in keys]) # type: ignore
+        if cls._local is not None:
+            await publish_invalidations(cls.__name__, keys)
+        return result
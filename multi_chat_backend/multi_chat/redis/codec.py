@@ -0,0 +1,119 @@
+import zlib
+from typing import Any, Dict, Optional, Type
+
+import orjson
+from pydantic import BaseModel, parse_raw_as
+from pydantic.json import pydantic_encoder
+
+from multi_chat import config
+
+# 新格式的值以 4 字节头开始: 0x00, 格式版本, 编码 id, 标志位
+# 旧格式 (pydantic .json()) 以 '{' 等可见字符开头, 读的时候按首字节区分, 新旧 worker 可以同时运行
+_MAGIC = 0x00
+_VERSION = 1
+_FLAG_ZLIB = 0x01
+
+
+def _construct(model_type: Type[BaseModel], data: Any) -> Any:
+    """不校验直接构造, 嵌套的模型同样处理"""
+    if not isinstance(data, dict):
+        return data
+
+    values = {}
+    for name, field in model_type.__fields__.items():
+        key = field.alias if field.alias in data else name
+        if key not in data:
+            continue
+        value = data[key]
+        if (
+            isinstance(field.type_, type)
+            and issubclass(field.type_, BaseModel)
+            and field.shape == 1  # SHAPE_SINGLETON
+        ):
+            value = _construct(field.type_, value)
+        values[name] = value
+    return model_type.construct(**values)
+
+
+class Codec:
+    """值的序列化方式, 每个 RedisCache/RedisSet 子类通过 _codec 选择"""
+
+    codec_id = 0
+
+    def dumps(self, value: BaseModel) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, model_type: Any, body: bytes) -> Any:
+        raise NotImplementedError
+
+    def encode(self, value: BaseModel) -> bytes:
+        return self.dumps(value)
+
+    def decode(self, model_type: Any, data: bytes) -> Any:
+        if len(data) == 0 or data[0] != _MAGIC:
+            return LEGACY.loads(model_type, data)
+
+        if len(data) < 4 or data[1] > _VERSION:
+            raise ValueError(f"unsupported redis value format: version {data[1] if len(data) > 1 else None}")
+
+        # 本类的编码按本类的设置读, 其他编码 (例如切换过编码) 用默认设置读
+        codec = self if data[2] == self.codec_id else _codecs.get(data[2])
+        if codec is None:
+            raise ValueError(f"unsupported redis value codec: {data[2]}")
+
+        body = data[4:]
+        if data[3] & _FLAG_ZLIB:
+            body = zlib.decompress(body)
+        return codec.loads(model_type, body)
+
+
+class LegacyJSONCodec(Codec):
+    """原来的格式: pydantic .json(), 读时完整校验"""
+
+    def dumps(self, value: BaseModel) -> bytes:
+        return value.json().encode(encoding="utf8")
+
+    def loads(self, model_type: Any, body: bytes) -> Any:
+        return parse_raw_as(model_type, body, encoding="utf8")
+
+
+class OrjsonCodec(Codec):
+    """orjson 编码, trusted 时读取跳过校验 (只用于本服务自己写入的值), 超过 compress_min_bytes 时 zlib 压缩"""
+
+    codec_id = 1
+
+    def __init__(self, trusted: bool = False, compress_min_bytes: Optional[int] = None) -> None:
+        self.trusted = trusted
+        self.compress_min_bytes = compress_min_bytes
+
+    def dumps(self, value: BaseModel) -> bytes:
+        # 按模型自己的 json_encoders 处理 orjson 不认识的类型 (例如 ObjectId)
+        return orjson.dumps(value.dict(), default=getattr(value, "__json_encoder__", pydantic_encoder))
+
+    def loads(self, model_type: Any, body: bytes) -> Any:
+        data = orjson.loads(body)
+        if self.trusted and isinstance(model_type, type) and issubclass(model_type, BaseModel):
+            return _construct(model_type, data)
+        if isinstance(model_type, type) and issubclass(model_type, BaseModel):
+            return model_type.parse_obj(data)
+        return parse_raw_as(model_type, body)
+
+    def encode(self, value: BaseModel) -> bytes:
+        # 兼容模式: 还有旧 worker 在跑时继续写旧格式
+        if config.redis.codec_compat:
+            return LEGACY.encode(value)
+
+        body = self.dumps(value)
+        flags = 0
+        if self.compress_min_bytes is not None and len(body) >= self.compress_min_bytes:
+            body = zlib.compress(body)
+            flags |= _FLAG_ZLIB
+        return bytes((_MAGIC, _VERSION, self.codec_id, flags)) + body
+
+
+LEGACY = LegacyJSONCodec()
+
+# 各编码 id 的默认实现 (读取时校验)
+_codecs: Dict[int, Codec] = {
+    OrjsonCodec.codec_id: OrjsonCodec(),
+}
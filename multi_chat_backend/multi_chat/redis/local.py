@@ -0,0 +1,292 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+from . import get_database, get_pipeline
+
+# 进程内缓存按名字注册, 失效消息 "<进程标识>\n<名字>\n<key>" 通过 redis pub/sub 广播给所有 worker
+_local_caches: Dict[str, "LocalCache"] = {}
+
+# 订阅连接正常时才使用进程内缓存, 断线期间可能漏掉失效消息
+_bus_connected = False
+_listener: Optional[asyncio.Task] = None
+
+_MISSING = object()
+
+# 本进程的标识, 订阅时忽略自己发出的失效消息, 避免刚写入的值被自己的回声清掉
+_origin = uuid4().hex
+
+# 远端失效记录保留的 key 数, 超出后更早的记录按一次整体失效处理
+_RECENT_SIZE = 1024
+
+
+def _channel() -> str:
+    return config.redis.redis_prefix + ":invalidate"
+
+
+class LocalCache:
+    """进程内的 LRU + TTL 缓存, 作为 redis 缓存前面的第一级
+
+    从 redis 读取或写入 redis 之前先 mark() 取序号, 之后 set(..., since=序号);
+    期间其他 worker 对该 key 的失效消息到达过就不写入, 避免把旧值缓存下来.
+    """
+
+    def __init__(self, name: str, ttl: float, max_size: Optional[int] = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.max_size = config.redis.local_cache_max_size if max_size is None else max_size
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+        # 远端失效的序号: 最近失效的 key -> 序号, 以及更早的失效 (整体清空或记录被挤出) 的序号
+        self._seq = 0
+        self._recent: "OrderedDict[str, int]" = OrderedDict()
+        self._floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.remote_invalidations = 0
+        self.stale_skips = 0
+        # 第二级 (redis) 的命中情况
+        self.remote_hits = 0
+        self.remote_misses = 0
+
+        # 最近一分钟的失效次数, 用于算失效速率
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._last_rate: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and _bus_connected
+
+    def mark(self) -> int:
+        return self._seq
+
+    def get(self, key: str) -> Any:
+        """未命中返回 _MISSING, 缓存的值可以是 None"""
+        if not self.enabled:
+            return _MISSING
+
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: str, value: Any, since: int, ttl: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+
+        if since < self._floor or self._recent.get(key, 0) > since:
+            self.stale_skips += 1
+            return
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def record_remote(self, hit: bool) -> None:
+        if hit:
+            self.remote_hits += 1
+        else:
+            self.remote_misses += 1
+
+    def _count_invalidation(self) -> None:
+        self.invalidations += 1
+
+        now = time.monotonic()
+        if now - self._window_start >= 60:
+            self._last_rate = self._window_count / (now - self._window_start)
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+
+    def invalidate(self, key: Optional[str] = None, remote: bool = False) -> None:
+        self._count_invalidation()
+
+        if remote:
+            self.remote_invalidations += 1
+            self._seq += 1
+            if key is None:
+                self._floor = self._seq
+                self._recent.clear()
+            else:
+                self._recent[key] = self._seq
+                self._recent.move_to_end(key)
+                while len(self._recent) > _RECENT_SIZE:
+                    _, seq = self._recent.popitem(last=False)
+                    self._floor = max(self._floor, seq)
+
+        if key is None:
+            self._items.clear()
+        else:
+            self._items.pop(key, None)
+
+    def invalidation_rate(self) -> Optional[float]:
+        """每秒失效次数, 取最近一个完整的一分钟窗口, 还没有完整窗口时用当前窗口"""
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= 60 or self._last_rate is None:
+            return self._window_count / elapsed if elapsed > 0 else None
+        return self._last_rate
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        remote_total = self.remote_hits + self.remote_misses
+        return dict(
+            size=len(self._items),
+            max_size=self.max_size,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+            remote_invalidations=self.remote_invalidations,
+            invalidation_rate=self.invalidation_rate(),
+            stale_skips=self.stale_skips,
+            local=dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / total if total > 0 else None,
+            ),
+            redis=dict(
+                hits=self.remote_hits,
+                misses=self.remote_misses,
+                hit_rate=self.remote_hits / remote_total if remote_total > 0 else None,
+            ),
+        )
+
+
+def get_local_cache(name: str, ttl: float) -> LocalCache:
+    cache = _local_caches.get(name)
+    if cache is None:
+        cache = LocalCache(name, ttl)
+        _local_caches[name] = cache
+    return cache
+
+
+def is_missing(value: Any) -> bool:
+    return value is _MISSING
+
+
+def _message(name: str, key: str) -> str:
+    return _origin + "\n" + name + "\n" + key
+
+
+async def publish_invalidation(name: str, key: str) -> None:
+    """写 redis 之后调用: 本进程立即失效, 其他 worker 通过订阅失效"""
+    cache = _local_caches.get(name)
+    if cache is None:
+        return
+    cache.invalidate(key)
+    await get_database().publish(_channel(), _message(name, key))  # type: ignore
+
+
+async def publish_invalidations(name: str, keys: List[str]) -> None:
+    cache = _local_caches.get(name)
+    if cache is None or len(keys) == 0:
+        return
+    for key in keys:
+        cache.invalidate(key)
+
+    async with get_pipeline() as pipe:
+        for key in keys:
+            pipe.publish(_channel(), _message(name, key))  # type: ignore
+        await pipe.execute()
+
+
+def queue_invalidation(pipe: Any, name: str, key: str) -> None:
+    """失效消息和写入放进同一个 pipeline, 省掉单独 PUBLISH 的一次往返"""
+    cache = _local_caches.get(name)
+    if cache is None:
+        return
+    cache.invalidate(key)
+    pipe.publish(_channel(), _message(name, key))  # type: ignore
+
+
+def _clear_all() -> None:
+    for cache in _local_caches.values():
+        cache.invalidate(remote=True)
+
+
+async def _listen() -> None:
+    global _bus_connected
+
+    while True:
+        pubsub = get_database().pubsub()
+        try:
+            await pubsub.subscribe(_channel())
+            # 订阅前可能已有更新, 从空缓存开始
+            _clear_all()
+            _bus_connected = True
+            logger.info("local cache invalidation bus connected")
+
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode("utf8")
+                parts = data.split("\n", 2)
+                if len(parts) == 3:
+                    origin, name, key = parts
+                    if origin == _origin:
+                        continue
+                else:
+                    # 旧格式 "<名字>\n<key>"
+                    name, _, key = data.partition("\n")
+
+                cache = _local_caches.get(name)
+                if cache is not None:
+                    cache.invalidate(key, remote=True)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("local cache invalidation bus error: " + repr(e))
+        finally:
+            _bus_connected = False
+            _clear_all()
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+        await asyncio.sleep(1.0)
+
+
+def start_invalidation_listener() -> None:
+    global _listener
+    if _listener is None or _listener.done():
+        _listener = asyncio.ensure_future(_listen())
+
+
+async def stop_invalidation_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except BaseException:
+            pass
+        _listener = None
+
+
+register_collector(
+    "local_cache",
+    lambda: dict(
+        bus_connected=_bus_connected,
+        caches={name: cache.stats() for name, cache in _local_caches.items()},
+    ),
+)
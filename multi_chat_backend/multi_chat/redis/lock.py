@@ -0,0 +1,240 @@
+import asyncio
+import math
+import time
+from typing import Dict, Optional
+from uuid import uuid4
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+from . import get_database
+
+# 分布式信号量, 使用共享的 redis 连接池:
+#   {prefix}:Lock:{name}:holders  zset, 成员为持有者 id, 分数为租约到期毫秒
+#   {prefix}:Lock:{name}:fence    递增计数, 每次获取分配一个 fencing token
+#   {prefix}:Lock:{name}:wake     释放时 LPUSH, 等待者 BLPOP 阻塞等待而不是轮询
+
+# 获取: 成功返回 {1, fencing token}, 已满返回 {0, 最早到期的租约毫秒}
+# ARGV[1] key 前缀 ARGV[2] 持有者 id ARGV[3] 当前毫秒 ARGV[4] 租约毫秒 ARGV[5] 容量
+_ACQUIRE_SCRIPT = """
+local holders = ARGV[1] .. ':holders'
+local now = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+
+if redis.call('ZCARD', holders) < tonumber(ARGV[5]) then
+    redis.call('ZADD', holders, now + tonumber(ARGV[4]), ARGV[2])
+    redis.call('PEXPIRE', holders, tonumber(ARGV[4]))
+    local fence = redis.call('INCR', ARGV[1] .. ':fence')
+    return {1, fence}
+end
+
+local first = redis.call('ZRANGE', holders, 0, 0, 'WITHSCORES')
+return {0, tonumber(first[2])}
+"""
+
+# 续租: 仍持有时延长租约返回 1, 已丢失返回 0
+# ARGV[1] key 前缀 ARGV[2] 持有者 id ARGV[3] 当前毫秒 ARGV[4] 租约毫秒
+_RENEW_SCRIPT = """
+local holders = ARGV[1] .. ':holders'
+local score = redis.call('ZSCORE', holders, ARGV[2])
+if not score or tonumber(score) < tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', holders, tonumber(ARGV[3]) + tonumber(ARGV[4]), ARGV[2])
+if redis.call('PTTL', holders) < tonumber(ARGV[4]) then
+    redis.call('PEXPIRE', holders, tonumber(ARGV[4]))
+end
+return 1
+"""
+
+# 释放并唤醒一个等待者
+# ARGV[1] key 前缀 ARGV[2] 持有者 id ARGV[3] 容量
+_RELEASE_SCRIPT = """
+local removed = redis.call('ZREM', ARGV[1] .. ':holders', ARGV[2])
+if removed == 1 then
+    local wake = ARGV[1] .. ':wake'
+    redis.call('LPUSH', wake, 1)
+    redis.call('LTRIM', wake, 0, tonumber(ARGV[3]) - 1)
+    redis.call('PEXPIRE', wake, 60000)
+end
+return removed
+"""
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+class LockLostError(Exception):
+    """租约过期被别人拿走, 不能再以持有者身份写入"""
+
+
+class LockStats:
+    def __init__(self) -> None:
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.lost = 0
+        self.renewals = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def dict(self) -> dict:
+        return dict(
+            acquired=self.acquired,
+            contended=self.contended,
+            timeouts=self.timeouts,
+            lost=self.lost,
+            renewals=self.renewals,
+            wait_avg=self.wait_total / self.acquired if self.acquired > 0 else None,
+            wait_max=self.wait_max,
+        )
+
+
+_stats: Dict[str, LockStats] = {}
+
+
+class RedisSemaphore:
+    """基于共享连接池的分布式信号量, capacity=1 时即互斥锁
+
+    持有期间后台按 lease/3 的间隔续租, 长时间的流式请求不会因租约到期被别人拿走;
+    进程崩溃时租约到期自动释放. 每次获取得到单调递增的 fencing token (self.fence),
+    受保护的写入带上它 (RedisCache.set 的 fence 参数), 暂停后过期的持有者的写入会被拒绝.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int = 1,
+        lease: Optional[float] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.lease = config.redis.lock_lease_seconds if lease is None else lease
+        self.timeout = config.redis.lock_wait_seconds if timeout is None else timeout
+
+        self.holder = uuid4().hex
+        self.fence: Optional[int] = None
+        self.lost = False
+        self._renew_task: Optional[asyncio.Task] = None
+
+    def _prefix(self) -> str:
+        return config.redis.redis_prefix + ":Lock:" + self.name
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    def _stats(self) -> LockStats:
+        stats = _stats.get(self.name)
+        if stats is None:
+            stats = LockStats()
+            _stats[self.name] = stats
+        return stats
+
+    async def acquire(self) -> int:
+        stats = self._stats()
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        deadline = started + self.timeout
+        lease_ms = int(self.lease * 1000)
+        contended = False
+
+        while True:
+            now_ms = self._now_ms()
+            result = await get_database().eval(  # type: ignore
+                _ACQUIRE_SCRIPT,
+                0,
+                self._prefix(),
+                self.holder,
+                now_ms,
+                lease_ms,
+                self.capacity,
+            )
+
+            if int(result[0]) == 1:
+                self.fence = int(result[1])
+                self.lost = False
+                waited = loop.time() - started
+                stats.acquired += 1
+                stats.wait_total += waited
+                stats.wait_max = max(stats.wait_max, waited)
+                if contended:
+                    stats.contended += 1
+                self._renew_task = asyncio.ensure_future(self._renew_loop())
+                return self.fence
+
+            contended = True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                stats.timeouts += 1
+                raise LockTimeoutError(f"{self.name} wait exceeded {self.timeout}s")
+
+            # 等释放通知, 最迟等到最早的租约到期 (持有者崩溃时不会有通知)
+            expire_in = max(int(result[1]) - now_ms, 0) / 1000
+            # BLPOP 在 redis 5 上只支持整数秒
+            block = max(1, math.ceil(min(remaining, expire_in)))
+            # 阻塞时间要小于连接的读超时, 否则会被当成超时断开
+            if config.redis.socket_timeout is not None:
+                block = min(block, max(1, math.floor(config.redis.socket_timeout) - 1))
+            await get_database().blpop(self._prefix() + ":wake", timeout=block)  # type: ignore
+
+    async def _renew_loop(self) -> None:
+        interval = self.lease / 3
+        stats = self._stats()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                renewed = await get_database().eval(  # type: ignore
+                    _RENEW_SCRIPT,
+                    0,
+                    self._prefix(),
+                    self.holder,
+                    self._now_ms(),
+                    int(self.lease * 1000),
+                )
+            except Exception as e:
+                logger.warning(f"{self.name} lock renew error: {e!r}")
+                continue
+
+            if int(renewed) == 1:
+                stats.renewals += 1
+            else:
+                self.lost = True
+                stats.lost += 1
+                logger.warning(f"{self.name} lock lease lost, fence {self.fence}")
+                return
+
+    def ensure_held(self) -> None:
+        """写入受锁保护的数据前调用, 只检查本地续租结果; 写入本身由 fencing token 保证"""
+        if self.lost:
+            raise LockLostError(f"{self.name} lock lease lost, fence {self.fence}")
+
+    async def release(self) -> None:
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            try:
+                await self._renew_task
+            except BaseException:
+                pass
+            self._renew_task = None
+
+        await get_database().eval(  # type: ignore
+            _RELEASE_SCRIPT,
+            0,
+            self._prefix(),
+            self.holder,
+            self.capacity,
+        )
+
+    async def __aenter__(self) -> "RedisSemaphore":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        # 取消时也要释放, 避免等到租约到期
+        await asyncio.shield(self.release())
+
+
+register_collector("locks", lambda: {name: stats.dict() for name, stats in _stats.items()})
@@ -1,11 +1,14 @@
-from typing import Any, Generic, TypeVar, get_args
+from typing import Any, Generic, List, Optional, TypeVar, get_args
 
-from pydantic import BaseModel, parse_raw_as
+from pydantic import BaseModel
 from pydantic.generics import GenericModel
 
 from multi_chat import config
 
-from . import get_database
+from . import get_database, get_pipeline
+from .codec import LEGACY, Codec
+from .local import (LocalCache, get_local_cache, is_missing,
+                    publish_invalidation, publish_invalidations)
 
 T = TypeVar("T", bound=BaseModel)
 
@@ -13,25 +16,110 @@ T = TypeVar("T", bound=BaseModel)
 class RedisSet(Generic[T], GenericModel):
 
     _type_T: Any
+    # 大于 0 时 exists 的结果在进程内缓存, 增删时通过 pub/sub 失效
+    _local_ttl: float = 0
+    _local: Optional[LocalCache] = None
+    # 成员的编码即成员本身, 换编码等于换了一批成员, 所有 worker 必须一致, 一般保持默认
+    _codec: Codec = LEGACY
 
     def __init_subclass__(cls) -> None:
         cls._type_T = get_args(cls.__orig_bases__[0])[0]  # type: ignore
+        cls._local = get_local_cache(cls.__name__, cls._local_ttl) if cls._local_ttl > 0 else None
 
     @classmethod
     def get_key(cls) -> str:
         return config.redis.redis_prefix + ":" + str(cls.__name__)
 
+    @classmethod
+    def format_item(cls, item: T) -> bytes:
+        return cls._codec.encode(item)
+
     @classmethod
     async def add(cls, item: T) -> bool:
-        return await get_database().sadd(cls.get_key(), item.json().encode(encoding="utf8")) # type: ignore
+        member = cls.format_item(item)
+        result = await get_database().sadd(cls.get_key(), member) # type: ignore
+        if cls._local is not None:
+            await publish_invalidation(cls.__name__, member.decode("utf8"))
+        return result
     
     @classmethod
     async def remove(cls, item: T) -> bool:
-        return await get_database().srem(cls.get_key(), item.json().encode(encoding="utf8")) # type: ignore
+        member = cls.format_item(item)
+        result = await get_database().srem(cls.get_key(), member) # type: ignore
+        if cls._local is not None:
+            await publish_invalidation(cls.__name__, member.decode("utf8"))
+        return result
 
     @classmethod
     async def exists(cls, item: T) -> bool:
-        return await get_database().sismember(cls.get_key(), item.json().encode(encoding="utf8")) # type: ignore
+        member = cls.format_item(item)
+
+        if cls._local is not None:
+            value = cls._local.get(member.decode("utf8"))
+            if not is_missing(value):
+                return value
+
+        since = cls._local.mark() if cls._local is not None else 0
+        result = bool(await get_database().sismember(cls.get_key(), member)) # type: ignore
+
+        if cls._local is not None:
+            # 集合的成员判断总有结果, 按命中计
+            cls._local.record_remote(True)
+            cls._local.set(member.decode("utf8"), result, since)
+        return result
+
+    @classmethod
+    async def add_many(cls, items: List[T]) -> int:
+        """一次 SADD 添加多个成员, 返回新增的数量"""
+        if len(items) == 0:
+            return 0
+
+        members = [cls.format_item(item) for item in items]
+        result = await get_database().sadd(cls.get_key(), *members) # type: ignore
+        if cls._local is not None:
+            await publish_invalidations(cls.__name__, [member.decode("utf8") for member in members])
+        return result
+
+    @classmethod
+    async def remove_many(cls, items: List[T]) -> int:
+        if len(items) == 0:
+            return 0
+
+        members = [cls.format_item(item) for item in items]
+        result = await get_database().srem(cls.get_key(), *members) # type: ignore
+        if cls._local is not None:
+            await publish_invalidations(cls.__name__, [member.decode("utf8") for member in members])
+        return result
+
+    @classmethod
+    async def exists_many(cls, items: List[T]) -> List[bool]:
+        """用 pipeline 一次判断多个成员, 结果顺序与 items 一致"""
+        members = [cls.format_item(item) for item in items]
+        results: List[Optional[bool]] = [None] * len(members)
+        remote_idx: List[int] = []
+
+        for idx, member in enumerate(members):
+            if cls._local is not None:
+                value = cls._local.get(member.decode("utf8"))
+                if not is_missing(value):
+                    results[idx] = value
+                    continue
+            remote_idx.append(idx)
+
+        if len(remote_idx) > 0:
+            since = cls._local.mark() if cls._local is not None else 0
+            async with get_pipeline() as pipe:
+                for idx in remote_idx:
+                    pipe.sismember(cls.get_key(), members[idx]) # type: ignore
+                remote_results = await pipe.execute()
+
+            for idx, result in zip(remote_idx, remote_results):
+                results[idx] = bool(result)
+                if cls._local is not None:
+                    cls._local.record_remote(True)
+                    cls._local.set(members[idx].decode("utf8"), bool(result), since)
+
+        return [bool(result) for result in results]
 
     @classmethod
     async def count(cls) -> int:
@@ -40,6 +128,6 @@ class RedisSet(Generic[T], GenericModel):
     @classmethod
     async def random_get(cls) -> T:   # type: ignore
         obj = await get_database().srandmember(cls.get_key()) # type: ignore
-        return parse_raw_as(cls._type_T, obj, encoding="utf8") if obj else None   # type: ignore
+        return cls._codec.decode(cls._type_T, obj) if obj else None   # type: ignore
 
 
@@ -0,0 +1,100 @@
+from typing import Any, Dict, Optional, Set, Type
+from uuid import UUID
+
+from pydantic import BaseModel
+
+from multi_chat import config
+
+from ..redis import get_database, get_pipeline
+from ..redis.codec import OrjsonCodec
+from ..redis.local import get_local_cache, is_missing, queue_invalidation
+
+# 每个会话一个 redis hash, 通用对话层和各后端各占一个字段, 一次 HGETALL 读出, 一次 MULTI 写回
+# 字段由各层自己注册, 这里不依赖具体后端
+_fields: Dict[str, Type[BaseModel]] = {}
+
+# 允许存活时间10分钟
+STATE_EXPIRE = 600
+
+_codec = OrjsonCodec()
+_local = (
+    get_local_cache("SessionState", config.redis.dialog_state_local_ttl)
+    if config.redis.dialog_state_local_ttl > 0
+    else None
+)
+
+
+def register_field(name: str, model: Type[BaseModel]) -> None:
+    _fields[name] = model
+
+
+def _key(session_id: UUID) -> str:
+    return config.redis.redis_prefix + ":SessionState__" + str(session_id)
+
+
+class SessionState:
+    """一个会话的最新状态, 在一轮对话内由各层共享, 结束时 commit 一次写回"""
+
+    def __init__(self, session_id: UUID, values: Optional[Dict[str, Any]] = None, since: Optional[int] = None) -> None:
+        self.session_id = session_id
+        self._values: Dict[str, Any] = dict(values) if values is not None else {}
+        self._dirty: Set[str] = set()
+        # 读取时的本地缓存序号, 只有完整读取过的状态才写回本地缓存
+        self._since = since
+
+    def get(self, name: str) -> Any:
+        return self._values.get(name)
+
+    def update(self, **values: BaseModel) -> None:
+        for name, value in values.items():
+            assert name in _fields, f"unknown session state field {name}"
+            self._values[name] = value
+            self._dirty.add(name)
+
+    @classmethod
+    async def load(cls, session_id: UUID) -> "SessionState":
+        key = str(session_id)
+
+        if _local is not None:
+            values = _local.get(key)
+            if not is_missing(values):
+                return cls(session_id, {name: value.copy() for name, value in values.items()}, _local.mark())
+
+        since = _local.mark() if _local is not None else None
+        raw = await get_database().hgetall(_key(session_id))  # type: ignore
+
+        values = {}
+        for name, data in raw.items():
+            name = name.decode("utf8") if isinstance(name, bytes) else name
+            if name in _fields and data:
+                values[name] = _codec.decode(_fields[name], data)
+
+        if _local is not None:
+            _local.record_remote(len(values) > 0)
+            _local.set(key, {name: value.copy() for name, value in values.items()}, since)  # type: ignore
+        return cls(session_id, values, since)
+
+    async def commit(self) -> None:
+        """本轮修改过的字段一次写回并续期"""
+        if len(self._dirty) == 0:
+            return
+
+        key = str(self.session_id)
+        async with get_pipeline(transaction=True) as pipe:
+            pipe.hset(  # type: ignore
+                _key(self.session_id),
+                mapping={name: _codec.encode(self._values[name]) for name in self._dirty},
+            )
+            pipe.expire(_key(self.session_id), STATE_EXPIRE)  # type: ignore
+            queue_invalidation(pipe, "SessionState", key)
+            await pipe.execute()
+        self._dirty.clear()
+
+        # 同一个会话的下一轮通常落在同一个 worker
+        if _local is not None and self._since is not None:
+            _local.set(
+                key,
+                {name: value.copy() for name, value in self._values.items()},
+                self._since,
+                ttl=STATE_EXPIRE,
+            )
@@ -0,0 +1,101 @@
+import asyncio
+import weakref
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from multi_chat import config
+
+from ..metrics import register_collector
+
+
+class PooledTransport(httpx.AsyncHTTPTransport):
+    """带连接统计的长连接 transport, 用于确认连接复用情况"""
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.connections_opened = 0
+        self._seen_connections: "weakref.WeakSet" = weakref.WeakSet()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await super().handle_async_request(request)
+        self.requests += 1
+
+        # 连接池中新出现的连接即为一次新的 TCP+TLS 握手
+        for connection in self._pool.connections:
+            if connection not in self._seen_connections:
+                self._seen_connections.add(connection)
+                self.connections_opened += 1
+
+        return response
+
+    def stats(self) -> dict:
+        connections = self._pool.connections
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return dict(
+            requests=self.requests,
+            connections_opened=self.connections_opened,
+            handshakes_avoided=max(self.requests - self.connections_opened, 0),
+            active=len(connections) - idle,
+            idle=idle,
+        )
+
+
+_clients: Dict[Tuple[str, Optional[str]], httpx.AsyncClient] = {}
+
+
+def get_client(backend: str, proxy: Optional[str] = None) -> httpx.AsyncClient:
+    """按 (backend, proxy) 获取共享的长连接客户端"""
+    key = (backend, proxy)
+    client = _clients.get(key)
+
+    if client is None or client.is_closed:
+        transport = PooledTransport(
+            proxy=httpx.Proxy(url=proxy) if proxy is not None else None,
+            limits=httpx.Limits(
+                max_connections=config.upstream.max_connections,
+                max_keepalive_connections=config.upstream.max_keepalive_connections,
+                keepalive_expiry=config.upstream.keepalive_expiry,
+            ),
+            retries=config.upstream.retries,
+        )
+        # 共享客户端不保存响应 cookie, 避免不同账号之间串 cookie
+        client = httpx.AsyncClient(
+            transport=transport,
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+        _clients[key] = client
+
+    return client
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*[client.aclose() for client in clients], return_exceptions=True)
+
+
+def _proxy_label(proxy: Optional[str]) -> Optional[str]:
+    # 不暴露代理的账号密码
+    if proxy is None:
+        return None
+    url = httpx.URL(proxy)
+    return f"{url.scheme}://{url.host}:{url.port}" if url.port else f"{url.scheme}://{url.host}"
+
+
+def get_pool_stats() -> List[dict]:
+    stats = []
+    for (backend, proxy), client in _clients.items():
+        transport = client._transport
+        if isinstance(transport, PooledTransport):
+            stats.append(dict(
+                backend=backend,
+                proxy=_proxy_label(proxy),
+                **transport.stats(),
+            ))
+    return stats
+
+
+register_collector("upstream", get_pool_stats)
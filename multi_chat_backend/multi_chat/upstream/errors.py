@@ -0,0 +1,74 @@
+from typing import Optional
+
+import httpx
+
+
+class UpstreamError(Exception):
+    """上游接口错误, retryable 表示换个时机 (或换个账号) 重试可能成功"""
+
+    retryable = False
+
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        text: Optional[str] = None,
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.text = text
+
+
+class AuthError(UpstreamError):
+    """token 无法解析或已过期, 需要重新登录"""
+
+
+class RateLimitError(UpstreamError):
+    """账号触发限流"""
+
+
+class CloudflareError(UpstreamError):
+    """cf clearance 失效"""
+
+    retryable = True
+
+
+class OverloadedError(UpstreamError):
+    """上游过载或内部错误"""
+
+    retryable = True
+
+
+class StreamError(UpstreamError):
+    """连接中断或流被截断"""
+
+    retryable = True
+
+
+class AccountUnavailableError(UpstreamError):
+    """没有可分配的账号: 预算用完或都在熔断冷却中"""
+
+
+def classify_response(status_code: int, text: str) -> UpstreamError:
+    """按状态码和响应内容把失败的响应归类"""
+    message = f"[Status Code] {status_code} | [Response Text] {text}"
+    lower_text = text.lower()
+
+    if (
+        status_code == 401
+        or "parse your authentication token" in lower_text
+        or "token has expired" in lower_text
+    ):
+        return AuthError(message, status_code, text)
+    if status_code == 429 or "too many requests" in lower_text:
+        return RateLimitError(message, status_code, text)
+    if status_code == 403 and "cloudflare" in lower_text:
+        return CloudflareError(message, status_code, text)
+    if status_code >= 500 or "maybe try me again" in lower_text:
+        return OverloadedError(message, status_code, text)
+    return UpstreamError(message, status_code, text)
+
+
+def classify_transport(e: httpx.TransportError) -> StreamError:
+    # incomplete chunked read, peer closed connection, 超时等
+    return StreamError(f"[{type(e).__name__}] {e}")
@@ -0,0 +1,92 @@
+import asyncio
+import random
+from collections import Counter
+from typing import Dict, Optional, Tuple, Type
+
+from multi_chat import config, logger
+
+from ..metrics import register_collector
+from .errors import UpstreamError
+
+# 按 (backend, 错误类型) 统计重试次数
+_retry_counter: Counter = Counter()
+
+
+class RetryPolicy:
+    """重试预算加带抖动的指数退避
+
+    调用方用循环代替递归:
+
+        policy = RetryPolicy("chatgpt")
+        while True:
+            try:
+                ...
+                break
+            except UpstreamError as e:
+                if not policy.should_retry(e):
+                    raise
+                await policy.backoff(e)
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        budget: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        retry_on: Optional[Tuple[Type[UpstreamError], ...]] = None,
+    ) -> None:
+        self.backend = backend
+        self.budget = config.upstream.retry_budget if budget is None else budget
+        self.base_delay = config.upstream.retry_base_delay if base_delay is None else base_delay
+        self.max_delay = config.upstream.retry_max_delay if max_delay is None else max_delay
+        # 为空时按错误自身的 retryable 判断
+        self.retry_on = retry_on
+        self.attempt = 0
+
+    def should_retry(self, e: UpstreamError) -> bool:
+        if self.retry_on is not None:
+            retryable = isinstance(e, self.retry_on)
+        else:
+            retryable = e.retryable
+
+        if not retryable:
+            return False
+        if self.attempt >= self.budget:
+            logger.warning(f"{self.backend} retry max: {type(e).__name__}")
+            return False
+        return True
+
+    def delay(self) -> float:
+        # full jitter: [0, min(max_delay, base_delay * 2^attempt)]
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** self.attempt)))
+
+    async def backoff(self, e: UpstreamError) -> None:
+        _retry_counter[(self.backend, type(e).__name__)] += 1
+        delay = self.delay()
+        self.attempt += 1
+        logger.info(f"{self.backend} retry {self.attempt}/{self.budget} after {delay:.2f}s: {type(e).__name__}")
+        await asyncio.sleep(delay)
+
+
+class StreamResume:
+    """重试后上游从头重新生成, 只有新的回答超过已发送的长度后才继续发送, 避免客户端看到回退和重复"""
+
+    def __init__(self) -> None:
+        self.emitted = 0
+
+    def accept(self, text_length: int) -> bool:
+        if text_length > self.emitted:
+            self.emitted = text_length
+            return True
+        return False
+
+
+def get_retry_stats() -> Dict[str, Dict[str, int]]:
+    stats: Dict[str, Dict[str, int]] = {}
+    for (backend, error), count in _retry_counter.items():
+        stats.setdefault(backend, {})[error] = count
+    return stats
+
+
+register_collector("upstream_retry", get_retry_stats)
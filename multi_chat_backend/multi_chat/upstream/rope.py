@@ -0,0 +1,51 @@
+from bisect import bisect_right
+from typing import Iterable, List
+
+
+class TextRope:
+    """只追加的分块文本
+
+    流式生成时每次只追加新块, 不重复拷贝已有内容; 需要全文时才拼接 (结果缓存),
+    需要增量时用 since 取某个位置之后的后缀.
+    """
+
+    __slots__ = ("_chunks", "_starts", "_length", "_text", "_joined")
+
+    def __init__(self, chunks: Iterable[str] = ()) -> None:
+        self._chunks: List[str] = []
+        self._starts: List[int] = []
+        self._length = 0
+        self._text = ""
+        self._joined = 0
+
+        for chunk in chunks:
+            self.append(chunk)
+
+    def append(self, chunk: str) -> None:
+        if len(chunk) == 0:
+            return
+        self._chunks.append(chunk)
+        self._starts.append(self._length)
+        self._length += len(chunk)
+
+    def since(self, offset: int) -> str:
+        if offset <= 0:
+            return str(self)
+        if offset >= self._length:
+            return ""
+
+        idx = bisect_right(self._starts, offset) - 1
+        head = self._chunks[idx][offset - self._starts[idx]:]
+        return head + "".join(self._chunks[idx + 1:])
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __str__(self) -> str:
+        if self._joined < len(self._chunks):
+            self._text += "".join(self._chunks[self._joined:])
+            self._joined = len(self._chunks)
+        return self._text
+
+    def __repr__(self) -> str:
+        return f"TextRope(length={self._length}, chunks={len(self._chunks)})"
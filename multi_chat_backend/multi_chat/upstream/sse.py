@@ -0,0 +1,71 @@
+from typing import Any, AsyncGenerator, List
+
+import httpx
+import orjson
+
+DONE = b"[DONE]"
+
+
+class SSEParser:
+    """增量解析 text/event-stream 字节流, 不解码成 str
+
+    缓冲区在 feed 之间复用, 一个事件的多行 data 按规范用换行拼接,
+    event/id/retry 字段和注释行直接忽略.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        buffer = self._buffer
+        buffer += chunk
+
+        events = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+
+            line_end = end
+            if line_end > start and buffer[line_end - 1] == 13:  # \r
+                line_end -= 1
+
+            if line_end == start:
+                # 空行, 一个事件结束
+                if len(self._data) > 0:
+                    events.append(self._data[0] if len(self._data) == 1 else b"\n".join(self._data))
+                    self._data = []
+            elif buffer.startswith(b"data:", start):
+                value_start = start + 5
+                if value_start < line_end and buffer[value_start] == 32:  # 空格
+                    value_start += 1
+                self._data.append(bytes(buffer[value_start:line_end]))
+
+            start = end + 1
+
+        del buffer[:start]
+        return events
+
+    def flush(self) -> List[bytes]:
+        """流结束时处理没有以空行结尾的最后一个事件"""
+        events = self.feed(b"\n\n") if len(self._buffer) > 0 else self.feed(b"\n")
+        self._buffer.clear()
+        return events
+
+
+async def iter_events(response: httpx.Response) -> AsyncGenerator[Any, None]:
+    """逐个返回上游事件解析后的 json, 遇到 [DONE] 结束"""
+    parser = SSEParser()
+
+    async for chunk in response.aiter_bytes():
+        for data in parser.feed(chunk):
+            if data == DONE:
+                return
+            yield orjson.loads(data)
+
+    for data in parser.flush():
+        if data == DONE:
+            return
+        yield orjson.loads(data)